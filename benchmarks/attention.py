@@ -0,0 +1,74 @@
+"""
+Latency and largest single allocation of the attention backends (einsum vs
+scaled_dot_product_attention vs the chunked attention) on CPU, with and without
+the (B, 1, S, S) attention bias, over several sequence lengths
+
+usage: python benchmarks/attention.py [--seq-lens 1000 2000 4000]
+    [--batch-size 4] [--chunk-size 1024] [--threads 8]
+"""
+
+import argparse
+import time
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from scprint.model.flash_attn.backends import attention
+
+
+def largest_allocation(fn):
+    with profile(
+        activities=[ProfilerActivity.CPU], profile_memory=True
+    ) as prof:
+        fn()
+    return max(
+        (event.self_cpu_memory_usage for event in prof.events()), default=0
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--seq-lens", nargs="+", type=int, default=[1000, 2000, 4000]
+    )
+    parser.add_argument("--batch-size", type=int, default=4)
+    parser.add_argument("--nhead", type=int, default=8)
+    parser.add_argument("--head-dim", type=int, default=64)
+    parser.add_argument("--chunk-size", type=int, default=1024)
+    parser.add_argument("--repeats", type=int, default=3)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    for seq_len in args.seq_lens:
+        qkv = torch.randn(
+            args.batch_size, seq_len, 3, args.nhead, args.head_dim
+        )
+        for bias in [None, torch.randn(args.batch_size, 1, seq_len, seq_len)]:
+            for backend in ["einsum", "sdpa", "chunked"]:
+                kwargs = (
+                    {"chunk_size": args.chunk_size}
+                    if backend == "chunked"
+                    else {}
+                )
+                with torch.inference_mode():
+                    run = lambda: attention(
+                        qkv, bias=bias, backend=backend, **kwargs
+                    )
+                    run()
+                    start = time.perf_counter()
+                    for _ in range(args.repeats):
+                        run()
+                    duration = (time.perf_counter() - start) / args.repeats
+                    peak = largest_allocation(run)
+                print(
+                    f"S={seq_len:>6} bias={bias is not None!s:>5} "
+                    f"{backend:>7}: "
+                    f"{duration * 1000:9.1f} ms, "
+                    f"largest allocation {peak / 2**20:8.1f} MiB"
+                )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Memory / throughput of a training step of the transformer for several
+activation checkpointing and offloading policies of FlashTransformerEncoder
+
+usage: python benchmarks/checkpointing.py [--d-model 512] [--nlayers 16]
+    [--seq-len 2400] [--batch-size 8]
+"""
+
+import argparse
+import time
+
+import torch
+
+from scprint.model.flash_attn import FlashTransformerEncoder
+
+POLICIES = {
+    "none": {},
+    "mlp": {"checkpoint_mlp": True},
+    "half layers + mlp": {"checkpoint_layers": "half", "checkpoint_mlp": True},
+    "all layers": {"checkpoint_layers": "all"},
+    "offload": {"offload_activations": True},
+    "all layers + offload": {
+        "checkpoint_layers": "all",
+        "offload_activations": True,
+    },
+}
+
+
+def saved_bytes(fn):
+    """
+    saved_bytes runs fn and sums the size of the tensors kept on the device for
+    the backward pass (the ones recomputed or offloaded by the policy are
+    handled by their own hooks and not counted)
+    """
+    size = 0
+
+    def pack(tensor):
+        nonlocal size
+        size += tensor.numel() * tensor.element_size()
+        return tensor
+
+    with torch.autograd.graph.saved_tensors_hooks(pack, lambda tensor: tensor):
+        fn()
+    return size
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--d-model", type=int, default=512)
+    parser.add_argument("--nhead", type=int, default=8)
+    parser.add_argument("--nlayers", type=int, default=16)
+    parser.add_argument("--seq-len", type=int, default=2400)
+    parser.add_argument("--batch-size", type=int, default=8)
+    parser.add_argument("--repeats", type=int, default=3)
+    args = parser.parse_args()
+
+    cuda = torch.cuda.is_available()
+    device = torch.device("cuda" if cuda else "cpu")
+    dtype = torch.float16 if cuda else torch.bfloat16
+    x = torch.randn(args.batch_size, args.seq_len, args.d_model, device=device)
+
+    for name, policy in POLICIES.items():
+        if policy.get("checkpoint_layers") == "half":
+            policy = {
+                **policy,
+                "checkpoint_layers": list(range(args.nlayers // 2)),
+            }
+        model = FlashTransformerEncoder(
+            args.d_model,
+            args.nhead,
+            args.nlayers,
+            dropout=0.1,
+            use_flash_attn=cuda,
+            **policy,
+        ).to(device)
+
+        def step():
+            with torch.autocast(device_type=device.type, dtype=dtype):
+                out = model(x)
+            out.float().pow(2).mean().backward()
+
+        step()
+        if cuda:
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        for _ in range(args.repeats):
+            step()
+        if cuda:
+            torch.cuda.synchronize()
+        duration = (time.perf_counter() - start) / args.repeats
+        with torch.autocast(device_type=device.type, dtype=dtype):
+            saved = saved_bytes(lambda: model(x))
+        print(
+            f"{name:>22}: {saved / 2**20:8.1f} MiB saved for backward, "
+            + (
+                f"{torch.cuda.max_memory_allocated() / 2**20:8.1f} MiB peak, "
+                if cuda
+                else ""
+            )
+            + f"{args.batch_size * args.seq_len / duration:9.0f} tokens/s"
+        )
+        del model
+
+
+if __name__ == "__main__":
+    main()
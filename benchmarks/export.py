@@ -0,0 +1,82 @@
+"""
+Start-up time, latency and parity of an exported scPrint artifact vs the
+scprint package, on CPU
+
+usage: python benchmarks/export.py --ckpt path/to/model.ckpt [--format onnx]
+    [--out /tmp/scprint_export]
+"""
+
+import argparse
+import subprocess
+import sys
+import time
+
+import numpy as np
+import torch
+
+from scprint import scPrint
+from scprint.model.export import export
+
+
+def startup(code):
+    start = time.perf_counter()
+    subprocess.run([sys.executable, "-c", code], check=True)
+    return time.perf_counter() - start
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt", type=str, required=True)
+    parser.add_argument("--format", type=str, default="onnx")
+    parser.add_argument("--out", type=str, default="/tmp/scprint_export")
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--seq-len", type=int, default=2000)
+    args = parser.parse_args()
+
+    model = scPrint.load_from_checkpoint(args.ckpt, precpt_gene_emb=None)
+    model = model.to("cpu", torch.float32).eval()
+    export(model, args.out, format=args.format)
+
+    print(f"import scprint: {startup('import scprint'):.2f}s")
+    load = (
+        f"import sys; sys.path.insert(0, {args.out!r}); "
+        f"import runner; runner.Runner({args.out!r})"
+    )
+    print(f"load the runner: {startup(load):.2f}s")
+
+    sys.path.insert(0, args.out)
+    import runner
+
+    run = runner.Runner(args.out)
+    torch.manual_seed(0)
+    gene_pos = torch.stack(
+        [
+            torch.randperm(len(model.genes))[: args.seq_len]
+            for _ in range(args.batch_size)
+        ]
+    )
+    expression = torch.poisson(torch.rand(gene_pos.shape) * 3)
+    depth = expression.sum(1)
+
+    start = time.perf_counter()
+    with torch.no_grad():
+        ref = model._predict(gene_pos, expression, depth, keep_output=False)
+    print(f"scPrint._predict: {time.perf_counter() - start:.2f}s per batch")
+    start = time.perf_counter()
+    out = run.predict(gene_pos.numpy(), expression.numpy(), depth.numpy())
+    print(f"runner.predict: {time.perf_counter() - start:.2f}s per batch")
+
+    print(
+        f"max embs diff: {np.abs(out['embs'] - ref['embs'].numpy()).max():.2e}"
+    )
+    diff = max(
+        np.abs(a - b.numpy()).max() for a, b in zip(out["expr"], ref["expr"])
+    )
+    print(f"max expr diff: {diff:.2e}")
+    if out["class"] is not None:
+        agreement = (out["class"] == ref["class"].numpy()).mean()
+        print(f"class agreement: {agreement:.4f}")
+
+
+if __name__ == "__main__":
+    main()
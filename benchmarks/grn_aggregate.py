@@ -0,0 +1,65 @@
+"""
+Time of GRNfer.aggregate, turning the accumulated Q/K of the cells into a gene
+x gene network, on random Q/K for 5000 genes x 16 layers x 8 heads by default
+
+usage: python benchmarks/grn_aggregate.py [--genes 5000] [--layers 16]
+    [--heads 8] [--device cuda] [--memory BYTES]
+"""
+
+import argparse
+import time
+from types import SimpleNamespace
+
+import torch
+
+from scprint.tasks.grn import GRNfer
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--genes", type=int, default=5000)
+    parser.add_argument("--layers", type=int, default=16)
+    parser.add_argument("--heads", type=int, default=8)
+    parser.add_argument("--head-dim", type=int, default=64)
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+    )
+    parser.add_argument(
+        "--memory",
+        type=int,
+        default=None,
+        help="the aggregate_memory of GRNfer, defaults to the free memory",
+    )
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    attn = torch.randn(
+        args.layers, args.genes + 8, 2, args.heads, args.head_dim
+    )
+    # all the genes were seen, after the 8 cell tokens
+    ids = torch.arange(args.genes + 8)
+    model = SimpleNamespace(
+        device=torch.device(args.device),
+        genes=[str(i) for i in range(args.genes)],
+        attn=SimpleNamespace(gene_dim=args.genes + 8),
+    )
+    for head_agg in ["mean", "max", "none"]:
+        grnfer = GRNfer(
+            model,
+            None,
+            head_agg=head_agg,
+            doplot=False,
+            aggregate_memory=args.memory,
+        )
+        start = time.perf_counter()
+        adj = grnfer.aggregate((ids, attn))
+        if args.device == "cuda":
+            torch.cuda.synchronize()
+        duration = time.perf_counter() - start
+        print(f"head_agg={head_agg:>4}: {duration:.2f}s, output {adj.shape}")
+
+
+if __name__ == "__main__":
+    main()
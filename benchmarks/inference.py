@@ -0,0 +1,119 @@
+"""
+Allocations of a scPrint forward pass per batch: regular forward (with and
+without autograd) vs scPrint.infer()
+
+usage: python benchmarks/inference.py [--ckpt path/to/model.ckpt]
+    [--batch-size 16] [--seq-len 2000]
+"""
+
+import argparse
+import time
+
+import torch
+from torch.profiler import ProfilerActivity, profile
+
+from scprint import scPrint
+
+
+def allocations(fn, device):
+    """
+    allocations runs fn under the profiler and counts the memory allocations it
+    made
+
+    Returns:
+        tuple[int, int]: the number of allocations and the number of allocated
+        bytes
+    """
+    activities = [ProfilerActivity.CPU]
+    if device.type == "cuda":
+        activities.append(ProfilerActivity.CUDA)
+    with profile(activities=activities, profile_memory=True) as prof:
+        fn()
+    num, size = 0, 0
+    for event in prof.events():
+        mem = (
+            event.self_cuda_memory_usage
+            if device.type == "cuda"
+            else event.self_cpu_memory_usage
+        )
+        if mem > 0:
+            num += 1
+            size += mem
+    return num, size
+
+
+def timeit(fn, device, repeats):
+    fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    start = time.perf_counter()
+    for _ in range(repeats):
+        fn()
+    if device.type == "cuda":
+        torch.cuda.synchronize()
+    return (time.perf_counter() - start) / repeats
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt", type=str, default=None)
+    parser.add_argument("--batch-size", type=int, default=16)
+    parser.add_argument("--seq-len", type=int, default=2000)
+    parser.add_argument("--repeats", type=int, default=5)
+    args = parser.parse_args()
+
+    device = torch.device("cuda" if torch.cuda.is_available() else "cpu")
+    if args.ckpt is not None:
+        model = scPrint.load_from_checkpoint(args.ckpt, precpt_gene_emb=None)
+    else:
+        model = scPrint(
+            genes=[str(i) for i in range(20_000)],
+            d_model=256,
+            nhead=4,
+            nlayers=4,
+            classes={"cell_type_ontology_term_id": 10},
+            num_batch_labels=0,
+            transformer="flash" if device.type == "cuda" else "normal",
+        )
+    model = model.to(device).eval()
+    model.attn_bias = "none"
+
+    torch.manual_seed(0)
+    gene_pos = torch.stack(
+        [
+            torch.randperm(len(model.genes), device=device)[: args.seq_len]
+            for _ in range(args.batch_size)
+        ]
+    )
+    expression = (
+        torch.poisson(torch.rand(gene_pos.shape, device=device) * 3) + 1
+    )
+    depth = expression.sum(1)
+
+    def autograd():
+        model(gene_pos, expression, full_depth=depth, do_class=True)
+
+    def no_grad():
+        with torch.no_grad():
+            model(gene_pos, expression, full_depth=depth, do_class=True)
+
+    def inference():
+        model.infer(gene_pos, expression, full_depth=depth, do_class=True)
+
+    with torch.autocast(device_type=device.type, dtype=torch.bfloat16):
+        for name, fn in [
+            ("forward", autograd),
+            ("no_grad forward", no_grad),
+            ("infer", inference),
+        ]:
+            num, size = allocations(fn, device)
+            duration = timeit(fn, device, args.repeats)
+            print(
+                f"{name:>16}: {num} allocations, "
+                f"{size / 2**20:.1f} MiB allocated, "
+                f"{duration * 1000:.1f} ms per batch"
+            )
+
+
+if __name__ == "__main__":
+    main()
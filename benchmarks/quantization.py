@@ -0,0 +1,47 @@
+"""
+Accuracy vs speed of the int8 dynamic quantization on CPU, on the default
+embedding and classification benchmarks of scprint.tasks.cell_emb
+
+usage: python benchmarks/quantization.py --ckpt path/to/model.ckpt
+    [--datasets pancreas lung]
+"""
+
+import argparse
+import time
+
+import torch
+
+from scprint import scPrint
+from scprint.tasks.cell_emb import default_benchmark
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--ckpt", type=str, required=True)
+    parser.add_argument("--datasets", nargs="+", default=["pancreas", "lung"])
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args()
+
+    if args.threads is not None:
+        torch.set_num_threads(args.threads)
+    model = scPrint.load_from_checkpoint(args.ckpt, precpt_gene_emb=None)
+    model = model.to("cpu", torch.float32).eval()
+
+    for dataset in args.datasets:
+        for quantize in [None, "int8"]:
+            start = time.perf_counter()
+            metrics = default_benchmark(
+                model, default_dataset=dataset, coarse=False, quantize=quantize
+            )
+            duration = time.perf_counter() - start
+            classif = metrics["classif"]["cell_type_ontology_term_id"]
+            print(
+                f"{dataset:>10} {str(quantize):>5}: "
+                f"{duration:7.1f}s total (embedding + metrics), "
+                f"scib total {metrics['scib']['Total']:.4f}, "
+                f"cell type accuracy {classif['accuracy']:.4f}"
+            )
+
+
+if __name__ == "__main__":
+    main()
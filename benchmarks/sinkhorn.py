@@ -0,0 +1,62 @@
+"""
+Time and peak memory of the sinkhorn normalization of
+GRNfer(preprocess="sinkhorn") on random attention scores of a batch of heads,
+for 1000 and 5000 genes by default
+
+usage: python benchmarks/sinkhorn.py [--genes 1000 5000] [--heads 4]
+    [--device cuda]
+"""
+
+import argparse
+import time
+
+import torch
+
+from scprint.utils.sinkhorn import sinkhorn
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--genes", type=int, nargs="+", default=[1000, 5000])
+    parser.add_argument("--heads", type=int, default=4)
+    parser.add_argument("--max-iter", type=int, default=200)
+    parser.add_argument("--thresh", type=float, default=1e-5)
+    parser.add_argument(
+        "--device",
+        type=str,
+        default="cuda" if torch.cuda.is_available() else "cpu",
+    )
+    args = parser.parse_args()
+
+    torch.manual_seed(0)
+    for n_genes in args.genes:
+        q = torch.randn(args.heads, n_genes, 64, device=args.device)
+        k = torch.randn(args.heads, n_genes, 64, device=args.device)
+        scores = q @ k.transpose(-1, -2) / 8
+        if args.device == "cuda":
+            torch.cuda.synchronize()
+            torch.cuda.reset_peak_memory_stats()
+        start = time.perf_counter()
+        plans = sinkhorn(
+            scores,
+            0.1,
+            max_iter=args.max_iter,
+            thresh=args.thresh,
+            inplace=True,
+        )[0]
+        if args.device == "cuda":
+            torch.cuda.synchronize()
+        duration = time.perf_counter() - start
+        line = f"{n_genes:>6} genes x {args.heads} heads: {duration:7.2f}s"
+        if args.device == "cuda":
+            line += f", peak {torch.cuda.max_memory_allocated() / 2**20:.0f}MB"
+        row_err = (plans.sum(-1) * n_genes - 1).abs().max().item()
+        col_err = (plans.sum(-2) * n_genes - 1).abs().max().item()
+        print(
+            f"{line}, marginal errors {row_err:.1e} (rows) "
+            f"{col_err:.1e} (cols)"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,34 @@
+"""
+Time of the TMFG filtration (scprint.tasks.tmfg) on random symmetric weights,
+for 1000 to 10000 nodes by default
+
+usage: python benchmarks/tmfg.py [--nodes 1000 2000 5000 10000]
+"""
+
+import argparse
+import time
+
+import numpy as np
+
+from scprint.tasks.tmfg import tmfg
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument(
+        "--nodes", type=int, nargs="+", default=[1000, 2000, 5000, 10000]
+    )
+    args = parser.parse_args()
+
+    rng = np.random.default_rng(0)
+    for p in args.nodes:
+        weights = rng.random((p, p), dtype=np.float32)
+        weights = (weights + weights.T) / 2
+        start = time.perf_counter()
+        adj = tmfg(weights)
+        duration = time.perf_counter() - start
+        print(f"{p:>6} nodes: {duration:7.2f}s, {adj.nnz // 2} edges")
+
+
+if __name__ == "__main__":
+    main()
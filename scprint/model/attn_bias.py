@@ -0,0 +1,123 @@
+from collections import OrderedDict
+from typing import Union
+
+import numpy as np
+import torch
+from scipy.sparse import csr_matrix, load_npz, spmatrix
+from torch import Tensor
+
+
+class SparseGeneBias:
+    def __init__(
+        self,
+        prior: Union[str, spmatrix],
+        num_special_tokens: int = 0,
+        special_bias: float = -10_000.0,
+        cache_size: int = 16,
+        dtype: torch.dtype = torch.float16,
+    ):
+        """
+        SparseGeneBias builds the gene-gene attention bias of a minibatch from
+        a sparse prior.
+
+        The prior (genes x genes) stays in CSR format on the host. For each
+        minibatch, only the block of the genes actually present is densified
+        and sent to the device. When all the cells of a minibatch use the same
+        genes (e.g. a fixed gene panel at inference), a single (1, 1, S, S)
+        bias is broadcast over the batch and kept in an LRU cache keyed by the
+        gene set.
+
+        Args:
+            prior (str | scipy.sparse.spmatrix): the prior or the path to the
+                .npz file storing it.
+            num_special_tokens (int, optional): the number of non-gene tokens
+                (cell embeddings) at the start of the sequence. Defaults to 0.
+            special_bias (float, optional): the bias of gene tokens attending
+                to the special tokens. Defaults to -10_000 (do not pay
+                attention to the cls embeddings).
+            cache_size (int, optional): the number of gene sets to keep in the
+                cache. 0 disables it. Defaults to 16.
+            dtype (torch.dtype, optional): the dtype of the bias. Defaults to
+                torch.float16.
+        """
+        if isinstance(prior, str):
+            prior = load_npz(prior)
+        self.prior = csr_matrix(prior, dtype=np.float32)
+        self.num_special_tokens = num_special_tokens
+        self.special_bias = special_bias
+        self.cache_size = cache_size
+        self.dtype = dtype
+        self._cache = OrderedDict()
+
+    def block(self, genes: np.ndarray) -> np.ndarray:
+        """
+        block the dense (len(genes), len(genes)) sub-matrix of the prior for
+        the given gene ids
+
+        Args:
+            genes (np.ndarray): the gene ids (positions in the model's
+                vocabulary)
+
+        Returns:
+            np.ndarray: the dense block
+        """
+        return self.prior[genes][:, genes].toarray()
+
+    def _fill(self, out: Tensor, genes: np.ndarray):
+        n = self.num_special_tokens
+        out[n:, :n] = self.special_bias
+        out[n:, n:] = torch.from_numpy(self.block(genes))
+
+    def get(self, genes: np.ndarray, device: torch.device) -> Tensor:
+        """
+        get the (S, S) bias for a single gene set, going through the cache
+
+        Args:
+            genes (np.ndarray): the gene ids of the sequence
+            device (torch.device): the device on which to return the bias
+
+        Returns:
+            Tensor: the bias of shape (num_special_tokens + len(genes),) * 2
+        """
+        key = (str(device), genes.tobytes())
+        if key in self._cache:
+            self._cache.move_to_end(key)
+            return self._cache[key]
+        size = len(genes) + self.num_special_tokens
+        bias = torch.zeros((size, size), dtype=self.dtype)
+        self._fill(bias, genes)
+        bias = bias.to(device)
+        if self.cache_size > 0:
+            self._cache[key] = bias
+            if len(self._cache) > self.cache_size:
+                self._cache.popitem(last=False)
+        return bias
+
+    def clear_cache(self):
+        self._cache.clear()
+
+    def __call__(self, gene_pos: Tensor) -> Tensor:
+        """
+        Args:
+            gene_pos (Tensor): the gene ids of the minibatch (minibatch,
+                seq_len)
+
+        Returns:
+            Tensor: the bias, of shape (1, 1, S, S) if all cells share the same
+                genes, else (minibatch, 1, S, S), with S = num_special_tokens +
+                seq_len
+        """
+        if bool((gene_pos == gene_pos[:1]).all()):
+            return self.get(gene_pos[0].cpu().numpy(), gene_pos.device)[
+                None, None
+            ]
+        genes = gene_pos.cpu().numpy()
+        size = genes.shape[1] + self.num_special_tokens
+        bias = torch.zeros(
+            (genes.shape[0], 1, size, size),
+            dtype=self.dtype,
+            pin_memory=gene_pos.is_cuda,
+        )
+        for i, cell_genes in enumerate(genes):
+            self._fill(bias[i, 0], cell_genes)
+        return bias.to(gene_pos.device, non_blocking=True)
@@ -1,4 +1,4 @@
-from typing import Dict, Union, Callable
+from typing import Dict, Union, Callable, Optional
 from torch import Tensor, nn
 from torch.nn import functional as F
 import torch
@@ -58,12 +58,31 @@ class ExprDecoder(nn.Module):
         self.pred_var_zero = nn.Linear(d_model, 3 if zinb else 1)
         self.zinb = zinb
 
-    def forward(self, x: Tensor) -> Dict[str, Tensor]:
-        """x is the output of the transformer, (batch, seq_len, d_model)"""
+    def forward(
+        self, x: Tensor, mask: Optional[Tensor] = None
+    ) -> Dict[str, Tensor]:
+        """
+        Args:
+            x: Tensor, the output of the transformer, (batch, seq_len, d_model)
+            mask: Tensor, optional. (batch, seq_len - nfirst_tokens_to_skip)
+                True for the gene tokens to decode, False for padding. Padding
+                tokens are not decoded and get a null mean. Defaults to None.
+        """
         # we don't do it on the labels
-        x = self.fc(x[:, self.nfirst_tokens_to_skip :, :])
+        x = x[:, self.nfirst_tokens_to_skip :, :]
+        if mask is None:
+            out = self.pred_var_zero(self.fc(x))
+        else:
+            # only the real tokens go through the decoder
+            out = torch.zeros(
+                x.shape[:2] + (self.pred_var_zero.out_features,),
+                device=x.device,
+                dtype=x.dtype,
+            )
+            out[mask] = self.pred_var_zero(self.fc(x[mask])).to(x.dtype)
+            out[..., 0] = out[..., 0].masked_fill(~mask, float("-inf"))
         if self.zinb:
-            pred_value, var_value, zero_logits = self.pred_var_zero(x).split(
+            pred_value, var_value, zero_logits = out.split(
                 1, dim=-1
             )  # (batch, seq_len)
             # The sigmoid function is used to map the zero_logits to a probability between 0 and 1.
@@ -73,8 +92,7 @@ class ExprDecoder(nn.Module):
                 zero_logits=zero_logits.squeeze(-1),
             )
         else:
-            pred_value = self.pred_var_zero(x)
-            return dict(mean=F.softmax(pred_value.squeeze(-1), dim=-1))
+            return dict(mean=F.softmax(out.squeeze(-1), dim=-1))
 
 
 class MVCDecoder(nn.Module):
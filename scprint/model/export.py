@@ -0,0 +1,188 @@
+import json
+import os
+import shutil
+from contextlib import contextmanager
+
+import torch
+from torch import Tensor, nn
+
+from .flash_attn.mha import MHA, SelfAttention
+
+FILEDIR = os.path.dirname(os.path.realpath(__file__))
+
+
+@contextmanager
+def non_triton_attention(model: nn.Module):
+    """
+    non_triton_attention temporarily replaces the triton flash attention
+    kernels of the model by the pure pytorch attention, so that it can be
+    traced and run on CPU.
+
+    Args:
+        model (nn.Module): the model
+    """
+    swapped = []
+    for module in model.modules():
+        if isinstance(module, MHA) and module.use_flash_attn:
+            swapped.append((module, module.inner_attn))
+            module.inner_attn = SelfAttention(
+                causal=module.inner_attn.causal,
+                softmax_scale=module.inner_attn.softmax_scale,
+            )
+            module.use_flash_attn = False
+    try:
+        yield model
+    finally:
+        for module, inner_attn in swapped:
+            module.inner_attn = inner_attn
+            module.use_flash_attn = True
+
+
+class InferenceGraph(nn.Module):
+    def __init__(self, model: nn.Module):
+        """
+        InferenceGraph the part of scPrint that is exported: the encoders, the
+        transformer, the expression decoder and the class decoders, as used by
+        scPrint._predict()
+
+        Args:
+            model (scPrint): the model
+        """
+        super().__init__()
+        self.model = model
+        self.output_names = ["cell_embs", "mean"]
+        if model.expr_decoder.zinb:
+            self.output_names += ["disp", "zero_logits"]
+        self.output_names += ["cls_output_" + clss for clss in model.classes]
+
+    def forward(self, gene_pos: Tensor, expression: Tensor, depth: Tensor):
+        """
+        Args:
+            gene_pos (Tensor): the gene ids of each cell (minibatch, seq_len)
+            expression (Tensor): the expression of these genes (minibatch,
+                seq_len)
+            depth (Tensor): the total count of each cell (minibatch,)
+
+        Returns:
+            tuple[Tensor]: the outputs, in the order of self.output_names
+        """
+        output = self.model(
+            gene_pos,
+            expression,
+            depth_mult=expression.sum(1),
+            full_depth=depth,
+            do_class=True,
+        )
+        return tuple(output[name] for name in self.output_names)
+
+
+def export(
+    model: nn.Module,
+    path: str,
+    format: str = "onnx",
+    opset_version: int = 18,
+    example_seq_len: int = 64,
+):
+    """
+    export exports the model to a self-contained inference artifact directory,
+    containing:
+
+    - the graph, as model.onnx (format="onnx") or model.pt2 (format="torch",
+      torch.export)
+    - meta.json, the genes, classes, label decoders and output names of the
+      model
+    - runner.py, a CPU runner that only depends on numpy and onnxruntime (or
+      torch for model.pt2), @see scprint.model.export_runner
+
+    The graph uses the pure pytorch attention path and has a dynamic minibatch
+    size and sequence length. It takes the gene ids (int64, (minibatch,
+    seq_len)), the expression (float32, (minibatch, seq_len)) and the total
+    count (float32, (minibatch,)) of the cells, as in
+    scPrint._predict(predict_mode="none"). The onnx export needs the onnx and
+    onnxscript packages, the torch export needs torch>=2.1.
+
+    Args:
+        model (scPrint): the model to export
+        path (str): the directory where to write the artifact
+        format (str, optional): one of "onnx" or "torch". Defaults to "onnx".
+        opset_version (int, optional): the onnx opset to use. Defaults to 18.
+        example_seq_len (int, optional): the sequence length of the example
+            inputs used for tracing. Defaults to 64.
+
+    Raises:
+        ValueError: if the format is unknown or if the model uses an attention
+            bias.
+    """
+    if format not in ["onnx", "torch"]:
+        raise ValueError(f"format should be one of onnx, torch, got {format}")
+    if model.attn_bias != "none":
+        raise ValueError(
+            "models using an attention bias (attn_bias) cannot be exported"
+        )
+    os.makedirs(path, exist_ok=True)
+    training, inference_mode = model.training, model.inference_mode
+    device, dtype = model.device, next(model.parameters()).dtype
+    model = model.to("cpu", torch.float32).eval()
+    model.inference_mode = False
+    graph = InferenceGraph(model)
+    gene_pos = torch.stack(
+        [torch.randperm(len(model.genes))[:example_seq_len] for _ in range(2)]
+    )
+    expression = torch.rand(gene_pos.shape) * 10
+    inputs = (gene_pos, expression, expression.sum(1))
+    try:
+        with non_triton_attention(model), torch.no_grad():
+            if format == "onnx":
+                torch.onnx.export(
+                    graph,
+                    inputs,
+                    os.path.join(path, "model.onnx"),
+                    input_names=["gene_pos", "expression", "depth"],
+                    output_names=graph.output_names,
+                    dynamic_axes={
+                        "gene_pos": {0: "batch", 1: "seq_len"},
+                        "expression": {0: "batch", 1: "seq_len"},
+                        "depth": {0: "batch"},
+                        **{
+                            name: (
+                                {0: "batch", 1: "seq_len"}
+                                if name in ["mean", "disp", "zero_logits"]
+                                else {0: "batch"}
+                            )
+                            for name in graph.output_names
+                        },
+                    },
+                    opset_version=opset_version,
+                )
+            else:
+                batch = torch.export.Dim("batch")
+                seq_len = torch.export.Dim("seq_len")
+                program = torch.export.export(
+                    graph,
+                    inputs,
+                    dynamic_shapes={
+                        "gene_pos": {0: batch, 1: seq_len},
+                        "expression": {0: batch, 1: seq_len},
+                        "depth": {0: batch},
+                    },
+                )
+                torch.export.save(program, os.path.join(path, "model.pt2"))
+    finally:
+        model.to(device, dtype).train(training)
+        model.inference_mode = inference_mode
+    with open(os.path.join(path, "meta.json"), "w") as f:
+        json.dump(
+            {
+                "format": format,
+                "genes": list(model.genes),
+                "classes": model.classes,
+                "label_decoders": model.label_decoders,
+                "output_names": graph.output_names,
+                "cell_embs_count": model.cell_embs_count,
+            },
+            f,
+        )
+    shutil.copy(
+        os.path.join(FILEDIR, "export_runner.py"),
+        os.path.join(path, "runner.py"),
+    )
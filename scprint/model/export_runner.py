@@ -0,0 +1,164 @@
+"""
+CPU runner for the inference artifacts written by
+scprint.model.export.export().
+
+This file is copied into each artifact as runner.py and does not depend on
+scprint: it only needs numpy and onnxruntime (model.onnx) or torch (model.pt2).
+
+usage: python runner.py <artifact dir>
+    <input.npz with gene_pos, expression[, depth]> <output.npz>
+"""
+
+import json
+import os
+import sys
+from typing import List, Optional
+
+import numpy as np
+
+
+class Runner:
+    def __init__(self, path: str, num_threads: Optional[int] = None):
+        """
+        Runner loads an exported scPrint artifact for inference on CPU
+
+        Args:
+            path (str): the artifact directory
+            num_threads (int, optional): the number of threads to use. Defaults
+                to None (all).
+        """
+        with open(os.path.join(path, "meta.json")) as f:
+            self.meta = json.load(f)
+        self.genes = self.meta["genes"]
+        self.classes = self.meta["classes"]
+        self.output_names = self.meta["output_names"]
+        if self.meta["format"] == "onnx":
+            import onnxruntime
+
+            options = onnxruntime.SessionOptions()
+            if num_threads is not None:
+                options.intra_op_num_threads = num_threads
+            self.session = onnxruntime.InferenceSession(
+                os.path.join(path, "model.onnx"),
+                options,
+                providers=["CPUExecutionProvider"],
+            )
+            self.module = None
+        else:
+            import torch
+
+            if num_threads is not None:
+                torch.set_num_threads(num_threads)
+            self.module = torch.export.load(
+                os.path.join(path, "model.pt2")
+            ).module()
+            self.session = None
+
+    def __call__(
+        self,
+        gene_pos: np.ndarray,
+        expression: np.ndarray,
+        depth: Optional[np.ndarray] = None,
+    ) -> dict:
+        """
+        Args:
+            gene_pos (np.ndarray): the gene ids (positions in self.genes) of
+                each cell (minibatch, seq_len)
+            expression (np.ndarray): the expression of these genes (minibatch,
+                seq_len)
+            depth (np.ndarray, optional): the total count of each cell
+                (minibatch,). Defaults to None (the sum of the expression).
+
+        Returns:
+            dict[str, np.ndarray]: the outputs of the model, keyed by
+            self.output_names
+        """
+        gene_pos = np.asarray(gene_pos, dtype=np.int64)
+        expression = np.asarray(expression, dtype=np.float32)
+        depth = (
+            expression.sum(1)
+            if depth is None
+            else np.asarray(depth, dtype=np.float32)
+        )
+        if self.session is not None:
+            outputs = self.session.run(
+                self.output_names,
+                {
+                    "gene_pos": gene_pos,
+                    "expression": expression,
+                    "depth": depth,
+                },
+            )
+        else:
+            import torch
+
+            with torch.inference_mode():
+                outputs = [
+                    i.numpy()
+                    for i in self.module(
+                        torch.from_numpy(gene_pos),
+                        torch.from_numpy(expression),
+                        torch.from_numpy(depth),
+                    )
+                ]
+        return dict(zip(self.output_names, outputs))
+
+    def predict(
+        self,
+        gene_pos: np.ndarray,
+        expression: np.ndarray,
+        depth: Optional[np.ndarray] = None,
+        pred_embedding: List[str] = [],
+    ) -> dict:
+        """
+        predict the same outputs as scPrint._predict(predict_mode="none",
+        keep_output=False)
+
+        Args:
+            @see self.__call__()
+            pred_embedding (List[str], optional): the classes whose embeddings
+                are averaged into the cell embedding. Defaults to [] (all).
+
+        Returns:
+            dict: embs (minibatch, d_model), class (minibatch, n_classes) or
+                None, pos, and expr ([mean, disp, zero_logits] or [mean])
+        """
+        output = self(gene_pos, expression, depth)
+        if len(pred_embedding) == 0:
+            pred_embedding = self.classes
+        ind = [self.classes.index(i) + 2 for i in pred_embedding]
+        return {
+            "embs": output["cell_embs"][:, ind, :].mean(1),
+            "class": (
+                np.stack(
+                    [
+                        output["cls_output_" + clsname].argmax(1)
+                        for clsname in self.classes
+                    ]
+                ).T
+                if len(self.classes) > 0
+                else None
+            ),
+            "pos": gene_pos,
+            "expr": (
+                [output["mean"], output["disp"], output["zero_logits"]]
+                if "disp" in output
+                else [output["mean"]]
+            ),
+        }
+
+
+if __name__ == "__main__":
+    if len(sys.argv) != 4:
+        print(__doc__)
+        sys.exit(1)
+    runner = Runner(sys.argv[1])
+    data = np.load(sys.argv[2])
+    np.savez(
+        sys.argv[3],
+        **runner(
+            data["gene_pos"],
+            data["expression"],
+            data["depth"] if "depth" in data else None,
+        ),
+    )
@@ -0,0 +1,303 @@
+import math
+from typing import Callable, Optional
+
+import torch
+import torch.nn.functional as F
+
+try:
+    from .flashattention import flash_attn_qkvpacked_func
+except ModuleNotFoundError:
+    flash_attn_qkvpacked_func = None
+
+# name -> (attention function, predicate: can the backend run these inputs)
+ATTENTION_BACKENDS = {}
+# the order in which the backends are tried by select_backend
+BACKEND_PRIORITY = ["triton", "sdpa", "einsum"]
+
+
+def register_backend(name: str, supports: Callable):
+    """
+    register_backend decorator adding an attention function to the backend
+    registry
+
+    The function is called as fn(qkv, bias, causal, softmax_scale,
+    key_padding_mask, dropout_p) with qkv of shape (B, S, 3, H, D) and returns
+    the attention output (B, S, H, D). supports is called as supports(qkv,
+    bias, key_padding_mask, dropout_p) and returns whether the backend can
+    compute the attention for these inputs.
+
+    Args:
+        name (str): the name of the backend
+        supports (Callable): the predicate
+    """
+
+    def decorator(fn):
+        ATTENTION_BACKENDS[name] = (fn, supports)
+        return fn
+
+    return decorator
+
+
+def _supports_triton(qkv, bias, key_padding_mask, dropout_p):
+    return (
+        flash_attn_qkvpacked_func is not None
+        and qkv.is_cuda
+        and qkv.dtype in [torch.float16, torch.bfloat16]
+        and qkv.shape[-1] <= 128
+        and key_padding_mask is None
+        and dropout_p == 0.0
+        # the kernel does not compute the gradient of the bias
+        and (bias is None or (bias.dim() == 4 and not bias.requires_grad))
+    )
+
+
+@register_backend("triton", _supports_triton)
+def triton_attention(
+    qkv,
+    bias=None,
+    causal=False,
+    softmax_scale=None,
+    key_padding_mask=None,
+    dropout_p=0.0,
+):
+    """the triton flash attention kernel (CUDA, fp16/bf16, no dropout)"""
+    return flash_attn_qkvpacked_func(qkv, bias, causal, softmax_scale)
+
+
+@register_backend(
+    "sdpa", lambda *args: hasattr(F, "scaled_dot_product_attention")
+)
+def sdpa_attention(
+    qkv,
+    bias=None,
+    causal=False,
+    softmax_scale=None,
+    key_padding_mask=None,
+    dropout_p=0.0,
+):
+    """
+    torch's scaled_dot_product_attention, dispatching to its flash / memory
+    efficient kernels (including on CPU) so that the (B, H, S, S) scores are
+    not materialized when possible
+    """
+    q, k, v = qkv.transpose(1, 3).unbind(dim=2)  # (B, H, S, D)
+    if softmax_scale is not None:
+        # sdpa scales by 1 / sqrt(D)
+        q = q * (softmax_scale * math.sqrt(q.shape[-1]))
+    mask = None
+    if bias is not None:
+        mask = bias.to(dtype=q.dtype)
+    if key_padding_mask is not None:
+        padding = torch.zeros(
+            key_padding_mask.shape, dtype=q.dtype, device=q.device
+        ).masked_fill_(~key_padding_mask, -10000.0)[:, None, None, :]
+        mask = padding if mask is None else mask + padding
+    if causal:
+        seqlen = q.shape[-2]
+        causal_mask = torch.triu(
+            torch.full((seqlen, seqlen), -10000.0, device=q.device), 1
+        ).to(dtype=q.dtype)
+        mask = causal_mask if mask is None else mask + causal_mask
+    out = F.scaled_dot_product_attention(
+        q, k, v, attn_mask=mask, dropout_p=dropout_p
+    )
+    return out.transpose(1, 2)
+
+
+@register_backend("einsum", lambda *args: True)
+def einsum_attention(
+    qkv,
+    bias=None,
+    causal=False,
+    softmax_scale=None,
+    key_padding_mask=None,
+    dropout_p=0.0,
+):
+    """the reference implementation, materializing the (B, H, S, S) scores"""
+    batch_size, seqlen = qkv.shape[0], qkv.shape[1]
+    q, k, v = qkv.unbind(dim=2)
+    softmax_scale = softmax_scale or 1.0 / math.sqrt(q.shape[-1])
+    scores = torch.einsum("bthd,bshd->bhts", q, k * softmax_scale)
+    if bias is not None:
+        scores = scores + bias.to(dtype=scores.dtype)
+    if key_padding_mask is not None:
+        padding_mask = torch.full(
+            (batch_size, seqlen),
+            -10000.0,
+            dtype=scores.dtype,
+            device=scores.device,
+        )
+        padding_mask.masked_fill_(key_padding_mask, 0.0)
+        # TD [2022-09-30]: Adding is faster than masked_fill_ (idk why, just
+        # better kernel I guess)
+        scores = scores + padding_mask[:, None, None, :]
+    if causal:
+        # "triu_tril_cuda_template" not implemented for 'BFloat16'
+        # So we have to construct the mask in float
+        causal_mask = torch.triu(
+            torch.full((seqlen, seqlen), -10000.0, device=scores.device), 1
+        )
+        scores = scores + causal_mask.to(dtype=scores.dtype)
+    attention = torch.softmax(scores, dim=-1, dtype=v.dtype)
+    if dropout_p > 0.0:
+        attention = F.dropout(attention, p=dropout_p)
+    return torch.einsum("bhts,bshd->bthd", attention, v)
+
+
+@register_backend("chunked", lambda *args: False)
+def chunked_attention(
+    qkv,
+    bias=None,
+    causal=False,
+    softmax_scale=None,
+    key_padding_mask=None,
+    dropout_p=0.0,
+    chunk_size=1024,
+):
+    """
+    chunked_attention computes the attention by tiles of chunk_size queries and
+    keys, with an online softmax over the key tiles, so that the peak memory is
+    O(B * H * chunk_size^2) instead of O(B * H * S^2). It is never selected
+    automatically (@see attention's chunk_size).
+
+    Args:
+        @see einsum_attention
+        chunk_size (int, optional): the tile size. Defaults to 1024.
+    """
+    batch_size, seqlen = qkv.shape[0], qkv.shape[1]
+    q, k, v = qkv.unbind(dim=2)
+    softmax_scale = softmax_scale or 1.0 / math.sqrt(q.shape[-1])
+    if key_padding_mask is not None:
+        padding_mask = torch.full(
+            (batch_size, seqlen), -10000.0, dtype=q.dtype, device=q.device
+        )
+        padding_mask.masked_fill_(key_padding_mask, 0.0)
+    output = torch.empty_like(q)
+    for qstart in range(0, seqlen, chunk_size):
+        qend = min(qstart + chunk_size, seqlen)
+        qchunk = q[:, qstart:qend] * softmax_scale
+        # running max, sum and weighted values of the softmax of each query
+        rowmax, rowsum, acc = None, None, None
+        for kstart in range(0, seqlen, chunk_size):
+            if causal and kstart >= qend:
+                # fully masked tile
+                break
+            kend = min(kstart + chunk_size, seqlen)
+            scores = torch.einsum(
+                "bthd,bshd->bhts", qchunk, k[:, kstart:kend]
+            ).float()
+            if bias is not None:
+                scores = scores + bias[..., qstart:qend, kstart:kend]
+            if key_padding_mask is not None:
+                scores = scores + padding_mask[:, None, None, kstart:kend]
+            if causal:
+                scores = scores + torch.triu(
+                    torch.full(
+                        (qend - qstart, kend - kstart),
+                        -10000.0,
+                        device=q.device,
+                    ),
+                    qstart - kstart + 1,
+                )
+            tilemax = scores.amax(dim=-1, keepdim=True)
+            newmax = (
+                tilemax if rowmax is None else torch.maximum(rowmax, tilemax)
+            )
+            probs = torch.exp(scores - newmax)
+            tilesum = probs.sum(dim=-1, keepdim=True)
+            if dropout_p > 0.0:
+                probs = F.dropout(probs, p=dropout_p)
+            tileacc = torch.einsum(
+                "bhts,bshd->bhtd", probs.to(v.dtype), v[:, kstart:kend]
+            )
+            if rowmax is None:
+                rowsum, acc = tilesum, tileacc.float()
+            else:
+                correction = torch.exp(rowmax - newmax)
+                rowsum = rowsum * correction + tilesum
+                acc = acc * correction + tileacc
+            rowmax = newmax
+        output[:, qstart:qend] = (acc / rowsum).transpose(1, 2).to(q.dtype)
+    return output
+
+
+def select_backend(
+    qkv: torch.Tensor,
+    bias: Optional[torch.Tensor] = None,
+    key_padding_mask: Optional[torch.Tensor] = None,
+    dropout_p: float = 0.0,
+) -> str:
+    """
+    select_backend the first backend of BACKEND_PRIORITY that supports the
+    inputs: the triton kernel on CUDA in fp16/bf16, else
+    scaled_dot_product_attention, else einsum.
+
+    Returning the qkv of a layer (return_qkv) does not constrain the choice,
+    as the qkv are projected before the attention.
+
+    Args:
+        qkv (Tensor): (B, S, 3, H, D)
+        bias (Tensor, optional): additive attention bias, broadcastable to (B,
+            H, S, S). Defaults to None.
+        key_padding_mask (Tensor, optional): (B, S), True for the tokens to
+            keep. Defaults to None.
+        dropout_p (float, optional): the attention dropout. Defaults to 0.0.
+
+    Returns:
+        str: the name of the backend
+    """
+    for name in BACKEND_PRIORITY:
+        if ATTENTION_BACKENDS[name][1](qkv, bias, key_padding_mask, dropout_p):
+            return name
+    raise ValueError("no attention backend supports these inputs")
+
+
+def attention(
+    qkv: torch.Tensor,
+    bias: Optional[torch.Tensor] = None,
+    causal: bool = False,
+    softmax_scale: Optional[float] = None,
+    key_padding_mask: Optional[torch.Tensor] = None,
+    dropout_p: float = 0.0,
+    backend: str = "auto",
+    chunk_size: Optional[int] = None,
+) -> torch.Tensor:
+    """
+    attention computes the multi-head softmax attention with the given backend
+
+    Args:
+        qkv (Tensor): (B, S, 3, H, D)
+        @see select_backend for the others
+        causal (bool, optional): whether to use causal attention. Defaults to
+            False.
+        softmax_scale (float, optional): the scaling of the scores. Defaults to
+            None (1 / sqrt(D)).
+        backend (str, optional): the name of a registered backend or "auto"
+            (@see select_backend). Defaults to "auto".
+        chunk_size (int, optional): if set, uses the chunked backend with tiles
+            of this size whatever the backend, for sequences longer than
+            chunk_size. Defaults to None.
+
+    Returns:
+        Tensor: (B, S, H, D)
+    """
+    if chunk_size is not None and qkv.shape[1] > chunk_size:
+        return chunked_attention(
+            qkv,
+            bias,
+            causal,
+            softmax_scale,
+            key_padding_mask,
+            dropout_p,
+            chunk_size=chunk_size,
+        )
+    if backend == "auto":
+        backend = select_backend(qkv, bias, key_padding_mask, dropout_p)
+    elif backend not in ATTENTION_BACKENDS:
+        raise ValueError(
+            f"Unknown attention backend: {backend}, "
+            f"should be one of {list(ATTENTION_BACKENDS)}"
+        )
+    return ATTENTION_BACKENDS[backend][0](
+        qkv, bias, causal, softmax_scale, key_padding_mask, dropout_p
+    )
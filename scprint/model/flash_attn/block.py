@@ -7,6 +7,7 @@ import torch
 import torch.nn as nn
 import torch.nn.functional as F
 from torch import Tensor
+from torch.utils.checkpoint import checkpoint
 from torchvision.ops import StochasticDepth
 
 from .mha import MHA
@@ -37,6 +38,7 @@ class Block(nn.Module):
         residual_in_fp32: bool = False,
         sequence_parallel: bool = False,
         mark_shared_params: bool = False,
+        checkpoint_mlp: bool = False,
     ):
         """
         For prenorm=True, this Block has a slightly different structure compared to a regular
@@ -73,12 +75,16 @@ class Block(nn.Module):
             sequence_parallel (bool, optional): whether to use sequence parallelism. Defaults to False.
             mark_shared_params (bool, optional): whether to mark the norm parameters as "shared_params".
                 This is useful when we want to sync the norm parameters across workers. Defaults to False.
+            checkpoint_mlp (bool, optional): whether to recompute the mlp
+                during the backward pass instead of storing its (4 x dim)
+                hidden activations. Defaults to False.
         """
         super().__init__()
         self.prenorm = prenorm
         self.fused_dropout_add_ln = fused_dropout_add_ln
         self.return_residual = return_residual
         self.residual_in_fp32 = residual_in_fp32
+        self.checkpoint_mlp = checkpoint_mlp
         if self.residual_in_fp32:
             assert self.prenorm, "residual_in_fp32 is only compatible with prenorm=True"
         if mixer_cls is None:
@@ -134,6 +140,15 @@ class Block(nn.Module):
             for p in self.norm2.parameters():
                 p._sequence_parallel = val
 
+    def register_qkv_hook(self, hook: Callable):
+        """@see MHA.register_qkv_hook"""
+        return self.mixer.register_qkv_hook(hook)
+
+    def _mlp(self, hidden_states: Tensor):
+        if self.checkpoint_mlp and torch.is_grad_enabled():
+            return checkpoint(self.mlp, hidden_states, use_reentrant=False)
+        return self.mlp(hidden_states)
+
     def forward(
         self,
         hidden_states: Tensor,
@@ -155,8 +170,9 @@ class Block(nn.Module):
             mixer_subset: This argument is used only for cross-attention.
                 If not None, a subset of the input sequence 'x' is taken before applying the query projection.
                 This is particularly useful for models like ViT where only the CLS token in the last layer is of interest.
-            mixer_kwargs: This argument is used only for cross-attention.
-                It is a dictionary of additional arguments to be passed to the mixer.
+            mixer_kwargs: It is a dictionary of additional arguments to be
+                passed to the mixer. e.g. cu_seqlens and max_seqlen for packed
+                sequences.
             return_qkv: If True, the function will return the query, key, and value tensors.
 
         Returns:
@@ -237,7 +253,7 @@ class Block(nn.Module):
                         residual_in_fp32=self.residual_in_fp32,
                         is_rms_norm=isinstance(self.norm2, RMSNorm),
                     )
-                hidden_states = self.mlp(hidden_states)
+                hidden_states = self._mlp(hidden_states)
             return (
                 (hidden_states, residual)
                 if not return_qkv
@@ -290,7 +306,7 @@ class Block(nn.Module):
                     is_rms_norm=isinstance(self.norm1, RMSNorm),
                 )
             if not isinstance(self.mlp, nn.Identity):
-                mlp_out = self.mlp(hidden_states)
+                mlp_out = self._mlp(hidden_states)
                 if self.return_residual:  # mlp out is actually a pair here
                     mlp_out, hidden_states = mlp_out
                 if not self.fused_dropout_add_ln:
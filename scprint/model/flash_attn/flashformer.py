@@ -1,9 +1,11 @@
 import torch
 from torch import nn, Tensor
 from torch.nn.init import trunc_normal_
+from torch.utils.checkpoint import checkpoint
 from torchvision.ops import StochasticDepth
 
-from typing import Optional, Callable
+from typing import Optional, Callable, List, Union
+from contextlib import nullcontext
 from functools import partial
 import sys
 import os
@@ -11,7 +13,8 @@ import os
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
 sys.path.append(os.path.dirname(SCRIPT_DIR))
 ########
-from . import MHA, Block, Mlp
+from . import MHA, Block, Mlp, SelfAttention
+from .mha import pack_index
 
 try:
     from .layer_norm import layer_norm_fn
@@ -49,7 +52,12 @@ class FlashTransformerEncoder(nn.Module):
         sequence_parallel: bool = False,
         drop_path_rate: float = 0.0,
         use_flash_attn: bool = True,
+        attn_backend: str = "auto",
+        attn_chunk_size: Optional[int] = None,
         weight_init: str = "",
+        checkpoint_layers: Optional[Union[str, List[int]]] = None,
+        checkpoint_mlp: bool = False,
+        offload_activations: bool = False,
     ):
         """
         FlashTransformerEncoder a transformer encoder with flash attention.
@@ -70,7 +78,24 @@ class FlashTransformerEncoder(nn.Module):
             fused_bias_fc (bool, optional): Whether to fuse bias and fully connected layers. Defaults to False.
             sequence_parallel (bool, optional): Whether to use sequence parallelism. Defaults to False.
             drop_path_rate (float, optional): The drop path rate. Defaults to 0.0.
+            use_flash_attn (bool, optional): Whether to use the triton flash
+                attention kernel. Defaults to True.
+            attn_backend (str, optional): The attention backend used otherwise
+                ("auto", "triton", "sdpa", "einsum" or "chunked"), @see
+                flash_attn.backends. Defaults to "auto".
+            attn_chunk_size (int, optional): If set, the attention is computed
+                by tiles of this many queries and keys with an online softmax,
+                for long sequences on CPU. Defaults to None.
             weight_init (str, optional): The weight initialization method. Defaults to "".
+            checkpoint_layers (str | List[int], optional): The blocks to
+                checkpoint entirely ("all" or a list of block indices): their
+                activations are recomputed during the backward pass. Defaults
+                to None.
+            checkpoint_mlp (bool, optional): Whether to checkpoint the MLP of
+                the other blocks. Defaults to False.
+            offload_activations (bool, optional): Whether to offload the
+                activations saved for the backward pass to pinned CPU memory
+                during training. Defaults to False.
 
         Raises:
             ImportError: Raised when Triton is not installed but fused_dropout_add_ln is set to True.
@@ -83,6 +108,18 @@ class FlashTransformerEncoder(nn.Module):
             x.item() for x in torch.linspace(0, drop_path_rate, nlayers)
         ]  # stochastic depth decay rule
 
+        if checkpoint_layers == "all":
+            checkpoint_layers = list(range(nlayers))
+        elif checkpoint_layers is None:
+            checkpoint_layers = []
+        elif isinstance(checkpoint_layers, str):
+            raise ValueError(
+                "checkpoint_layers should be 'all' or a list of layers, "
+                f"got {checkpoint_layers}"
+            )
+        self.checkpoint_layers = list(checkpoint_layers)
+        self.offload_activations = offload_activations
+
         for i in range(nlayers):
             mlp = create_mlp_cls(d_model, mlp_ratio, nn.GELU, fused_mlp)
             attention = partial(
@@ -91,6 +128,8 @@ class FlashTransformerEncoder(nn.Module):
                 dropout=dropout,
                 causal=False,
                 use_flash_attn=use_flash_attn,
+                attn_backend=attn_backend,
+                attn_chunk_size=attn_chunk_size,
                 num_heads_kv=num_heads_kv,
                 checkpointing=checkpointing,
                 fused_bias_fc=fused_bias_fc,
@@ -112,6 +151,8 @@ class FlashTransformerEncoder(nn.Module):
                 drop_path2=dpr[i],
                 fused_dropout_add_ln=fused_dropout_add_ln,
                 return_residual=return_residual,
+                checkpoint_mlp=checkpoint_mlp
+                and i not in self.checkpoint_layers,
             )
             self.blocks.append(encoder_layers)
 
@@ -131,6 +172,29 @@ class FlashTransformerEncoder(nn.Module):
 
         self.init_weights(weight_init)
 
+    def set_attn_chunk_size(self, chunk_size: Optional[int] = None):
+        """
+        set_attn_chunk_size changes the tile size of the chunked attention of
+        the blocks that do not use the triton kernel.
+
+        Args:
+            chunk_size (int, optional): the tile size. Defaults to None (not
+                chunked).
+        """
+        for block in self.blocks:
+            if isinstance(block.mixer.inner_attn, SelfAttention):
+                block.mixer.inner_attn.chunk_size = chunk_size
+
+    def get_attn_chunk_size(self) -> Optional[int]:
+        """
+        get_attn_chunk_size returns the tile size of the chunked attention set
+        by set_attn_chunk_size (None if not chunked).
+        """
+        for block in self.blocks:
+            if isinstance(block.mixer.inner_attn, SelfAttention):
+                return block.mixer.inner_attn.chunk_size
+        return None
+
     def init_weights(self, mode=""):
         assert mode == ""
         named_apply(_init_weights, self)
@@ -142,27 +206,74 @@ class FlashTransformerEncoder(nn.Module):
         return_qkv=[],
         bias: torch.Tensor = None,
         bias_layer=[],
+        cu_seqlens: Optional[Tensor] = None,
+        max_seqlen: Optional[int] = None,
     ) -> Tensor:
+        """
+        Args:
+            hidden_states (Tensor): the input sequences (batch, seqlen,
+                d_model), or (total, d_model) packed sequences if cu_seqlens is
+                given.
+            return_qkv (list, optional): the layers for which to also return
+                the qkv tensors. Defaults to [].
+            bias (Tensor, optional): an additive attention bias. Defaults to
+                None.
+            bias_layer (list, optional): the layers on which to apply the bias.
+                Defaults to [].
+            cu_seqlens (Tensor, optional): (batch + 1,) int32, the cumulative
+                lengths of the packed sequences, for padding-free attention.
+                Defaults to None.
+            max_seqlen (int, optional): the maximum sequence length when
+                packed. Defaults to None.
+        """
         residual = None
         qkvs = []
+        mixer_kwargs = None
+        if cu_seqlens is not None:
+            # the buckets of the attention are shared by all the layers
+            mixer_kwargs = {
+                "cu_seqlens": cu_seqlens,
+                "max_seqlen": max_seqlen,
+                "pack_index": pack_index(cu_seqlens),
+            }
         if bias is not None and bias.dim() == 2:
             bias = bias.unsqueeze(0).unsqueeze(0)
-        for i, block in enumerate(self.blocks):
-            hidden_states = block(
-                hidden_states,
-                residual,
-                return_qkv=(i in return_qkv),
-                bias=bias if i in bias_layer else None,
-            )
-            if i in return_qkv:
-                qkvs.append(hidden_states[-1])
-                hidden_states, residual = (
-                    hidden_states[:-1] if self.prenorm else hidden_states
-                )
-            else:
-                hidden_states, residual = (
-                    hidden_states if self.prenorm else hidden_states
-                )
+        elif bias is not None and bias.dim() == 3:
+            # (batch, seqlen, seqlen) -> (batch, 1, seqlen, seqlen), all heads
+            bias = bias.unsqueeze(1)
+        with (
+            torch.autograd.graph.save_on_cpu(pin_memory=hidden_states.is_cuda)
+            if self.offload_activations and torch.is_grad_enabled()
+            else nullcontext()
+        ):
+            for i, block in enumerate(self.blocks):
+                if i in self.checkpoint_layers and torch.is_grad_enabled():
+                    hidden_states = checkpoint(
+                        block,
+                        hidden_states,
+                        residual,
+                        use_reentrant=False,
+                        return_qkv=(i in return_qkv),
+                        bias=bias if i in bias_layer else None,
+                        mixer_kwargs=mixer_kwargs,
+                    )
+                else:
+                    hidden_states = block(
+                        hidden_states,
+                        residual,
+                        return_qkv=(i in return_qkv),
+                        bias=bias if i in bias_layer else None,
+                        mixer_kwargs=mixer_kwargs,
+                    )
+                if i in return_qkv:
+                    qkvs.append(hidden_states[-1])
+                    hidden_states, residual = (
+                        hidden_states[:-1] if self.prenorm else hidden_states
+                    )
+                else:
+                    hidden_states, residual = (
+                        hidden_states if self.prenorm else hidden_states
+                    )
         if self.prenorm:
             if not self.fused_dropout_add_ln:
                 residual = self.drop_path(self.dropout(hidden_states)) + residual
@@ -1,6 +1,7 @@
 # Copyright (c) 2023, Tri Dao.
 
 import math
+from collections import OrderedDict
 from functools import partial
 
 from typing import Optional, Any
@@ -8,6 +9,9 @@ from typing import Optional, Any
 import torch
 import torch.nn as nn
 from einops import rearrange, repeat
+from torch.utils.hooks import RemovableHandle
+
+from .backends import attention
 
 try:
     from .flashattention import (
@@ -30,6 +34,132 @@ FusedDense = None
 RotaryEmbedding = None
 
 
+def pack_index(cu_seqlens, min_fill=0.9):
+    """
+    pack_index groups packed sequences into buckets of similar lengths, each
+    padded only to its own longest sequence, so that the attention work
+    follows the length of each sequence instead of the longest one of the
+    batch. The sequences are taken from the longest and added to the current
+    bucket as long as at least min_fill of its attention work (sum of the
+    squared lengths over the number of sequences times the squared padded
+    length) is on real tokens. With min_fill=1, the buckets are sequences of
+    the same length and no work is done on padding.
+
+    The lengths are read on the host once, so the buckets are computed once
+    per forward pass and shared by the layers.
+
+    Args:
+        cu_seqlens: (batch_size + 1,), the cumulative sequence lengths.
+        min_fill: float. The minimum fraction of the attention work of a
+            bucket on real tokens. Defaults to 0.9.
+
+    Returns:
+        list of buckets (seqs, seqlen, tokens, index, key_padding_mask):
+            seqs: (n,) the sequences of the bucket.
+            seqlen: int. The length of its longest sequence.
+            tokens: the positions of their tokens in the packed stream.
+            index: the position of each of these tokens in the flattened
+                (n, seqlen) padded layout.
+            key_padding_mask: (n, seqlen) True for the real tokens, or None
+                if the sequences have the same length.
+    """
+    seqlens = cu_seqlens.diff()
+    lengths = seqlens.tolist()
+    buckets = []
+    for i in sorted(range(len(lengths)), key=lambda i: -lengths[i]):
+        if lengths[i] == 0:
+            break
+        if buckets:
+            seqs, work = buckets[-1]
+            longest = lengths[seqs[0]] ** 2 * (len(seqs) + 1)
+            if work + lengths[i] ** 2 >= min_fill * longest:
+                seqs.append(i)
+                buckets[-1][1] += lengths[i] ** 2
+                continue
+        buckets.append([[i], lengths[i] ** 2])
+    out = []
+    for seqs, _ in buckets:
+        seqlen = lengths[seqs[0]]
+        ntokens = sum(lengths[i] for i in seqs)
+        seqs = torch.tensor(seqs, device=cu_seqlens.device)
+        bucket_lens = seqlens[seqs]
+        row = torch.repeat_interleave(
+            torch.arange(len(seqs), device=cu_seqlens.device),
+            bucket_lens,
+            output_size=ntokens,
+        )
+        pos = torch.arange(ntokens, device=cu_seqlens.device) - (
+            bucket_lens.cumsum(0) - bucket_lens
+        )[row]
+        key_padding_mask = None
+        if ntokens < len(seqs) * seqlen:
+            key_padding_mask = (
+                torch.arange(seqlen, device=cu_seqlens.device)[None, :]
+                < bucket_lens[:, None]
+            )
+        out.append(
+            (
+                seqs,
+                seqlen,
+                cu_seqlens[seqs].long()[row] + pos,
+                row * seqlen + pos,
+                key_padding_mask,
+            )
+        )
+    return out
+
+
+def varlen_attention(
+    attn_fn, qkv, cu_seqlens, bias=None, index=None, **kwargs
+):
+    """
+    Block diagonal attention over packed sequences: the sequences are grouped
+    in buckets of similar lengths (@see pack_index), and each bucket is
+    attended in a single call, padded to its own longest sequence.
+
+    Args:
+        attn_fn: the attention function, taking a (B, S, 3, H, D) qkv, a bias
+            and a key_padding_mask.
+        qkv: the packed query, key and value (total, 3, H, D).
+        cu_seqlens: (batch_size + 1,), the cumulative sequence lengths of the
+            sequences in qkv.
+        bias: optional, (batch_size or 1, 1 or H, S, S) with S >= the length
+            of the longest sequence, the sequences being prefixes of the rows
+            and columns.
+        index: optional, the output of pack_index, computed if not given.
+
+    Returns:
+        out: (total, H, D)
+    """
+    if index is None:
+        index = pack_index(cu_seqlens)
+    out = None
+    for seqs, seqlen, tokens, pos, key_padding_mask in index:
+        if key_padding_mask is None:
+            padded = qkv[tokens]
+        else:
+            padded = qkv.new_zeros((len(seqs) * seqlen,) + qkv.shape[1:])
+            padded[pos] = qkv[tokens]
+        bucket_bias = None
+        if bias is not None:
+            bucket_bias = bias if bias.shape[0] == 1 else bias[seqs]
+            bucket_bias = bucket_bias[..., :seqlen, :seqlen]
+        res = attn_fn(
+            padded.view(len(seqs), seqlen, *qkv.shape[1:]),
+            bias=bucket_bias,
+            key_padding_mask=key_padding_mask,
+            **kwargs,
+        )
+        res = res.reshape(len(seqs) * seqlen, *res.shape[2:])
+        if out is None:
+            out = res.new_zeros((qkv.shape[0],) + res.shape[1:])
+        out[tokens] = res if key_padding_mask is None else res[pos]
+    if out is None:
+        # only empty sequences
+        out = qkv.new_zeros((qkv.shape[0],) + qkv.shape[2:])
+    return out
+
+
 class FlashSelfAttention(nn.Module):
     def __init__(
         self,
@@ -64,6 +194,8 @@ class FlashSelfAttention(nn.Module):
         cu_seqlens_k: Optional[torch.Tensor] = None,
         max_seqlen_k: Optional[int] = None,
         bias: Optional[torch.Tensor] = None,
+        pack_index: Optional[tuple] = None,
+        key_padding_mask: Optional[torch.Tensor] = None,
         **kwargs,
     ):
         """Implements the multihead softmax attention.
@@ -77,6 +209,10 @@ class FlashSelfAttention(nn.Module):
             cu_seqlens (batch_size + 1,), dtype torch.int32. The cumulative sequence lengths
                 of the sequences in the batch, used to index into qkv.
             max_seqlen (int). Maximum sequence length in the batch.
+            pack_index (tuple, optional): @see pack_index, computed if not
+                given.
+            key_padding_mask (Tensor, optional): (B, S) True for the tokens
+                to keep, applied as an additive bias.
         Returns:
             out: (total, H, D) if cu_seqlens is not None and max_seqlen is not None,
                 else (B, S, H, D).
@@ -84,6 +220,21 @@ class FlashSelfAttention(nn.Module):
         assert qkv.dtype in [torch.float16, torch.bfloat16]
         assert qkv.is_cuda
         causal = self.causal if causal is None else causal
+        if cu_seqlens is not None:
+            # the triton kernel does not handle ragged batches
+            return varlen_attention(
+                self.forward,
+                qkv,
+                cu_seqlens,
+                bias,
+                index=pack_index,
+                causal=causal,
+            )
+        if key_padding_mask is not None:
+            padding = torch.zeros(
+                key_padding_mask.shape, dtype=qkv.dtype, device=qkv.device
+            ).masked_fill_(~key_padding_mask, -10000.0)[:, None, None, :]
+            bias = padding if bias is None else bias + padding
         return flash_attn_qkvpacked_func(
             qkv,
             bias,
@@ -172,48 +323,75 @@ class SelfAttention(nn.Module):
             runtime)
         attention_dropout: The dropout rate to apply to the attention
             (default: 0.0)
+        backend: The attention backend to use, one of the backends registered
+            in flash_attn.backends or "auto" to select it from the inputs
+            (default: "auto")
+        chunk_size: If set, the attention of sequences longer than chunk_size
+            is computed by tiles of chunk_size queries and keys, in O(seqlen *
+            chunk_size) memory (default: None)
     """
 
-    def __init__(self, causal=False, softmax_scale=None, attention_dropout=0.0):
+    def __init__(
+        self,
+        causal=False,
+        softmax_scale=None,
+        attention_dropout=0.0,
+        backend="auto",
+        chunk_size=None,
+    ):
         super().__init__()
         self.causal = causal
         self.softmax_scale = softmax_scale
         self.drop = nn.Dropout(attention_dropout)
+        self.backend = backend
+        self.chunk_size = chunk_size
 
-    def forward(self, qkv, causal=None, key_padding_mask=None, bias=None):
+    def forward(
+        self,
+        qkv,
+        causal=None,
+        key_padding_mask=None,
+        bias=None,
+        cu_seqlens=None,
+        max_seqlen=None,
+        pack_index=None,
+    ):
         """
         Implements the multihead softmax attention.
 
         Args:
             qkv: The tensor containing the query, key, and value. (B, S, 3, H, D)
+                or (total, 3, H, D) if cu_seqlens is given.
             causal: if passed, will override self.causal
             key_padding_mask: boolean mask to apply to the attention weights. True means to keep,
                 False means to mask out. (B, S)
+            bias: additive attention bias, broadcastable to (B, H, S, S)
+            cu_seqlens: (B + 1,), the cumulative sequence lengths of the packed
+                sequences in qkv. The attention is then block diagonal.
+            max_seqlen: int. Maximum sequence length in the batch.
+            pack_index: @see pack_index, computed if not given.
         """
-        batch_size, seqlen = qkv.shape[0], qkv.shape[1]
         causal = self.causal if causal is None else causal
-        q, k, v = qkv.unbind(dim=2)
-        softmax_scale = self.softmax_scale or 1.0 / math.sqrt(q.shape[-1])
-        scores = torch.einsum("bthd,bshd->bhts", q, k * softmax_scale)
-        if key_padding_mask is not None:
-            padding_mask = torch.full(
-                (batch_size, seqlen), -10000.0, dtype=scores.dtype, device=scores.device
-            )
-            padding_mask.masked_fill_(key_padding_mask, 0.0)
-            # TD [2022-09-30]: Adding is faster than masked_fill_ (idk why, just better kernel I guess)
-            scores = scores + rearrange(padding_mask, "b s -> b 1 1 s")
-        if causal:
-            # "triu_tril_cuda_template" not implemented for 'BFloat16'
-            # So we have to construct the mask in float
-            causal_mask = torch.triu(
-                torch.full((seqlen, seqlen), -10000.0, device=scores.device), 1
+        if cu_seqlens is not None:
+            assert key_padding_mask is None
+            return varlen_attention(
+                self.forward,
+                qkv,
+                cu_seqlens,
+                bias,
+                index=pack_index,
+                causal=causal,
             )
-            # TD [2022-09-30]: Adding is faster than masked_fill_ (idk why, just better kernel I guess)
-            scores = scores + causal_mask.to(dtype=scores.dtype)
-        attention = torch.softmax(scores, dim=-1, dtype=v.dtype)
-        attention_drop = self.drop(attention)
-        output = torch.einsum("bhts,bshd->bthd", attention_drop, v)
-        return output
+        return attention(
+            qkv,
+            bias=bias,
+            causal=causal,
+            softmax_scale=self.softmax_scale,
+            key_padding_mask=key_padding_mask,
+            dropout_p=self.drop.p if self.training else 0.0,
+            backend=self.backend,
+            chunk_size=self.chunk_size,
+        )
 
 
 class CrossAttention(nn.Module):
@@ -340,6 +518,8 @@ class MHA(nn.Module):
         use_flash_attn: bool = False,
         return_residual: bool = False,
         checkpointing: bool = False,
+        attn_backend: str = "auto",
+        attn_chunk_size: Optional[int] = None,
         device: Optional[torch.device] = None,
         dtype: Optional[torch.dtype] = None,
     ) -> None:
@@ -366,6 +546,11 @@ class MHA(nn.Module):
             dwconv (bool, optional): whether to use depthwise convolution. Defaults to False.
             fused_bias_fc (bool, optional): whether to use fused_bias_fc. Defaults to False.
             use_flash_attn (bool, optional): whether to use FlashAttention. Defaults to False.
+            attn_backend (str, optional): the attention backend when not using
+                FlashAttention, @see flash_attn.backends. Defaults to "auto".
+            attn_chunk_size (int, optional): the tile size of the chunked
+                attention when not using FlashAttention, @see SelfAttention.
+                Defaults to None (not chunked).
             device (torch.device, optional): device. Defaults to None.
             dtype (torch.dtype, optional): dtype. Defaults to None.
         """
@@ -423,7 +608,9 @@ class MHA(nn.Module):
         inner_attn_cls = (
             partial(FlashSelfAttention, alibi_slopes=alibi_slopes)
             if use_flash_attn
-            else SelfAttention
+            else partial(
+                SelfAttention, backend=attn_backend, chunk_size=attn_chunk_size
+            )
         )
         inner_cross_attn_cls = (
             partial(FlashCrossAttention, alibi_slopes=alibi_slopes)
@@ -462,6 +649,29 @@ class MHA(nn.Module):
         self.out_proj = linear_cls(
             embed_dim, embed_dim, bias=out_proj_bias, **factory_kwargs
         )
+        self._qkv_hooks = OrderedDict()
+
+    def register_qkv_hook(self, hook) -> RemovableHandle:
+        """
+        register_qkv_hook registers a hook called as hook(module, qkv) with the
+        qkv tensor of each forward pass, (batch, seqlen, 3, nheads, head_dim),
+        once the attention is computed.
+
+        The hook should reduce qkv right away (e.g. accumulate statistics) and
+        not keep it, so that nothing is retained past the layer. It is only
+        called for self-attention (not cross-attention or grouped-query
+        attention) and is called again when the layer is recomputed by
+        checkpointing.
+
+        Args:
+            hook (Callable): the hook
+
+        Returns:
+            RemovableHandle: a handle whose remove() method removes the hook
+        """
+        handle = RemovableHandle(self._qkv_hooks)
+        self._qkv_hooks[handle.id] = hook
+        return handle
 
     def allocate_inference_cache(self, batch_size, max_seqlen, dtype=None):
         dtype = self.out_proj.weight.dtype if dtype is None else dtype
@@ -567,6 +777,7 @@ class MHA(nn.Module):
         key_padding_mask: Optional[torch.Tensor] = None,
         cu_seqlens: Optional[torch.Tensor] = None,
         max_seqlen: Optional[int] = None,
+        pack_index: Optional[tuple] = None,
         mixer_subset: Optional[torch.Tensor] = None,
         inference_params: Optional[dict] = None,
         return_qkv: bool = False,
@@ -579,9 +790,9 @@ class MHA(nn.Module):
                 is the is the sum of the sequence lengths in the batch.
             x_kv: (batch, seqlen, hidden_dim), only applicable for cross-attention. If None, use x.
             cu_seqlens: (batch_size + 1,), dtype torch.int32. The cumulative sequence lengths
-                of the sequences in the batch, used to index into x. Only applicable when using
-                FlashAttention.
+                of the sequences in the batch, used to index into x.
             max_seqlen: int. Maximum sequence length in the batch.
+            pack_index: @see pack_index, computed if not given.
             key_padding_mask: boolean mask, True means to keep, False means to mask out.
                 (batch, seqlen). Only applicable when not using FlashAttention.
             mixer_subset: for cross-attention only. If not None, will take a subset of x
@@ -600,7 +811,7 @@ class MHA(nn.Module):
         if cu_seqlens is not None:
             assert max_seqlen is not None
             assert key_padding_mask is None
-            assert self.use_flash_attn
+            assert not self.cross_attn and self.num_heads_kv == self.num_heads
             assert not self.dwconv
             assert self.rotary_emb_dim == 0
         if key_padding_mask is not None:
@@ -613,10 +824,18 @@ class MHA(nn.Module):
             assert not self.dwconv
 
         kwargs = (
-            {}  # "cu_seqlens": cu_seqlens, "max_seqlen": max_seqlen, **kwargs}
+            {"bias": kwargs.get("bias", None)}
             if self.use_flash_attn
             else {"key_padding_mask": key_padding_mask, **kwargs}
         )
+        if cu_seqlens is not None:
+            kwargs.update(
+                {
+                    "cu_seqlens": cu_seqlens,
+                    "max_seqlen": max_seqlen,
+                    "pack_index": pack_index,
+                }
+            )
         seqlen_offset = (
             0
             if inference_params is None
@@ -669,6 +888,8 @@ class MHA(nn.Module):
                 context = self._apply_rotary_update_kvcache_attention(
                     qkv[:, :, 0], qkv[:, :, 1:], inference_params
                 )
+            for hook in self._qkv_hooks.values():
+                hook(self, qkv)
         else:
             if self.cross_attn:
                 if not self.return_residual:
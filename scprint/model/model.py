@@ -11,12 +11,12 @@ import lightning as L
 import os
 import numpy as np
 import copy
-from scipy.sparse import load_npz
 from huggingface_hub import PyTorchModelHubMixin
 import pandas as pd
 from functools import partial
 
 from .flash_attn import FlashTransformerEncoder
+from .attn_bias import SparseGeneBias
 from . import encoders
 from . import decoders
 
@@ -27,6 +27,8 @@ from . import utils
 from .loss import grad_reverse
 
 FILEDIR = os.path.dirname(os.path.realpath(__file__))
+# the outputs that can be requested from scPrint.forward()
+OUTPUTS = {"expr", "cell_embs", "cell_emb", "cls", "mvc", "gene_embedding"}
 
 
 def is_interactive():
@@ -119,6 +121,7 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
         self.mean_attn_tot_c = 0
         self.do_adv_batch = False
         self.run_full_forward = True
+        self.fused_views = False
         self.class_scale = 0.4
         self.do_next_tp = False
         self.do_generate = False
@@ -141,6 +144,7 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
         self.predict_depth_mult = 3
         self.predict_mode = "none"
         self.keep_all_cls_pred = False
+        self.inference_mode = False
         # should be stored somehow
         self.d_model = d_model
         self.normalization = normalization
@@ -232,6 +236,13 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
         self.class_encoder = encoders.CategoryValueEncoder(
             self.cell_embs_count - 1, d_model
         )
+        self.register_buffer(
+            "cls_token_ids",
+            torch.arange(self.cell_embs_count - 1),
+            persistent=False,
+        )
+        # at inference, the class tokens are constant and computed once
+        self.register_buffer("cls_token_embs", None, persistent=False)
         # self.time_encoder = encoders.ContinuousValueEncoder(d_model, dropout)
         self.depth_encoder = encoders.ContinuousValueEncoder(
             d_model, dropout, layers=expr_encoder_layers
@@ -326,6 +337,7 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
             for k2, v2 in v.items():
                 tens[k2 - classes[k], v2] = 1
             self.mat_labels_hierarchy[k] = tens.to(bool)
+        self.cls_token_embs = None
 
         mencoders = {}
         try:
@@ -358,41 +370,38 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
         full_depth: Optional[Tensor] = None,
         timepoint: Optional[Tensor] = None,
         cell_embs: Optional[Tensor] = None,  # (minibatch, n_labels, embsize)
+        keep_gene_embs: bool = True,
+        gene_encoding: Optional[Tensor] = None,
     ):
         """
         _encode given inputs to the model encode into embeddings.
 
         Args:
             @see self.forward()
+            keep_gene_embs (bool, optional): whether to keep a copy of the gene
+                token embeddings in self.cur_gene_token_embs (only needed by
+                the mvc decoder). Defaults to True.
+            gene_encoding (Tensor, optional): the gene token encoding
+                (minibatch, seq_len, embsize) of a previous call with the same
+                gene_pos, expression and mask, to reuse instead of recomputing
+                it. Defaults to None.
 
         Returns:
             Tensor: the encoded data
         """
-        enc = self.gene_encoder(gene_pos)  # (minibatch, seq_len, embsize)
-        self.cur_gene_token_embs = enc.clone()
-
-        if expression is not None:
-            if self.normalization == "sum":
-                enc += self.expr_encoder(
-                    (expression / expression.sum(1).unsqueeze(1)), mask
-                )  # (minibatch, seq_len, embsize)
-            elif self.normalization == "log":
-                enc += self.expr_encoder(
-                    torch.log2(1 + expression), mask
-                )  # (minibatch, seq_len, embsize)
-            else:
-                raise ValueError(f"Unknown normalization: {self.normalization}")
+        if gene_encoding is None:
+            enc = self.gene_encoder(gene_pos)  # (minibatch, seq_len, embsize)
+            self.cur_gene_token_embs = enc.clone() if keep_gene_embs else None
 
-        if self.gene_pos_enc:
-            enc += self.pos_encoder(gene_pos)
+            if expression is not None:
+                enc += self._encode_expression(expression, mask)
+
+            if self.gene_pos_enc:
+                enc += self.pos_encoder(gene_pos)
+        else:
+            enc = gene_encoding
         cell_embs = (
-            self.class_encoder(
-                torch.Tensor(
-                    [list(range(self.cell_embs_count - 1))] * gene_pos.shape[0]
-                )
-                .int()
-                .to(gene_pos.device)
-            )
+            self._class_tokens(gene_pos.shape[0], gene_pos.device)
             if cell_embs is None
             else cell_embs
         )  # (minibatch, embsize)
@@ -410,6 +419,46 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
         enc = torch.cat([cell_embs, enc], dim=1)
         return enc  # self.norm_and_dropout(enc) # we already apply prenorm & dropout  # (minibatch, seq_len, embsize)
 
+    def _encode_expression(
+        self, expression: Tensor, mask: Optional[Tensor] = None
+    ):
+        """
+        _encode_expression normalizes and encodes the expression values
+
+        Args:
+            @see self.forward()
+
+        Returns:
+            Tensor: the expression encoding (minibatch, seq_len, embsize)
+        """
+        if self.normalization == "sum":
+            return self.expr_encoder(
+                (expression / expression.sum(1).unsqueeze(1)), mask
+            )  # (minibatch, seq_len, embsize)
+        elif self.normalization == "log":
+            return self.expr_encoder(
+                torch.log2(1 + expression), mask
+            )  # (minibatch, seq_len, embsize)
+        else:
+            raise ValueError(f"Unknown normalization: {self.normalization}")
+
+    def _class_tokens(self, batch_size: int, device: torch.device):
+        """
+        _class_tokens the learnt cell embedding tokens (all but the depth one)
+
+        Returns:
+            Tensor: the class tokens (minibatch, cell_embs_count - 1, embsize)
+        """
+        if self.inference_mode and not self.training:
+            if self.cls_token_embs is None:
+                self.cls_token_embs = self.class_encoder(
+                    self.cls_token_ids
+                ).detach()
+            cls_embs = self.cls_token_embs
+        else:
+            cls_embs = self.class_encoder(self.cls_token_ids)
+        return cls_embs.to(device).unsqueeze(0).expand(batch_size, -1, -1)
+
     def _decoder(
         self,
         transformer_output,
@@ -418,24 +467,35 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
         do_sample=False,
         do_mvc=False,
         do_class=False,
+        gene_mask=None,
+        outputs=None,
     ):
         """
         _decoder given the transformer output, decode into the final output.
 
         Args:
             @see self.forward()
+            gene_mask (Tensor, optional): (minibatch, seq_len) True for the
+                real gene tokens, False for padding. Defaults to None.
 
         Returns:
             dict: the output of the model
         """
-        output = self.expr_decoder(transformer_output)
-
-        output["mean"] = depth_mult.unsqueeze(1) * output["mean"]
+        if outputs is not None:
+            do_class, do_mvc, get_gene_emb = (
+                "cls" in outputs,
+                "mvc" in outputs,
+                "gene_embedding" in outputs,
+            )
+        output = {}
+        if outputs is None or "expr" in outputs:
+            output = self.expr_decoder(transformer_output, gene_mask)
+            output["mean"] = depth_mult.unsqueeze(1) * output["mean"]
         if do_sample:
             pass
 
         output["cell_embs"] = self.get_cell_embs(transformer_output)
-        output["cell_emb"] = torch.mean(output["cell_embs"].clone(), dim=1)
+        output["cell_emb"] = torch.mean(output["cell_embs"], dim=1)
         if len(self.classes) > 0 and do_class:
             output.update(
                 {
@@ -475,6 +535,8 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
         do_mvc: bool = False,
         do_class: bool = False,
         get_attention_layer: list = [],
+        lengths: Optional[Tensor] = None,
+        outputs: Optional[set] = None,
     ):
         """
         forward also called on self(), a full forward pass on the model
@@ -496,6 +558,22 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
                 If True, the expression levels are sampled during the forward pass. Defaults to False.
             get_attention_layer (list, optional): A list indicating which attention layers to return.
                 If not empty, the specified attention layers are included in the output. Defaults to [].
+            lengths (Tensor, optional): A tensor of shape (minibatch,) giving
+                the number of real genes of each cell, the rest of its sequence
+                being padding. If given, the cells are packed into a single
+                flat token stream without padding (using cu_seqlens), so that
+                the cost of the transformer and of the expression decoder
+                scales with the real length of each cell. Padded genes get a
+                null mean expression. Defaults to None.
+            outputs (set[str], optional): the outputs to compute, among "expr"
+                (mean, disp and zero_logits), "cell_embs", "cell_emb", "cls"
+                (the cls_output_*), "mvc" and "gene_embedding". The decoders of
+                the outputs that are not requested are not run and, when no
+                output needs the gene tokens, only the cell embedding tokens of
+                the last layer are kept. If given, it takes precedence over
+                do_class, do_mvc and get_gene_emb. cell_embs and cell_emb are
+                always returned. Defaults to None (the expression, the cell
+                embeddings and the outputs asked by the flags).
 
         Returns:
             dict of output Tensors: A dictionary containing the output tensors from the forward pass.
@@ -508,55 +586,239 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
                 - "cell_emb": the main cell embedding
                 - "cls_output": the output of the classifier
         """
-        encoding = self._encoder(gene_pos, expression, mask, full_depth, timepoint)
-
-        if self.attn_bias != "none":
-            if not hasattr(self, "nbias"):
-                self.nbias = torch.Tensor(
-                    load_npz(FILEDIR + "/../../data/bias_sparse.npz").todense()
-                ).to(device=gene_pos.device, dtype=torch.float16)
-            num = len(self.classes) + 2
-            bias = torch.zeros(
-                (
-                    gene_pos.shape[0],
-                    gene_pos.shape[1] + num,
-                    gene_pos.shape[1] + num,
-                ),
-                device=gene_pos.device,
-                dtype=torch.float16,
+        if outputs is not None:
+            outputs = set(outputs)
+            if not outputs <= OUTPUTS:
+                raise ValueError(
+                    f"Unknown outputs: {sorted(outputs - OUTPUTS)}, "
+                    f"should be among {sorted(OUTPUTS)}"
+                )
+            do_class, do_mvc, get_gene_emb = (
+                "cls" in outputs,
+                "mvc" in outputs,
+                "gene_embedding" in outputs,
             )
-            bias[:, num:, :num] = -10_000  # do not pay attention to the cls embeddings
-            bias[:, num:, num:] = self.nbias[gene_pos[:, :, None], gene_pos[:, None, :]]
-        transformer_output = self.transformer(
-            encoding,
-            return_qkv=get_attention_layer,
-            bias=bias if self.attn_bias != "none" else None,
-            bias_layer=list(range(self.nlayers - 1)),
+        encoding = self._encoder(
+            gene_pos,
+            expression,
+            mask,
+            full_depth,
+            timepoint,
+            keep_gene_embs=do_mvc,
         )
 
+        gene_mask = None
+        if lengths is not None:
+            if len(get_attention_layer) > 0:
+                raise NotImplementedError(
+                    "get_attention_layer is not available with packed "
+                    "sequences"
+                )
+            num = encoding.shape[1] - gene_pos.shape[1]
+            seqlens = lengths.to(torch.int32) + num
+            keep = (
+                torch.arange(encoding.shape[1], device=encoding.device)[
+                    None, :
+                ]
+                < seqlens[:, None]
+            )
+            gene_mask = keep[:, num:]
+            packed = self.transformer(
+                encoding[keep],  # (total, embsize)
+                bias=self._get_bias(gene_pos),
+                bias_layer=list(range(self.nlayers - 1)),
+                cu_seqlens=torch.nn.functional.pad(
+                    torch.cumsum(seqlens, 0, dtype=torch.int32), (1, 0)
+                ),
+                max_seqlen=int(seqlens.max()),
+            )
+            transformer_output = packed.new_zeros(
+                encoding.shape[:2] + packed.shape[-1:]
+            )
+            transformer_output[keep] = packed
+        else:
+            transformer_output = self.transformer(
+                encoding,
+                return_qkv=get_attention_layer,
+                bias=self._get_bias(gene_pos),
+                bias_layer=list(range(self.nlayers - 1)),
+            )
+
         depth_mult = expression.sum(1) if depth_mult is None else depth_mult
         if len(get_attention_layer) > 0:
             transformer_output, qkvs = transformer_output
-            return (
-                self._decoder(
-                    transformer_output,
-                    depth_mult,
-                    get_gene_emb,
-                    do_sample,
-                    do_mvc,
-                    do_class,
-                ),
-                qkvs,
+        if (
+            outputs is not None
+            and not outputs & {"expr", "gene_embedding"}
+            and self.cell_emb_style == "cls"
+        ):
+            # only the cell embedding tokens are used, gene tokens are freed
+            transformer_output = transformer_output[
+                :, : self.cell_embs_count
+            ].clone()
+            gene_mask = None
+        output = self._decoder(
+            transformer_output,
+            depth_mult,
+            get_gene_emb,
+            do_sample,
+            do_mvc,
+            do_class,
+            gene_mask,
+            outputs,
+        )
+        return (output, qkvs) if len(get_attention_layer) > 0 else output
+
+    def infer(
+        self, gene_pos: Tensor, expression: Optional[Tensor] = None, **kwargs
+    ):
+        """
+        infer an inference-only forward pass.
+
+        Runs self.forward() under torch.inference_mode() with
+        self.inference_mode set, so that no autograd state is recorded, the
+        gene token embeddings are not copied unless the mvc decoder is used and
+        the class tokens are computed only once. Under autocast,
+        torch.no_grad() is used instead, as autocast does not cache the low
+        precision copies of the weights in inference mode. The model is
+        expected to be in eval mode.
+
+        Args:
+            @see self.forward()
+
+        Returns:
+            @see self.forward()
+        """
+        prev_mode = self.inference_mode
+        self.inference_mode = True
+        try:
+            with (
+                torch.no_grad()
+                if torch.is_autocast_enabled()
+                or torch.is_autocast_cpu_enabled()
+                else torch.inference_mode()
+            ):
+                return self.forward(gene_pos, expression, **kwargs)
+        finally:
+            self.inference_mode = prev_mode
+
+    def _get_bias(self, gene_pos: Tensor):
+        """
+        _get_bias the gene-gene attention bias of the minibatch if attn_bias is
+        used
+
+        Returns:
+            Tensor: the bias (minibatch or 1, 1, seq_len, seq_len) or None
+        """
+        if self.attn_bias == "none":
+            return None
+        if not hasattr(self, "nbias"):
+            # the prior stays sparse, only the minibatch's genes are densified
+            self.nbias = SparseGeneBias(
+                FILEDIR + "/../../data/bias_sparse.npz",
+                num_special_tokens=len(self.classes) + 2,
+            )
+        return self.nbias(gene_pos)
+
+    def _multiview_forward(
+        self,
+        gene_pos: Tensor,
+        expressions: list[Tensor],
+        masks: list[Optional[Tensor]],
+        full_depth: Tensor,
+        depth_mult: Tensor,
+        do_mvc: bool = False,
+        do_class: bool = False,
+    ):
+        """
+        _multiview_forward runs several views of the same cells (masked,
+        downsampled...) in a single transformer call by stacking them along the
+        batch dimension.
+
+        The gene token encodings and the cell embedding tokens are computed
+        once and shared across views. As in _full_training, the mvc and class
+        decoders are only applied to the first view.
+
+        Args:
+            gene_pos (Tensor): the genes used for each cell (minibatch,
+                seq_len)
+            expressions (list[Tensor]): the input expression of each view
+                (minibatch, seq_len)
+            masks (list[Tensor]): the mask of each view, or None (minibatch,
+                seq_len)
+            full_depth (Tensor): the full depth of each cell (minibatch,)
+            depth_mult (Tensor): the depth multiplier of the expression decoder
+                (minibatch,)
+            @see self.forward() for the others
+
+        Returns:
+            list[dict]: the output of each view, as given by self.forward()
+        """
+        n_views = len(expressions)
+        batch_size = gene_pos.shape[0]
+        enc = self.gene_encoder(gene_pos)  # (minibatch, seq_len, embsize)
+        self.cur_gene_token_embs = enc
+        if self.gene_pos_enc:
+            enc = enc + self.pos_encoder(gene_pos)
+        if any(m is not None for m in masks):
+            mask = torch.cat(
+                [
+                    (
+                        m
+                        if m is not None
+                        else torch.zeros_like(gene_pos, dtype=torch.bool)
+                    )
+                    for m in masks
+                ]
             )
         else:
-            return self._decoder(
-                transformer_output,
-                depth_mult,
-                get_gene_emb,
-                do_sample,
-                do_mvc,
-                do_class,
+            mask = None
+        enc = enc.repeat(n_views, 1, 1) + self._encode_expression(
+            torch.cat(expressions), mask
+        )  # (views * minibatch, seq_len, embsize)
+        cell_embs = self._class_tokens(batch_size, gene_pos.device)
+        depth_encoded = self.depth_encoder(
+            torch.log2(1 + full_depth)
+        ).unsqueeze(1)
+        cell_embs = torch.cat(
+            (cell_embs[:, :1, :], depth_encoded, cell_embs[:, 1:, :]), dim=1
+        )
+        enc = torch.cat([cell_embs.repeat(n_views, 1, 1), enc], dim=1)
+
+        bias = self._get_bias(gene_pos)
+        if bias is not None and bias.shape[0] > 1:
+            bias = bias.repeat(n_views, 1, 1, 1)
+        transformer_output = self.transformer(
+            enc, bias=bias, bias_layer=list(range(self.nlayers - 1))
+        )
+        output = self._decoder(transformer_output, depth_mult.repeat(n_views))
+        outputs = [
+            {
+                k: v[i * batch_size : (i + 1) * batch_size]
+                for k, v in output.items()
+            }
+            for i in range(n_views)
+        ]
+        if len(self.classes) > 0 and do_class:
+            outputs[0].update(
+                {
+                    "cls_output_"
+                    + clsname: self.cls_decoders[clsname](
+                        outputs[0]["cell_embs"][:, 2 + i, :]
+                    )
+                    for i, clsname in enumerate(self.classes)
+                }
+            )  # (minibatch, n_cls)
+        if do_mvc:
+            outputs[0].update(
+                self.mvc_decoder(
+                    outputs[0]["cell_emb"], self.cur_gene_token_embs
+                )
             )
+            outputs[0]["mvc_mean"] = (
+                depth_mult.unsqueeze(1) * outputs[0]["mvc_mean"]
+            )
+        return outputs
 
     def configure_optimizers(self):
         """@see pl.LightningModule"""
@@ -637,6 +899,7 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
                 encoder_layers.set_seq_parallel(True)
         for k, v in self.mat_labels_hierarchy.items():
             self.mat_labels_hierarchy[k] = v.to(self.device)
+        self.cls_token_embs = None
 
     def training_step(
         self,
@@ -667,6 +930,7 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
             do_generate=self.do_generate,
             run_full_forward=self.run_full_forward,
             mask_ratio=self.mask_ratio,
+            fused_views=self.fused_views,
         )
         self.log("train_loss", total_loss, prog_bar=True, sync_dist=True)
         self.log_dict(losses, prog_bar=True, sync_dist=True)
@@ -688,6 +952,7 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
         do_generate: bool = False,
         run_full_forward: bool = True,
         mask_ratio: list[float] = [0.15],
+        fused_views: bool = False,
     ):
         """
         _full_training implement the trainng steps: forward (multiple sometimes), loss
@@ -708,6 +973,10 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
             do_adv_cls (bool, optional): A flag to indicate whether to perform adversarial classification. Defaults to False.
             do_generate (bool, optional): A flag to indicate whether to perform data generation. Defaults to False.
             mask_ratio (list, optional): A list of mask ratios to be used in the training. Defaults to [0.15].
+            fused_views (bool, optional): A flag to run the full, masked and
+                denoised views in a single transformer call (@see
+                self._multiview_forward). The losses are the same. Defaults to
+                False.
 
         Returns:
             loss, losses: the total loss as float and the individual losses as dict
@@ -724,14 +993,49 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
         total_loss = 0
         losses = {}
         cell_embs = []
+        if fused_views:
+            # the views are consumed in the order of the unfused loops below
+            view_exprs = [expression] * (
+                int(run_full_forward) + len(mask_ratio)
+            )
+            view_masks = [None] if run_full_forward else []
+            view_masks += [
+                simple_masker(shape=gene_pos.shape, mask_ratio=i).to(
+                    gene_pos.device
+                )
+                for i in mask_ratio
+            ]
+            if do_denoise:
+                view_exprs += [
+                    utils.downsample_profile(expression, dropout=i)
+                    for i in noise
+                ]
+                view_masks += [None] * len(noise)
+            fused = iter(
+                self._multiview_forward(
+                    gene_pos,
+                    view_exprs,
+                    view_masks,
+                    full_depth=total_count,
+                    depth_mult=expression.sum(1),
+                    do_mvc=do_mvc,
+                    do_class=do_cls,
+                )
+                if len(view_exprs) > 0
+                else []
+            )
         if run_full_forward:
-            output = self.forward(
-                gene_pos,
-                expression,
-                mask=None,
-                full_depth=total_count,
-                do_mvc=do_mvc,
-                do_class=do_cls,
+            output = (
+                next(fused)
+                if fused_views
+                else self.forward(
+                    gene_pos,
+                    expression,
+                    mask=None,
+                    full_depth=total_count,
+                    do_mvc=do_mvc,
+                    do_class=do_cls,
+                )
             )
             output.pop("disp")
             output.pop("zero_logits")
@@ -753,18 +1057,21 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
             do_cls = False if do_cls else do_cls
 
         for i in mask_ratio:
-            mask = simple_masker(
-                shape=gene_pos.shape,
-                mask_ratio=i,
-            ).to(gene_pos.device)
-            output = self.forward(
-                gene_pos,
-                expression=expression,
-                mask=mask,
-                full_depth=total_count,
-                do_mvc=do_mvc,
-                do_class=do_cls,
-            )
+            if fused_views:
+                output = next(fused)
+            else:
+                mask = simple_masker(
+                    shape=gene_pos.shape,
+                    mask_ratio=i,
+                ).to(gene_pos.device)
+                output = self.forward(
+                    gene_pos,
+                    expression=expression,
+                    mask=mask,
+                    full_depth=total_count,
+                    do_mvc=do_mvc,
+                    do_class=do_cls,
+                )
             l, tot = self._compute_loss(
                 output,
                 expression,
@@ -786,16 +1093,19 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
         # TASK 3. denoising
         if do_denoise:
             for i in noise:
-                expr = utils.downsample_profile(expression, dropout=i)
-                output = self.forward(
-                    gene_pos,
-                    expression=expr,
-                    mask=None,
-                    depth_mult=expression.sum(1),
-                    full_depth=total_count,
-                    do_mvc=do_mvc,
-                    do_class=do_cls,
-                )
+                if fused_views:
+                    output = next(fused)
+                else:
+                    expr = utils.downsample_profile(expression, dropout=i)
+                    output = self.forward(
+                        gene_pos,
+                        expression=expr,
+                        mask=None,
+                        depth_mult=expression.sum(1),
+                        full_depth=total_count,
+                        do_mvc=do_mvc,
+                        do_class=do_cls,
+                    )
                 l, tot = self._compute_loss(
                     output,
                     expression,
@@ -1042,6 +1352,7 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
     def on_validation_start(self):
         for k, v in self.mat_labels_hierarchy.items():
             self.mat_labels_hierarchy[k] = v.to(self.device)
+        self.cls_token_embs = None
 
     def on_validation_epoch_start(self):
         self.embs = None
@@ -1074,6 +1385,7 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
             do_generate=self.do_generate,
             run_full_forward=self.run_full_forward,
             mask_ratio=self.mask_ratio,
+            fused_views=self.fused_views,
         )
         expression = batch["x"]
         gene_pos = batch["genes"]
@@ -1088,6 +1400,7 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
                     depth,
                     pred_embedding=self.pred_embedding,
                     max_size_in_mem=100_000,
+                    outputs={"cls"},
                 )
         else:
             self.info = batch["class"]
@@ -1097,6 +1410,7 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
                 depth,
                 pred_embedding=self.pred_embedding,
                 max_size_in_mem=100_000,
+                outputs={"cls"},
             )
         self.log("val_loss", val_loss, sync_dist=True)
         self.log_dict(losses, sync_dist=True)
@@ -1144,6 +1458,7 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
         self.attn.data = None
         self.attn.attn = None
         self.counter = 0
+        self.cls_token_embs = None
         if type(self.transformer) is FlashTransformerEncoder:
             for encoder_layers in self.transformer.blocks:
                 encoder_layers.set_seq_parallel(False)
@@ -1179,6 +1494,8 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
         depth_mult=6,
         keep_output=True,
         max_size_in_mem=100_000,
+        outputs=None,
+        lengths=None,
     ):
         """
         @see predict_step will save output of predict in multiple self variables
@@ -1195,64 +1512,103 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
             @see training_step
             other important arguments:
             keep_output (bool, optional): whether to keep the output in memory. Defaults to True.
+            outputs (set[str], optional): the outputs to compute, @see
+                self.forward(). pred is only kept if "cls" is requested and
+                expr_pred if "expr" is. Defaults to None (all).
+            lengths (Tensor, optional): the number of real genes of each
+                cell, to pack the cells without their padding,
+                @see self.forward(). Not available with get_attention_layer
+                and the "generate" predict_mode. Defaults to None.
             self.get_attention_layer (list, optional): the layers to get the attention from. Defaults to [].
             self.pred_embedding (list, optional): the classes to predict. Defaults to [].
+            self.inference_mode (bool, optional): whether to run the forward
+                passes through self.infer(). Defaults to False.
 
         """
-        if predict_mode == "none":
-            output = self.forward(
-                gene_pos,
-                expression,
-                depth_mult=expression.sum(1),
-                full_depth=depth,
-                get_attention_layer=get_attention_layer,
-                do_class=True,
-            )
-            if len(get_attention_layer) > 0:
-                self.attn.agg([i[:, :, :2, :] for i in output[1]], gene_pos)
-                output = output[0]
-            cell_embs = output["cell_embs"]
-        elif predict_mode == "denoise":
-            output = self.forward(
-                gene_pos,
-                expression,
-                depth_mult=expression.sum(1) * depth_mult,
-                full_depth=depth * depth_mult,
-                get_attention_layer=get_attention_layer,
-                do_class=True,
-            )
-            if len(get_attention_layer) > 0:
-                self.attn.agg([i[:, :, :2, :] for i in output[1]], gene_pos)
-                output = output[0]
-            cell_embs = output["cell_embs"]
-        elif predict_mode == "generate":
-            output = self.forward(
-                gene_pos,
-                expression,
-                full_depth=depth,
-                do_mvc=False,
-                do_class=False,
-            )
-            cell_embs = output["cell_embs"]
-            output = self._generate(
-                output["cell_embs"],
-                gene_pos,
-                full_depth=None,  # otherwise we have 2 depths passed
-                depth_mult=expression.sum(1),
-                do_class=self.do_cls,
-                do_mvc=False,
-            )
-        else:
+        forward = self.infer if self.inference_mode else self.forward
+        if outputs is not None:
+            outputs = set(outputs) | {"cell_embs"}
+        if lengths is not None and (
+            len(get_attention_layer) > 0 or predict_mode == "generate"
+        ):
             raise ValueError(
-                "predict_mode needs to be one of ['none', 'denoise', 'generate']"
+                "lengths cannot be used with get_attention_layer or the "
+                "generate predict_mode"
             )
+        # self.attn aggregates the attention of the layers as it is computed
+        with self.attn.hooks(
+            [
+                self.transformer.blocks[i]
+                for i in (
+                    get_attention_layer if predict_mode != "generate" else []
+                )
+            ],
+            gene_pos,
+        ):
+            if predict_mode == "none":
+                output = forward(
+                    gene_pos,
+                    expression,
+                    depth_mult=expression.sum(1),
+                    full_depth=depth,
+                    do_class=True,
+                    outputs=outputs,
+                    lengths=lengths,
+                )
+                cell_embs = output["cell_embs"]
+            elif predict_mode == "denoise":
+                output = forward(
+                    gene_pos,
+                    expression,
+                    depth_mult=expression.sum(1) * depth_mult,
+                    full_depth=depth * depth_mult,
+                    do_class=True,
+                    outputs=outputs,
+                    lengths=lengths,
+                )
+                cell_embs = output["cell_embs"]
+            elif predict_mode == "generate":
+                output = forward(
+                    gene_pos,
+                    expression,
+                    full_depth=depth,
+                    outputs={"cell_embs"},
+                )
+                cell_embs = output["cell_embs"]
+                output = self._generate(
+                    output["cell_embs"],
+                    gene_pos,
+                    full_depth=None,  # otherwise we have 2 depths passed
+                    depth_mult=expression.sum(1),
+                    do_class=self.do_cls,
+                    do_mvc=False,
+                    outputs=outputs,
+                )
+            else:
+                raise ValueError(
+                    "predict_mode needs to be one of "
+                    "['none', 'denoise', 'generate']"
+                )
 
         if len(pred_embedding) == 0:
             pred_embedding = self.classes
         ind = [self.classes.index(i) + 2 for i in pred_embedding]
+        embs = torch.mean(cell_embs[:, ind, :], dim=1)
+        has_cls = (
+            len(self.classes) > 0 and "cls_output_" + self.classes[0] in output
+        )
+        expr = (
+            (
+                [output["mean"], output["disp"], output["zero_logits"]]
+                if "disp" in output
+                else [output["mean"]]
+            )
+            if "mean" in output
+            else None
+        )
         if not keep_output:
             return {
-                "embs": torch.mean(cell_embs[:, ind, :], dim=1),
+                "embs": embs,
                 "class": (
                     torch.stack(
                         [
@@ -1260,72 +1616,46 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
                             for clsname in self.classes
                         ]
                     ).transpose(0, 1)
-                    if len(self.classes) > 0
+                    if has_cls
                     else None
                 ),
                 "pos": gene_pos,
-                "expr": (
-                    [output["mean"], output["disp"], output["zero_logits"]]
-                    if "disp" in output
-                    else [output["mean"]]
-                ),
+                "expr": expr,
             }
+        pred = (
+            torch.stack(
+                [
+                    (
+                        torch.argmax(output["cls_output_" + clsname], dim=1)
+                        if not self.keep_all_cls_pred
+                        else output["cls_output_" + clsname]
+                    )
+                    for clsname in self.classes
+                ]
+            ).transpose(0, 1)
+            if has_cls
+            else None
+        )
         if self.embs is None:
-            self.embs = torch.mean(cell_embs[:, ind, :], dim=1)
+            self.embs = embs
             # self.embs = output["cls_output_" + "cell_type_ontology_term_id"]
-            self.pred = (
-                torch.stack(
-                    [
-                        (
-                            torch.argmax(output["cls_output_" + clsname], dim=1)
-                            if not self.keep_all_cls_pred
-                            else output["cls_output_" + clsname]
-                        )
-                        for clsname in self.classes
-                    ]
-                ).transpose(0, 1)
-                if len(self.classes) > 0
-                else None
-            )
+            self.pred = pred
             self.pos = gene_pos
-            self.expr_pred = (
-                [output["mean"], output["disp"], output["zero_logits"]]
-                if "disp" in output
-                else [output["mean"]]
-            )
+            self.expr_pred = expr
         else:
-            self.embs = torch.cat(
-                # [self.embs, output["cls_output_" + "cell_type_ontology_term_id"]]
-                [self.embs, torch.mean(cell_embs[:, ind, :], dim=1)]
-            )
-            self.pred = torch.cat(
-                [
-                    self.pred,
-                    (
-                        torch.stack(
-                            [
-                                (
-                                    torch.argmax(output["cls_output_" + clsname], dim=1)
-                                    if not self.keep_all_cls_pred
-                                    else output["cls_output_" + clsname]
-                                )
-                                for clsname in self.classes
-                            ]
-                        ).transpose(0, 1)
-                        if len(self.classes) > 0
-                        else None
-                    ),
-                ],
+            # [self.embs, output["cls_output_" + "cell_type_ontology_term_id"]]
+            self.embs = torch.cat([self.embs, embs])
+            self.pred = (
+                torch.cat([self.pred, pred]) if pred is not None else None
             )
             self.pos = torch.cat([self.pos, gene_pos])
             self.expr_pred = (
                 [
-                    torch.cat([self.expr_pred[0], output["mean"]]),
-                    torch.cat([self.expr_pred[1], output["disp"]]),
-                    torch.cat([self.expr_pred[2], output["zero_logits"]]),
+                    torch.cat([prev, new])
+                    for prev, new in zip(self.expr_pred, expr)
                 ]
-                if "disp" in output
-                else [torch.cat([self.expr_pred[0], output["mean"]])]
+                if expr is not None
+                else None
             )
         if self.embs is not None:
             if self.embs.shape[0] > max_size_in_mem:
@@ -1389,17 +1719,29 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
             src(:obj:`Tensor`): A tensor representing the source data. It has a shape of (minibatch, seq_len).
             values(:obj:`Tensor`): An optional tensor representing the values. It has a shape of (minibatch, seq_len).
             gen_iters(:obj:`int`): An integer representing the number of generation iterations.
+                The gene token encoding is computed once and reused across
+                iterations.
             classes(:obj:`Tensor`): An optional tensor representing the classes. It has a shape of (batch,).
         """
         if tp is not None:
             tp = tp / gen_iters
+        gene_encoding = None
         for i in range(gen_iters):
             encoding = self._encoder(
                 cell_embs=cell_embs,
                 gene_pos=gene_pos,
                 full_depth=full_depth,
                 timepoint=tp * (i + 1) if tp is not None else None,
+                keep_gene_embs=(
+                    "mvc" in decoder_kwargs["outputs"]
+                    if decoder_kwargs.get("outputs") is not None
+                    else decoder_kwargs.get("do_mvc", False)
+                ),
+                gene_encoding=gene_encoding,
             )  # (minibatch, seq_len, embsize)
+            # only the cell embeddings change across iterations, the gene
+            # tokens are encoded once
+            gene_encoding = encoding[:, -gene_pos.shape[1] :]
             transformer_output = self.transformer(encoding)
             cell_embs = self.get_cell_embs(transformer_output)
         output = self._decoder(
@@ -1424,7 +1766,8 @@ class scPrint(L.LightningModule, PyTorchModelHubMixin):
             self.embs,
             self.classes,
             self.pred if not self.keep_all_cls_pred else None,
-            self.attn.get(),
+            # the Q and K are not stored in the adata, not copied to the host
+            None,
             self.global_step,
             self.label_decoders,
             self.labels_hierarchy,
@@ -6,6 +6,7 @@ from torch.distributions import Poisson, Gamma
 import bionty as bt
 
 from collections import Counter
+from contextlib import contextmanager
 import math
 import torch.nn as nn
 from torch import Tensor
@@ -19,6 +20,7 @@ import pandas as pd
 import gc
 
 import gc
+import copy
 import json
 from ..tasks import cell_emb as embbed_task
 from ..tasks import grn as grn_task
@@ -283,6 +285,53 @@ def _init_weights(
                 )
 
 
+def quantize(model: nn.Module, dtype: str = "int8", inplace: bool = False):
+    """
+    quantize applies dynamic int8 quantization to the Linear layers of the
+    transformer (Wqkv, out_proj, fc1, fc2) and of the decoders of a scPrint
+    model, for CPU inference.
+
+    The weights are stored in int8 and the activations are quantized on the
+    fly. The encoders, LayerNorms and softmax stay in fp32.
+
+    Args:
+        model (nn.Module): the scPrint model, on CPU.
+        dtype (str, optional): the quantization to apply, only "int8" is
+            supported. Defaults to "int8".
+        inplace (bool, optional): whether to quantize the model in place
+            instead of a copy. Defaults to False.
+
+    Raises:
+        ValueError: if dtype is not "int8" or if the model is not on CPU.
+
+    Returns:
+        nn.Module: the quantized model
+    """
+    if dtype != "int8":
+        raise ValueError(
+            f"Unknown quantization: {dtype}, only int8 is supported"
+        )
+    if next(model.parameters()).device.type != "cpu":
+        raise ValueError(
+            "quantized models only run on CPU, move the model to CPU first"
+        )
+    if not inplace:
+        model = copy.deepcopy(model)
+    modules = {
+        name
+        for name in [
+            "transformer",
+            "expr_decoder",
+            "cls_decoders",
+            "mvc_decoder",
+        ]
+        if getattr(model, name, None) is not None
+    }
+    return torch.ao.quantization.quantize_dynamic(
+        model.float(), modules, dtype=torch.qint8, inplace=True
+    )
+
+
 def downsample_profile(mat: Tensor, dropout: float, method="new"):
     """
     This function downsamples the expression profile of a given single cell RNA matrix.
@@ -472,39 +521,238 @@ def translate(
 
 
 class Attention:
-    def __init__(self, gene_dim, comp_attn=False):
+    def __init__(
+        self,
+        gene_dim,
+        comp_attn=False,
+        chunk_size=4,
+        compact=True,
+        dtype=torch.float32,
+    ):
+        """
+        Attention accumulates the Q and K (or the full attention matrix if
+        comp_attn) of the cells, per gene, on the device of the model. The
+        result is only moved to CPU by get().
+
+        Args:
+            gene_dim (int): the number of cell tokens + the number of genes of
+                the model
+            comp_attn (bool, optional): whether to accumulate the full
+                attention matrix. Defaults to False.
+            chunk_size (int, optional): the number of cells whose full
+                attention matrices are computed at once if comp_attn, bounding
+                the memory to chunk_size * heads * context^2. Defaults to 4.
+            compact (bool, optional): whether to only store the Q and K of the
+                genes seen so far (rows are added as new genes come) instead of
+                the whole vocabulary. Defaults to True.
+            dtype (torch.dtype, optional): the storage dtype of the Q and K. In
+                float16 / bfloat16, the running means are stored instead of the
+                sums and updated in float32 with each minibatch (Welford), so
+                that the error stays at the precision of the dtype instead of
+                growing with the number of cells. Defaults to torch.float32.
+
+        The Q and K can also be accumulated per group of cells (@see GRNfer's
+        groupby): the group of each cell of the minibatch is then given in
+        self.groups (set by the caller), the number of groups in self.n_groups,
+        and optionally, in self.group_mask, the (groups, gene_dim) mask of the
+        tokens kept for each group.
+        """
         self.data = None
         self.gene_dim = gene_dim
         self.div = None
         self.attn = None
         self.comp_attn = comp_attn
+        self.chunk_size = chunk_size
+        self.compact = compact
+        self.dtype = dtype
+        # the vocabulary ids of the rows of self.data, the row of each id or -1
+        self.ids = None
+        self.row_of = None
+        self.groups = None
+        self.n_groups = 1
+        self.group_mask = None
 
     def agg(self, x: list[Tensor], pos: Tensor):
+        """
+        agg aggregates the Q and K of several layers over the cells of a
+        minibatch
+
+        Args:
+            x (list[Tensor]): per layer, the (cells, context, QK, heads, dim)
+                tensor
+            pos (Tensor): the gene ids of the cells (cells, seq_len)
+        """
+        for i, layer in enumerate(x):
+            self.agg_layer(layer, pos, i, len(x))
+
+    def agg_layer(self, x: Tensor, pos: Tensor, layer: int, nlayers: int):
+        """
+        agg_layer aggregates the Q and K of one layer over the cells of a
+        minibatch
+
+        Args:
+            x (Tensor): the (cells, context, QK, heads, dim) tensor
+            pos (Tensor): the gene ids of the cells (cells, seq_len)
+            layer (int): the index of the layer among the aggregated ones
+            nlayers (int): the number of aggregated layers
+        """
         if self.comp_attn:
+            x = x.detach()
             if self.attn is None:
-                self.attn = torch.zeros([self.gene_dim, self.gene_dim], device="cuda")
-                self.div = torch.zeros(self.gene_dim, device="cuda")
-            for j in range(x[0].shape[0]):  # •cells, •context, •QK, •heads, •dim
-                loc = torch.cat([torch.arange(8, device="cuda"), pos[j] + 8]).int()
-                for i in range(len(x)):
-                    for k in range(x[0].shape[3]):
-                        self.attn[loc[:, None], loc] += torch.nn.functional.softmax(
-                            (x[i][j, :, 0, k, :] @ x[i][j, :, 1, k, :].T)
-                            * (x[0].shape[-1] ** -0.5),
-                            dim=-1,
-                        )
-                    self.div[loc] += x[0].shape[3] * len(x)
-            torch.cuda.empty_cache()
+                self.attn = torch.zeros(
+                    [self.gene_dim, self.gene_dim], device=x.device
+                )
+                self.div = torch.zeros(self.gene_dim, device=x.device)
+            loc = self._loc(pos.to(x.device), x.shape[1])
+            for start in range(0, x.shape[0], self.chunk_size):
+                # •QK, •cells, •heads, •context, •dim
+                q, k = x[start : start + self.chunk_size].permute(
+                    2, 0, 3, 1, 4
+                )
+                # the attention matrices of the cells, summed over the heads
+                attn = torch.softmax(
+                    (q @ k.transpose(-1, -2)) * (x.shape[-1] ** -0.5),
+                    dim=-1,
+                    dtype=self.attn.dtype,
+                ).sum(1)
+                cell_loc = loc[start : start + self.chunk_size]
+                self.attn.index_put_(
+                    (cell_loc[:, :, None], cell_loc[:, None, :]),
+                    attn,
+                    accumulate=True,
+                )
+            self.div.index_add_(
+                0,
+                loc.flatten(),
+                torch.full((loc.numel(),), float(x.shape[3]), device=x.device),
+            )
         else:
-            pos = pos.detach().to("cpu")
-            if self.data is None:
-                self.data = torch.zeros([len(x), self.gene_dim] + list(x[0].shape[2:]))
-                self.div = torch.zeros(self.gene_dim)
-            for i in range(x[0].shape[0]):
-                loc = torch.cat([torch.arange(8), pos[i] + 8]).int()
-                for j in range(len(x)):
-                    self.data[j, loc, :, :, :] += x[j][i].detach().to("cpu")
-                self.div[loc] += 1
+            x = x.detach().flatten(0, 1)
+            loc = self._loc(pos.to(x.device), x.shape[0] // len(pos))
+            if self.groups is not None:
+                # each group has its own gene_dim ids
+                groups = self.groups.to(x.device)[:, None].expand_as(loc)
+                if self.group_mask is not None:
+                    keep = self.group_mask.to(x.device)[groups, loc].flatten()
+                    x, loc = (
+                        x[keep],
+                        (loc + groups * self.gene_dim).flatten()[keep],
+                    )
+                else:
+                    loc = loc + groups * self.gene_dim
+            loc = loc.flatten()
+            rows = self._rows(loc, nlayers, x)
+            if self.dtype == torch.float32:
+                # all the tokens of all the cells are summed into the rows of
+                # their genes at once
+                self.data[layer].index_add_(0, rows, x.float())
+            else:
+                uniq, inv = torch.unique(rows, return_inverse=True)
+                batch_sum = torch.zeros(
+                    (len(uniq),) + x.shape[1:], device=x.device
+                ).index_add_(0, inv, x.float())
+                batch_count = torch.bincount(inv, minlength=len(uniq)).float()
+                count = (self.div[layer, uniq] + batch_count)[
+                    :, None, None, None
+                ]
+                mean = self.data[layer, uniq].float()
+                mean += (
+                    batch_sum - mean * batch_count[:, None, None, None]
+                ) / count
+                self.data[layer, uniq] = mean.to(self.dtype)
+            self.div[layer].index_add_(
+                0, rows, torch.ones(len(rows), device=self.div.device)
+            )
+
+    def _rows(self, loc: Tensor, nlayers: int, x: Tensor) -> Tensor:
+        """the rows of self.data of the vocabulary ids loc, adding new ones"""
+        if self.data is None:
+            self.ids = torch.zeros(0, dtype=torch.long, device=x.device)
+            self.row_of = torch.full(
+                (self.gene_dim * self.n_groups,),
+                -1,
+                dtype=torch.long,
+                device=x.device,
+            )
+            self.div = torch.zeros(nlayers, 0, device=x.device)
+            self.data = torch.zeros(
+                [nlayers, 0] + list(x.shape[1:]),
+                dtype=self.dtype,
+                device=x.device,
+            )
+        new = (
+            torch.unique(loc[self.row_of[loc] < 0])
+            if self.compact
+            else torch.nonzero(self.row_of < 0).flatten()
+        )
+        if len(new) > 0:
+            self.row_of[new] = torch.arange(
+                len(self.ids), len(self.ids) + len(new), device=x.device
+            )
+            self.ids = torch.cat([self.ids, new])
+            # grow the storage geometrically to amortize the copies
+            if len(self.ids) > self.data.shape[1]:
+                size = min(
+                    max(len(self.ids), 2 * self.data.shape[1]),
+                    len(self.row_of),
+                )
+
+                def grow(t: Tensor) -> Tensor:
+                    return torch.cat(
+                        [
+                            t,
+                            t.new_zeros(
+                                (t.shape[0], size - t.shape[1]) + t.shape[2:]
+                            ),
+                        ],
+                        dim=1,
+                    )
+
+                self.data, self.div = grow(self.data), grow(self.div)
+        return self.row_of[loc]
+
+    def _loc(self, pos: Tensor, context: int) -> Tensor:
+        """
+        the rows of each token (cells, context): the cell tokens come first,
+        then the genes
+        """
+        ncell_tokens = context - pos.shape[1]
+        return torch.cat(
+            [
+                torch.arange(ncell_tokens, device=pos.device).expand(
+                    len(pos), -1
+                ),
+                pos + ncell_tokens,
+            ],
+            dim=1,
+        )
+
+    @contextmanager
+    def hooks(self, blocks: list, pos: Tensor):
+        """
+        hooks registers, while in the context, qkv hooks (@see
+        MHA.register_qkv_hook) on the given transformer blocks that aggregate
+        the Q and K of each layer as it is computed, so that the qkv of the
+        different layers are never kept together.
+
+        Args:
+            blocks (list[Block]): the blocks whose attention to aggregate
+            pos (Tensor): the gene ids of the cells (cells, seq_len)
+        """
+
+        def hook(layer):
+            return lambda module, qkv: self.agg_layer(
+                qkv[:, :, :2], pos, layer, len(blocks)
+            )
+
+        handles = [
+            block.register_qkv_hook(hook(i)) for i, block in enumerate(blocks)
+        ]
+        try:
+            yield
+        finally:
+            for handle in handles:
+                handle.remove()
 
     def add(self, x: list[Tensor], pos: Tensor):
         pos = pos.detach().to("cpu")
@@ -519,7 +767,21 @@ class Attention:
             )
             # self.div[loc] += 1
 
-    def get(self):
+    def get(self, group: Optional[int] = None):
+        """
+        get the accumulated attention matrix if comp_attn, else the mean Q
+        and K of the tokens seen, without rows for the rest of the vocabulary
+
+        Args:
+            group (int, optional): the group whose Q and K to get, when
+                accumulated per group. Defaults to None.
+
+        Returns:
+            np.ndarray | Tuple[Tensor, Tensor]: the (genes, genes) attention,
+                or the sorted vocabulary ids (in [0, gene_dim)) of the tokens
+                seen and their (layers, ids, QK, heads, dim) mean Q and K, on
+                CPU
+        """
         if self.comp_attn:
             loc = self.attn.sum(1) != 0
             return (
@@ -531,8 +793,27 @@ class Attention:
         else:
             if self.data is None:
                 return None
-            # shape is (layers, genes, qkv, heads, emb)
-            return self.data / self.div.view(1, self.div.shape[0], 1, 1, 1)
+            rows, ids = (
+                torch.arange(len(self.ids), device=self.ids.device),
+                self.ids,
+            )
+            if self.n_groups > 1:
+                if group is None:
+                    raise ValueError(
+                        "the Q and K are accumulated per group, give a group"
+                    )
+                rows = rows[ids // self.gene_dim == group]
+                ids = ids[rows] - group * self.gene_dim
+            # in the order of the vocabulary: the cell tokens, then the genes
+            ids, order = torch.sort(ids)
+            rows = rows[order]
+            qk = (
+                self.data[:, rows] / self.div[:, rows, None, None, None]
+                if self.dtype == torch.float32
+                else self.data[:, rows].float()
+            )
+            # shape is (layers, ids, qkv, heads, emb)
+            return ids.cpu(), qk.cpu()
 
 
 def test(model, name, filedir):
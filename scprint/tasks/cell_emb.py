@@ -20,7 +20,7 @@ from lightning.pytorch import Trainer
 
 from scipy.stats import spearmanr
 
-from typing import List
+from typing import List, Optional
 from anndata import AnnData
 
 FILE_LOC = os.path.dirname(os.path.realpath(__file__))
@@ -49,6 +49,8 @@ class Embedder:
         keep_all_cls_pred: bool = False,
         devices: List[int] = [0],
         dtype: torch.dtype = torch.float16,
+        quantize: Optional[str] = None,
+        pack_sequences: bool = False,
     ):
         """
         Embedder a class to embed and annotate cells using a model
@@ -64,13 +66,31 @@ class Embedder:
             pred_embedding (List[str], optional): The list of labels to be used for plotting embeddings. Defaults to [ "cell_type_ontology_term_id", "disease_ontology_term_id", "self_reported_ethnicity_ontology_term_id", "sex_ontology_term_id", ].
             model_name (str, optional): The name of the model to be used. Defaults to "scprint".
             output_expression (str, optional): The type of output expression to be used. Can be one of "all", "sample", "none". Defaults to "sample".
+            quantize (str, optional): "int8" to run a dynamically quantized
+                copy of the model, in fp32 on CPU. @see
+                scprint.model.utils.quantize. Defaults to None.
+            pack_sequences (bool, optional): With "most expr" and
+                "random expr", the collator completes the cells with fewer
+                than max_len expressed genes with unexpressed genes. If True,
+                these genes are left out and the cells are packed without
+                padding, so that the cost of a cell scales with its number of
+                expressed genes (@see scPrint.forward's lengths). The
+                add_zero_genes genes are kept. Defaults to False.
         """
-        self.model = model
+        self.model = (
+            model if quantize is None else utils.quantize(model, quantize)
+        )
+        self.quantize = quantize
         self.batch_size = batch_size
         self.num_workers = num_workers
         self.how = how
         self.max_len = max_len
         self.add_zero_genes = add_zero_genes
+        if pack_sequences and how not in ["most expr", "random expr"]:
+            raise ValueError(
+                "pack_sequences needs a how of 'most expr' or 'random expr'"
+            )
+        self.pack_sequences = pack_sequences
         self.pred_embedding = pred_embedding
         self.keep_all_cls_pred = keep_all_cls_pred
         self.model_name = model_name
@@ -137,7 +157,9 @@ class Embedder:
             self.model.on_predict_epoch_start()
             device = self.model.device.type
             with torch.no_grad(), torch.autocast(
-                device_type=device, dtype=torch.float16
+                device_type=device,
+                dtype=torch.float16,
+                enabled=self.quantize is None,
             ):
                 for batch in tqdm(dataloader):
                     gene_pos, expression, depth = (
@@ -151,6 +173,15 @@ class Embedder:
                         depth,
                         predict_mode="none",
                         pred_embedding=self.pred_embedding,
+                        outputs={"cell_embs", "cls"}
+                        | ({"expr"} if output_expression != "none" else set()),
+                        # the collator puts the expressed genes first
+                        lengths=(
+                            (expression > 0).sum(1).clamp(max=self.max_len)
+                            + self.add_zero_genes
+                            if self.pack_sequences
+                            else None
+                        ),
                     )
                     torch.cuda.empty_cache()
             self.model.log_adata(name="predict_part_" + str(self.model.counter))
@@ -401,7 +432,13 @@ def compute_corr(out, to, doplot=True, compute_mean_regress=False, plot_corr_siz
     return metrics
 
 
-def default_benchmark(model, default_dataset="pancreas", do_class=True, coarse=False):
+def default_benchmark(
+    model,
+    default_dataset="pancreas",
+    do_class=True,
+    coarse=False,
+    quantize=None,
+):
     if default_dataset == "pancreas":
         adata = sc.read(
             FILE_LOC + "/../../data/pancreas_atlas.h5ad",
@@ -439,6 +476,7 @@ def default_benchmark(model, default_dataset="pancreas", do_class=True, coarse=F
         pred_embedding=["cell_type_ontology_term_id"],
         doclass=(default_dataset not in ["pancreas", "lung"]),
         devices=1,
+        quantize=quantize,
     )
     embed_adata, metrics = embedder(adata.copy())
 
@@ -6,6 +6,7 @@ import torch
 from scdataloader.data import SimpleAnnDataset
 from scdataloader import Collator
 from scprint.model import utils
+from scprint.model.flash_attn import FlashTransformerEncoder
 import bionty as bt
 from torch.utils.data import DataLoader
 from typing import Tuple
@@ -45,6 +46,7 @@ class Denoiser:
         downsample: Optional[float] = None,
         devices: List[int] = [0],
         dtype: torch.dtype = torch.float16,
+        attn_chunk_size: Optional[int] = None,
     ):
         """
         Embedder a class to embed and annotate cells using a model
@@ -60,6 +62,10 @@ class Denoiser:
             pred_embedding (List[str], optional): The list of labels to be used for plotting embeddings. Defaults to [ "cell_type_ontology_term_id", "disease_ontology_term_id", "self_reported_ethnicity_ontology_term_id", "sex_ontology_term_id", ].
             model_name (str, optional): The name of the model to be used. Defaults to "scprint".
             output_expression (str, optional): The type of output expression to be used. Can be one of "all", "sample", "none". Defaults to "sample".
+            attn_chunk_size (int, optional): If set, the attention is computed
+                by tiles of this size, so that its memory grows linearly with
+                max_len (models not using the triton kernel, @see
+                FlashTransformerEncoder.set_attn_chunk_size). Defaults to None.
         """
         self.model = model
         self.batch_size = batch_size
@@ -72,6 +78,7 @@ class Denoiser:
         self.downsample = downsample
         self.precision = precision
         self.dtype = dtype
+        self.attn_chunk_size = attn_chunk_size
         # self.trainer = Trainer(precision=precision, devices=devices)
         # subset_hvg=1000, use_layer='counts', is_symbol=True,force_preprocess=True, skip_validate=True)
 
@@ -117,20 +124,33 @@ class Denoiser:
         self.model.on_predict_epoch_start()
         self.model.eval()
         device = self.model.device.type
-        with torch.no_grad(), torch.autocast(device_type=device, dtype=self.dtype):
-            for batch in tqdm(dataloader):
-                gene_pos, expression, depth = (
-                    batch["genes"].to(device),
-                    batch["x"].to(device),
-                    batch["depth"].to(device),
-                )
-                self.model._predict(
-                    gene_pos,
-                    expression,
-                    depth,
-                    predict_mode="denoise",
-                    depth_mult=self.predict_depth_mult,
-                )
+        chunked = self.attn_chunk_size is not None and isinstance(
+            self.model.transformer, FlashTransformerEncoder
+        )
+        if chunked:
+            prev_chunk_size = self.model.transformer.get_attn_chunk_size()
+            self.model.transformer.set_attn_chunk_size(self.attn_chunk_size)
+        try:
+            with torch.no_grad(), torch.autocast(
+                device_type=device, dtype=self.dtype
+            ):
+                for batch in tqdm(dataloader):
+                    gene_pos, expression, depth = (
+                        batch["genes"].to(device),
+                        batch["x"].to(device),
+                        batch["depth"].to(device),
+                    )
+                    self.model._predict(
+                        gene_pos,
+                        expression,
+                        depth,
+                        predict_mode="denoise",
+                        depth_mult=self.predict_depth_mult,
+                        outputs={"expr"},
+                    )
+        finally:
+            if chunked:
+                self.model.transformer.set_attn_chunk_size(prev_chunk_size)
         torch.cuda.empty_cache()
         self.genes = (
             self.model.pos
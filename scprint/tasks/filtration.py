@@ -0,0 +1,234 @@
+from typing import Callable, Iterator, List, Optional, Tuple, Union
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import scipy.sparse.csgraph
+import torch
+
+Adjacency = Union[np.ndarray, torch.Tensor]
+
+
+def row_blocks(
+    adj: Adjacency, chunk_rows: int = 1024
+) -> Iterator[Tuple[int, Adjacency]]:
+    """
+    row_blocks iterates over blocks of rows of a dense adjacency matrix,
+    without copying it
+
+    Args:
+        adj (np.ndarray | torch.Tensor): the (rows, genes) adjacency matrix,
+            can be memory-mapped or on the GPU
+        chunk_rows (int, optional): the number of rows of each block. Defaults
+            to 1024.
+
+    Yields:
+        Tuple[int, np.ndarray | torch.Tensor]: the first row of the block and
+        the block
+    """
+    for start in range(0, adj.shape[0], chunk_rows):
+        yield start, adj[start : start + chunk_rows]
+
+
+def _to_numpy(block: Adjacency) -> np.ndarray:
+    if isinstance(block, torch.Tensor):
+        return block.detach().float().cpu().numpy()
+    return np.asarray(block, dtype=np.float32)
+
+
+def sparsify(
+    adj: Adjacency,
+    keep: Callable[[int, Adjacency], scipy.sparse.csr_matrix],
+    chunk_rows: int = 1024,
+) -> scipy.sparse.csr_matrix:
+    """
+    sparsify builds a sparse adjacency matrix one block of rows at a time, so
+    that only a block of the dense matrix is ever copied
+
+    Args:
+        adj (np.ndarray | torch.Tensor): the (rows, genes) dense adjacency
+            matrix
+        keep (Callable): called as keep(start, block) for each block of rows,
+            returns the edges of the block to keep as a (block rows, genes) csr
+            matrix
+        chunk_rows (int, optional): the number of rows of each block. Defaults
+            to 1024.
+
+    Returns:
+        scipy.sparse.csr_matrix: the (rows, genes) filtered adjacency matrix
+    """
+    if adj.shape[0] == 0:
+        return scipy.sparse.csr_matrix(adj.shape, dtype=np.float32)
+    return scipy.sparse.vstack(
+        [keep(start, block) for start, block in row_blocks(adj, chunk_rows)],
+        format="csr",
+    )
+
+
+def threshold(
+    adj: Adjacency, thresh: Optional[float] = None, chunk_rows: int = 1024
+) -> scipy.sparse.csr_matrix:
+    """
+    threshold keeps the edges whose weight is at least thresh
+
+    Args:
+        adj (np.ndarray | torch.Tensor): the (rows, genes) dense adjacency
+            matrix
+        thresh (float, optional): the threshold. Defaults to None (1 / genes,
+            the weight of a uniform attention).
+        chunk_rows (int, optional): @see sparsify
+
+    Returns:
+        scipy.sparse.csr_matrix: the (rows, genes) filtered adjacency matrix
+    """
+    if thresh is None:
+        thresh = 1 / adj.shape[-1]
+
+    def keep(start, block):
+        block = _to_numpy(block)
+        return scipy.sparse.csr_matrix(np.where(block >= thresh, block, 0))
+
+    return sparsify(adj, keep, chunk_rows)
+
+
+def top_k(
+    adj: Adjacency, k: int, chunk_rows: int = 1024
+) -> scipy.sparse.csr_matrix:
+    """
+    top_k keeps the k strongest edges of each row, selected with torch.topk on
+    the device of a tensor or np.argpartition for an array, instead of sorting
+    the full rows
+
+    Args:
+        adj (np.ndarray | torch.Tensor): the (rows, genes) dense adjacency
+            matrix
+        k (int): the number of edges to keep per row
+        chunk_rows (int, optional): @see sparsify
+
+    Returns:
+        scipy.sparse.csr_matrix: the (rows, genes) filtered adjacency matrix
+    """
+    k = min(k, adj.shape[-1])
+
+    def keep(start, block):
+        if isinstance(block, torch.Tensor):
+            values, cols = torch.topk(block, k, dim=-1)
+            values, cols = _to_numpy(values), cols.cpu().numpy()
+        else:
+            block = _to_numpy(block)
+            cols = np.argpartition(block, -k, axis=-1)[:, -k:]
+            values = np.take_along_axis(block, cols, axis=-1)
+        rows = np.repeat(np.arange(block.shape[0]), k)
+        return scipy.sparse.csr_matrix(
+            (values.ravel(), (rows, cols.ravel())), shape=tuple(block.shape)
+        )
+
+    return sparsify(adj, keep, chunk_rows)
+
+
+def known_mask(gt: pd.DataFrame, genes: List[str]) -> scipy.sparse.csr_matrix:
+    """
+    known_mask the known edges (the 1s) of a ground truth GRN between the given
+    genes
+
+    Args:
+        gt (pd.DataFrame): the (regulators, targets) ground truth, dense or
+            with sparse columns
+        genes (List[str]): the genes, in the order of the rows and columns of
+            the mask
+
+    Returns:
+        scipy.sparse.csr_matrix: the (genes, genes) boolean mask of the known
+            edges
+    """
+    if all(isinstance(dtype, pd.SparseDtype) for dtype in gt.dtypes):
+        edges = scipy.sparse.coo_matrix(gt.sparse.to_coo())
+    else:
+        edges = scipy.sparse.coo_matrix(gt.values)
+    genes = pd.Index(genes)
+    rows = genes.get_indexer(gt.index)[edges.row]
+    cols = genes.get_indexer(gt.columns)[edges.col]
+    loc = (edges.data == 1) & (rows >= 0) & (cols >= 0)
+    return scipy.sparse.csr_matrix(
+        (np.ones(loc.sum(), dtype=bool), (rows[loc], cols[loc])),
+        shape=(len(genes), len(genes)),
+    )
+
+
+def known_edges(
+    adj: Adjacency, mask: scipy.sparse.csr_matrix, chunk_rows: int = 1024
+) -> scipy.sparse.csr_matrix:
+    """
+    known_edges keeps the edges of the adjacency matrix that are in the mask
+
+    Args:
+        adj (np.ndarray | torch.Tensor): the (rows, genes) dense adjacency
+            matrix
+        mask (scipy.sparse.csr_matrix): the (rows, genes) mask, @see known_mask
+        chunk_rows (int, optional): @see sparsify
+
+    Returns:
+        scipy.sparse.csr_matrix: the (rows, genes) filtered adjacency matrix
+    """
+
+    def keep(start, block):
+        return scipy.sparse.csr_matrix(
+            mask[start : start + block.shape[0]].multiply(_to_numpy(block))
+        )
+
+    return sparsify(adj, keep, chunk_rows)
+
+
+def mst(
+    adj: Adjacency, k: int = 10, n_trees: int = 1, chunk_rows: int = 1024
+) -> scipy.sparse.csr_matrix:
+    """
+    mst keeps the edges of the maximum spanning tree (a forest if the graph is
+    not connected) of the adjacency matrix, or the union of n_trees successive
+    maximum spanning trees, each one computed without the edges of the previous
+    ones, for a denser backbone.
+
+    The trees are computed with scipy's sparse minimum spanning tree on the k
+    strongest edges of each row (@see top_k), undirected, in O(E log V) instead
+    of on the dense matrix. The weights are turned into the distances
+    max(weight) - weight, so that the strongest edges are kept.
+
+    Args:
+        adj (np.ndarray | torch.Tensor): the (genes, genes) dense adjacency
+            matrix
+        k (int, optional): the number of candidate edges per row. Defaults to
+            10.
+        n_trees (int, optional): the number of spanning trees to merge.
+            Defaults to 1.
+        chunk_rows (int, optional): @see sparsify
+
+    Returns:
+        scipy.sparse.csr_matrix: the (genes, genes) filtered adjacency matrix,
+            with the weights of the kept edges in the direction(s) in which
+            they were candidates
+    """
+    if adj.shape[0] != adj.shape[1]:
+        raise ValueError("the mst filtration needs a square adjacency matrix")
+    candidates = top_k(adj, k, chunk_rows)
+    # no self loops
+    candidates = candidates - scipy.sparse.diags(
+        candidates.diagonal(), format="csr"
+    )
+    candidates.eliminate_zeros()
+    undirected = candidates.maximum(candidates.T).tocsr()
+    kept = scipy.sparse.csr_matrix(adj.shape, dtype=bool)
+    if undirected.nnz == 0:
+        return candidates
+    # the strongest edges get a small positive distance (zeros are no edge)
+    undirected.data = (
+        undirected.data.max() - undirected.data.astype(np.float64) + 1e-9
+    )
+    for _ in range(n_trees):
+        if undirected.nnz == 0:
+            break
+        tree = scipy.sparse.csgraph.minimum_spanning_tree(undirected)
+        tree = (tree + tree.T).astype(bool)
+        kept = kept + tree
+        undirected = (undirected - undirected.multiply(tree)).tocsr()
+        undirected.eliminate_zeros()
+    return scipy.sparse.csr_matrix(candidates.multiply(kept))
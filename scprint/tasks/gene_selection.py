@@ -0,0 +1,120 @@
+from typing import Any, Callable, Dict, List, Optional
+
+import numpy as np
+import scanpy as sc
+from anndata import AnnData
+
+from scprint.utils import cache
+
+# the selections computed in this session, by cache key
+_SELECTIONS: Dict[str, Any] = {}
+
+
+def _cached(
+    key: str, compute: Callable[[], Any], cache_dir: Optional[str] = None
+):
+    if key in _SELECTIONS:
+        return _SELECTIONS[key]
+    value = cache.load(cache_dir, key) if cache_dir is not None else None
+    if value is None:
+        value = compute()
+        if cache_dir is not None:
+            cache.save(cache_dir, key, value)
+    _SELECTIONS[key] = value
+    return value
+
+
+def highly_variable_genes(
+    adata: AnnData,
+    n_top_genes: int,
+    flavor: str = "seurat_v3",
+    cache_dir: Optional[str] = None,
+) -> List[str]:
+    """
+    highly_variable_genes the highly variable genes of a dataset, @see
+    scanpy.pp.highly_variable_genes
+
+    The dataset is not modified, so it can be a view. The genes are cached by
+    the content of the dataset and the parameters, in memory and in cache_dir
+    if given.
+
+    Args:
+        adata (AnnData): the cells, or a view of them
+        n_top_genes (int): the number of genes
+        flavor (str, optional): the flavor of scanpy. Defaults to "seurat_v3".
+        cache_dir (str, optional): a directory where the selection is stored.
+            Defaults to None.
+
+    Returns:
+        List[str]: the genes, in the order of adata.var
+    """
+    key = cache.cache_key(
+        selection="highly_variable_genes",
+        cells=cache.adata_fingerprint(adata),
+        n_top_genes=n_top_genes,
+        flavor=flavor,
+    )
+
+    def compute():
+        hvg = sc.pp.highly_variable_genes(
+            adata, flavor=flavor, n_top_genes=n_top_genes, inplace=False
+        )
+        hvg = hvg["highly_variable"].reindex(adata.var.index, fill_value=False)
+        return adata.var.index[hvg.values.astype(bool)].tolist()
+
+    return _cached(key, compute, cache_dir)
+
+
+def rank_genes_groups(
+    adata: AnnData,
+    groupby: str,
+    genes: Optional[List[str]] = None,
+    cache_dir: Optional[str] = None,
+) -> Dict[str, List[str]]:
+    """
+    rank_genes_groups the genes of each group of cells ranked by their
+    differential expression against the rest of the cells, @see
+    scanpy.tl.rank_genes_groups
+
+    All the groups are ranked in a single call, on a new AnnData with only the
+    matrix, .raw, groups and genes, so the dataset is not modified and can be
+    a view. The rankings are cached by the content of the dataset, its groups
+    and the genes, in memory and in cache_dir if given.
+
+    Args:
+        adata (AnnData): the cells, or a view of them
+        groupby (str): the column of adata.obs with the groups
+        genes (List[str], optional): the only genes to rank. Defaults to None
+            (all).
+        cache_dir (str, optional): a directory where the rankings are stored.
+            Defaults to None.
+
+    Returns:
+        Dict[str, List[str]]: the ranked genes of each group
+    """
+    key = cache.cache_key(
+        selection="rank_genes_groups",
+        cells=cache.adata_fingerprint(adata),
+        groups=cache.labels_fingerprint(adata.obs[groupby]),
+        genes=sorted(genes) if genes is not None else None,
+    )
+
+    def compute():
+        # with .raw, which scanpy ranks by default
+        ranked = AnnData(
+            X=adata.X, obs=adata.obs[[groupby]], var=adata.var, raw=adata.raw
+        )
+        sc.tl.rank_genes_groups(
+            ranked,
+            groupby=groupby,
+            mask_var=(
+                ranked.var.index.isin(genes) if genes is not None else None
+            ),
+        )
+        names = ranked.uns["rank_genes_groups"]["names"]
+        return {
+            group: np.asarray(names[group]).tolist()
+            for group in names.dtype.names
+        }
+
+    return _cached(key, compute, cache_dir)
@@ -1,6 +1,6 @@
 from bengrn import BenGRN, get_sroy_gt, get_perturb_gt
 from scdataloader import Preprocessor
-from bengrn.base import train_classifier
+from bengrn.base import train_classifier, get_GT_db
 from bengrn import BenGRN, get_sroy_gt
 from grnndata import utils as grnutils
 from anndata.utils import make_index_unique
@@ -14,11 +14,12 @@ from torch.utils.data import DataLoader
 
 from lightning.pytorch import Trainer
 import joblib
-from typing import List
+from typing import Dict, List, Optional, Union
 from anndata import AnnData
 
-from scprint.utils.sinkhorn import SinkhornDistance
+from scprint.utils.sinkhorn import sinkhorn
 from scprint.utils import load_genes
+from scprint.utils import cache
 
 from grnndata import GRNAnnData, from_anndata, read_h5ad
 
@@ -30,7 +31,7 @@ from matplotlib import pyplot as plt
 import seaborn as sns
 import numpy as np
 from .tmfg import tmfg
-import networkx as nx
+from . import filtration, gene_selection
 import scipy.sparse
 import os.path
 
@@ -56,6 +57,7 @@ class GRNfer:
         head_agg="mean",  # mean, sum, none
         filtration="thresh",  # thresh, top-k, mst, known, none
         k=10,
+        mst_trees=1,
         apc=False,
         known_grn=None,
         symmetrize=False,
@@ -66,6 +68,12 @@ class GRNfer:
         loc="./",
         dtype=torch.float16,
         devices: List[int] = [0],
+        store_path: Optional[str] = None,
+        regulators: Optional[Union[str, List[str]]] = None,
+        groupby: Optional[str] = None,
+        groups: Optional[List[str]] = None,
+        cache_dir: Optional[str] = None,
+        aggregate_memory: Optional[int] = None,
     ):
         """
         Embedder a class to embed and annotate cells using a model
@@ -81,6 +89,48 @@ class GRNfer:
             pred_embedding (List[str], optional): The list of labels to be used for plotting embeddings. Defaults to [ "cell_type_ontology_term_id", "disease_ontology_term_id", "self_reported_ethnicity_ontology_term_id", "sex_ontology_term_id", ].
             model_name (str, optional): The name of the model to be used. Defaults to "scprint".
             output_expression (str, optional): The type of output expression to be used. Can be one of "all", "sample", "none". Defaults to "sample".
+            dtype (torch.dtype, optional): The dtype of the autocast of the
+                forward pass. Defaults to torch.float16.
+            store_path (str, optional): With head_agg="none", the .npy file
+                where the per-head adjacency matrices (genes, genes, heads) are
+                written and memory-mapped from, instead of being kept in
+                memory. @see mean_heads to reduce them. Defaults to None.
+            regulators (List[str] | str, optional): The genes (adata.var.index)
+                whose outgoing edges are inferred, or "TFs" for the
+                transcription factors of grnndata.utils.TF. Only the
+                (regulators, genes) block of the attention is computed, and the
+                GRN is saved as a sparse matrix with only these rows. Needs a
+                head_agg of "mean" or "max". Defaults to None (all genes).
+            k (int, optional): The number of edges kept per gene by the top-k
+                filtration, and of candidate edges per gene of the mst
+                filtration. Defaults to 10.
+            mst_trees (int, optional): The number of successive maximum
+                spanning trees merged by the mst filtration (@see
+                filtration.mst). Defaults to 1.
+            groupby (str, optional): A column of adata.obs. If set, the cells
+                of all the groups are encoded in a single pass, with their Q
+                and K accumulated per group, and calling the GRNfer returns a
+                dict of one GRN per group (@see group_grns, differential_grn).
+                The genes are selected within each group, max_cells is per
+                group and store_path gets the name of the group appended.
+                Defaults to None.
+            groups (List[str], optional): With groupby, the only groups whose
+                GRNs are inferred. The cells of the other groups are not
+                encoded, but stay in the reference of the "most var across"
+                gene selection. Defaults to None (all the groups).
+            cache_dir (str, optional): A directory where the mean Q and K of
+                the genes computed by predict() are stored, keyed by the
+                content of the cells, the weights of the model, the genes and
+                the parameters of the forward pass. When they are found there,
+                the model is not run again, so that the other parameters
+                (preprocess, head_agg, filtration...) can be explored in
+                seconds. The gene selections of "most var within" and "most var
+                across" are stored there too (@see gene_selection), they are
+                otherwise only cached for the session. Defaults to None.
+            aggregate_memory (int, optional): The memory in bytes that the
+                (genes, genes) matrices of the heads computed at once by
+                aggregate can take, with their temporaries. Defaults to None
+                (half of the free memory of the GPU, 2 GiB on CPU).
         """
         self.model = model
         self.batch_size = batch_size
@@ -103,6 +153,7 @@ class GRNfer:
         self.apc = apc
         self.forward_mode = forward_mode
         self.k = k
+        self.mst_trees = mst_trees
         self.symmetrize = symmetrize
         self.known_grn = known_grn
         self.head_agg = head_agg
@@ -110,73 +161,263 @@ class GRNfer:
         self.curr_genes = None
         self.drop_unexpressed = drop_unexpressed
         self.precision = precision
+        self.dtype = dtype
+        # the cell tokens come before the genes in the rows of the attention
+        self.ncell_tokens = model.attn.gene_dim - len(model.genes)
+        self.store_path = store_path
+        self.regulators = regulators
+        self.regulator_loc = None
+        self.groupby = groupby
+        self.group_names = None
+        self.group_genes = None
+        self.groups = groups
+        self.cache_dir = cache_dir
+        self.attn_cache = None
+        self.aggregate_memory = aggregate_memory
+        if regulators is not None:
+            if head_agg not in ["mean", "max"]:
+                raise ValueError(
+                    "regulators need a head_agg of 'mean' or 'max'"
+                )
+            if symmetrize or filtration in ["known", "tmfg", "mst"]:
+                raise ValueError(
+                    "regulators cannot be used with symmetrize or the "
+                    "'known', 'tmfg' and 'mst' filtrations"
+                )
         ##elf.trainer = Trainer(precision=precision, devices=devices, use_distributed_sampler=False)
         # subset_hvg=1000, use_layer='counts', is_symbol=True,force_preprocess=True, skip_validate=True)
 
     def __call__(self, layer, cell_type=None, locname=""):
         # Add at least the organism you are working with
         subadata = self.predict(layer, cell_type)
-        adjacencies = self.aggregate(self.model.attn.get())
+        if self.groupby is not None:
+            return dict(self.group_grns(subadata, locname))
+        adjacencies = self.aggregate(self.get_attention())
+        return self._save_adjacencies(adjacencies, subadata, locname)
+
+    def get_attention(self, group=None):
+        """
+        get_attention the mean Q and K of the genes computed by predict(), from
+        the model or from the cache
+
+        Args:
+            group (int, optional): the index of the group, @see groupby.
+                Defaults to None.
+
+        Returns:
+            Tuple[Tensor, Tensor]: the sorted vocabulary ids of the tokens
+                seen and their (layers, ids, QK, heads, dim) mean Q and K,
+                @see Attention.get
+        """
+        if self.attn_cache is None:
+            return self.model.attn.get(group=group)
+        entry = self.attn_cache["groups"][group or 0]
+        return entry["ids"], entry["qk"]
+
+    def _cache_key(self, subadata, layer):
+        return cache.cache_key(
+            cells=cache.adata_fingerprint(subadata),
+            model=cache.model_fingerprint(self.model),
+            genes=list(self.curr_genes),
+            groups=(
+                cache.labels_fingerprint(subadata.obs[self.groupby])
+                if self.groupby is not None
+                else None
+            ),
+            group_genes=self.group_genes if self.groupby is not None else None,
+            layer=layer,
+            how=self.how,
+            forward_mode=self.forward_mode,
+            batch_size=self.batch_size,
+            # Q and K accumulated in another precision are not reused
+            dtype=self.dtype,
+            precision=self.precision,
+            attn_dtype=self.model.attn.dtype,
+        )
+
+    def _save_adjacencies(self, adjacencies, subadata, locname=""):
+        n = self.ncell_tokens
         if self.head_agg == "none":
-            return self.save(adjacencies[8:, 8:, :], subadata, locname)
+            return self.save(adjacencies[n:, n:, :], subadata, locname)
+        elif self.regulators is not None:
+            # the rows are the regulators only
+            return self.save(
+                self.filter(adjacencies[:, n:]), subadata, locname
+            )
         else:
-            return self.save(self.filter(adjacencies)[8:, 8:], subadata, locname)
+            return self.save(
+                self.filter(adjacencies[n:, n:]), subadata, locname
+            )
 
-    def predict(self, layer, cell_type=None):
-        self.curr_genes = None
-        self.model.pred_log_adata = False
-        if cell_type is not None:
-            subadata = self.adata[
-                self.adata.obs[self.cell_type_col] == cell_type
-            ].copy()
-        else:
-            subadata = self.adata.copy()
+    def group_grns(self, subadata, locname=""):
+        """
+        group_grns infers the GRN of each group of cells from the Q and K
+        accumulated per group by predict(), one group at a time (@see groupby)
+
+        Args:
+            subadata (AnnData): the cells returned by predict()
+            locname (str, optional): @see save, the name of the group is
+                appended. Defaults to "".
+
+        Yields:
+            Tuple[str, GRNAnnData]: the name of the group and its GRN
+        """
+        store_path = self.store_path
+        try:
+            for i, group in enumerate(self.group_names):
+                self.curr_genes = self.group_genes[i]
+                name = str(group).replace(" ", "_")
+                if store_path is not None:
+                    self.store_path = (
+                        os.path.splitext(store_path)[0] + f"_{name}.npy"
+                    )
+                adjacencies = self.aggregate(self.get_attention(group=i))
+                yield group, self._save_adjacencies(
+                    adjacencies,
+                    subadata[(subadata.obs[self.groupby] == group).values],
+                    f"{locname}{name}_",
+                )
+        finally:
+            self.store_path = store_path
+
+    def select_genes(self, subadata, cell_type=None):
+        """
+        select_genes the genes whose GRN is inferred, according to self.how
+
+        Args:
+            subadata (AnnData): the cells
+            cell_type (str, optional): the cell type of the cells, for "most
+                var across". Defaults to None.
+
+        Returns:
+            list: the genes
+        """
         if self.how == "most var within":
-            sc.pp.highly_variable_genes(
-                subadata, flavor="seurat_v3", n_top_genes=self.num_genes
-            )
-            self.curr_genes = (
-                subadata.var.index[subadata.var.highly_variable].tolist() + self.genes
+            genes = (
+                gene_selection.highly_variable_genes(
+                    subadata,
+                    n_top_genes=self.num_genes,
+                    cache_dir=self.cache_dir,
+                )
+                + self.genes
             )
             print(
                 "number of expressed genes in this cell type: "
                 + str((subadata.X.sum(0) > 1).sum())
             )
         elif self.how == "most var across" and cell_type is not None:
-            sc.tl.rank_genes_groups(
+            # all the cell types are ranked at once, and only the first time
+            diff_expr_genes = gene_selection.rank_genes_groups(
                 self.adata,
-                mask_var=self.adata.var.index.isin(self.model.genes),
                 groupby=self.cell_type_col,
-                groups=[cell_type],
-            )
-            diff_expr_genes = self.adata.uns["rank_genes_groups"]["names"][cell_type]
+                genes=self.model.genes,
+                cache_dir=self.cache_dir,
+            )[str(cell_type)]
+            model_genes = set(self.model.genes)
             diff_expr_genes = [
-                gene for gene in diff_expr_genes if gene in self.model.genes
+                gene for gene in diff_expr_genes if gene in model_genes
             ]
-            self.curr_genes = diff_expr_genes[:self.num_genes] + self.genes
-            self.curr_genes.sort()
+            genes = diff_expr_genes[: self.num_genes] + self.genes
+            genes.sort()
         elif self.how == "random expr":
-            self.curr_genes = self.model.genes
+            genes = self.model.genes
             # raise ValueError("cannot do it yet")
-            pass
         elif self.how == "given" and len(self.genes) > 0:
-            self.curr_genes = self.genes
+            genes = self.genes
         else:
             raise ValueError("how must be one of 'most var', 'random expr'")
         if self.drop_unexpressed:
             expr = subadata.var[(subadata.X.sum(0) > 0).tolist()[0]].index.tolist()
-            self.curr_genes = [i for i in self.curr_genes if i in expr]
-        subadata = subadata[: self.max_cells] if self.max_cells else subadata
+            genes = [i for i in genes if i in expr]
+        return genes
+
+    def predict(self, layer, cell_type=None):
+        self.curr_genes = None
+        self.model.pred_log_adata = False
+        # views of the dataset, the gene selection does not modify it
+        if cell_type is not None:
+            subadata = self.adata[
+                (self.adata.obs[self.cell_type_col] == cell_type).values
+            ]
+        else:
+            subadata = self.adata
+        attn = self.model.attn
+        attn.groups, attn.n_groups, attn.group_mask = None, 1, None
+        if self.groupby is not None:
+            if self.head_agg == "mean_full":
+                raise ValueError(
+                    "groupby cannot be used with the 'mean_full' head_agg"
+                )
+            if self.groups is not None:
+                # the other cells are only a reference of the gene selection
+                subadata = subadata[
+                    subadata.obs[self.groupby].isin(self.groups).values
+                ]
+            groups = pd.Categorical(
+                subadata.obs[self.groupby]
+            ).remove_unused_categories()
+            self.group_names = list(groups.categories)
+            # the genes are selected on all the cells of the group, as its
+            # cell type for "most var across"
+            self.group_genes = [
+                self.select_genes(
+                    subadata[groups == group],
+                    group if self.groupby == self.cell_type_col else None,
+                )
+                for group in self.group_names
+            ]
+            if self.max_cells:
+                # the first max_cells cells of each group are encoded
+                subadata = subadata[
+                    (
+                        subadata.obs.groupby(
+                            self.groupby, observed=True
+                        ).cumcount()
+                        < self.max_cells
+                    ).values
+                ]
+            self.curr_genes = sorted(set().union(*self.group_genes))
+            attn.n_groups = len(self.group_names)
+            if self.how in ["most var within", "most var across"]:
+                # each group only accumulates its genes and the cell tokens
+                attn.group_mask = torch.ones(
+                    (attn.n_groups, attn.gene_dim), dtype=torch.bool
+                )
+                for i, genes in enumerate(self.group_genes):
+                    attn.group_mask[i, self.ncell_tokens :] = torch.from_numpy(
+                        np.isin(self.model.genes, genes)
+                    )
+        else:
+            self.curr_genes = self.select_genes(subadata, cell_type)
+            subadata = (
+                subadata[: self.max_cells] if self.max_cells else subadata
+            )
         if len(subadata) == 0:
             raise ValueError("no cells in the dataset")
+        self.attn_cache = None
+        use_cache = self.cache_dir is not None and self.head_agg != "mean_full"
+        if use_cache:
+            key = self._cache_key(subadata, layer)
+            self.attn_cache = cache.load(self.cache_dir, key)
+            if self.attn_cache is not None:
+                print("using the cached Q and K of " + key)
+                return subadata
+        obs_to_output, encoder = ["organism_ontology_term_id"], None
+        if self.groupby is not None:
+            # the collator passes the group of each cell along in its "class"
+            obs_to_output.append(self.groupby)
+            encoder = {
+                self.groupby: {n: i for i, n in enumerate(self.group_names)}
+            }
         adataset = SimpleAnnDataset(
-            subadata, obs_to_output=["organism_ontology_term_id"]
+            subadata, obs_to_output=obs_to_output, encoder=encoder
         )
         self.col = Collator(
             organisms=self.model.organisms,
             valid_genes=self.model.genes,
             how="some" if self.how != "random expr" else "random expr",
             genelist=self.curr_genes if self.how != "random expr" else [],
+            class_names=[self.groupby] if self.groupby is not None else [],
         )
         dataloader = DataLoader(
             adataset,
@@ -191,34 +432,71 @@ class GRNfer:
         self.model.eval()
         device = self.model.device.type
 
-        with torch.no_grad(), torch.autocast(device_type=device, dtype=dtype):
-            for batch in tqdm(dataloader):
-                gene_pos, expression, depth = (
-                    batch["genes"].to(device),
-                    batch["x"].to(device),
-                    batch["depth"].to(device),
-                )
-                self.model._predict(
-                    gene_pos,
-                    expression,
-                    depth,
-                    predict_mode=self.forward_mode,
-                    get_attention_layer=layer if type(layer) is list else [layer],
-                )
-                torch.cuda.empty_cache()
+        try:
+            with torch.no_grad(), torch.autocast(
+                device_type=device, dtype=self.dtype
+            ):
+                for batch in tqdm(dataloader):
+                    gene_pos, expression, depth = (
+                        batch["genes"].to(device),
+                        batch["x"].to(device),
+                        batch["depth"].to(device),
+                    )
+                    if self.groupby is not None:
+                        attn.groups = batch["class"][:, 0].long()
+                    self.model._predict(
+                        gene_pos,
+                        expression,
+                        depth,
+                        predict_mode=self.forward_mode,
+                        get_attention_layer=(
+                            layer if type(layer) is list else [layer]
+                        ),
+                        outputs={"cell_embs"},
+                    )
+                    torch.cuda.empty_cache()
+            attn.groups = None
+            if self.groupby is not None or use_cache:
+                # the Q and K of each group, read by get_attention
+                groups = []
+                for group in range(attn.n_groups):
+                    ids, qk = attn.get(
+                        group=group if self.groupby is not None else None
+                    )
+                    groups.append({"ids": ids, "qk": qk})
+                self.attn_cache = {"gene_dim": attn.gene_dim, "groups": groups}
+                if use_cache:
+                    cache.save(self.cache_dir, key, self.attn_cache)
+        finally:
+            if self.groupby is not None:
+                # the grouped layout is not left on the model's accumulator
+                attn.data = attn.div = attn.ids = attn.row_of = None
+            attn.groups, attn.n_groups, attn.group_mask = None, 1, None
         return subadata
 
     def aggregate(self, attn):
+        """
+        aggregate computes the (genes, genes) attention matrices of the genes
+        seen from their mean Q and K, and reduces them over the layers and
+        heads according to self.head_agg
+
+        Args:
+            attn (Tuple[Tensor, Tensor] | np.ndarray): the vocabulary ids of
+                the tokens seen and their mean Q and K (@see get_attention),
+                or the attention matrix of "mean_full"
+
+        Returns:
+            np.ndarray | Tensor: the (rows, genes) or (rows, genes, heads)
+                adjacency, with the cell tokens. The mean and max reductions
+                stay on the device of the model, for the filtrations.
+        """
         if self.head_agg == "mean_full":
             self.curr_genes = [i for i in self.model.genes if i in self.curr_genes]
             return attn
-        badloc = torch.isnan(attn.sum((0, 2, 3, 4)))
-        attn = attn[:, ~badloc, :, :, :]
-        self.curr_genes = (
-            np.array(self.curr_genes)[~badloc[8:]]
-            if self.how == "random expr"
-            else [i for i in self.model.genes if i in self.curr_genes]
-        )
+        ids, attn = attn
+        # only the rows of the tokens seen: the cell tokens, then the genes
+        n = self.ncell_tokens
+        self.curr_genes = np.array(self.model.genes)[ids[n:].numpy() - n]
         if self.doplot:
             sns.set_theme(
                 style="white", context="poster", rc={"figure.figsize": (14, 10)}
@@ -243,7 +521,14 @@ class GRNfer:
         # attn = attn[:, :, 0, :, :].permute(0, 2, 1, 3) @ attn[:, :, 1, :, :].permute(
         #    0, 2, 3, 1
         # )
-        attns = None
+        if self.head_agg not in ["mean", "max", "none"]:
+            raise ValueError("head_agg must be one of 'mean', 'max' or 'None'")
+        if self.preprocess not in ["sinkhorn", "softmax", "none"]:
+            raise ValueError(
+                "preprocess must be one of 'sinkhorn', 'softmax', 'none'"
+            )
+        # one (genes, dim) Q and K per layer and head, on the model's device
+        attn = attn.to(self.model.device)
         Qs = (
             attn[:, :, 0, :, :]
             .permute(0, 2, 1, 3)
@@ -254,97 +539,154 @@ class GRNfer:
             .permute(0, 2, 1, 3)
             .reshape(-1, attn.shape[1], attn.shape[-1])
         )
-        for i in range(Qs.shape[0]):
-            attn = Qs[i] @ Ks[i].T
-            # return attn
-            scale = Qs.shape[-1] ** -0.5
-            attn = attn * scale
+        del attn
+        n_heads, n_genes = Qs.shape[0], Qs.shape[1]
+        n_rows = n_genes
+        if self.regulators is not None:
+            regulators = (
+                self.adata.var.index[self.adata.var["symbol"].isin(utils.TF)]
+                if self.regulators == "TFs"
+                else self.regulators
+            )
+            self.regulator_loc = np.flatnonzero(
+                np.isin(self.curr_genes, regulators)
+            )
+            if len(self.regulator_loc) == 0:
+                raise ValueError(
+                    "none of the regulators are in the selected genes"
+                )
+            # only the queries of the regulators (after the cell tokens)
+            rows = torch.from_numpy(self.regulator_loc + self.ncell_tokens)
+            Qs = Qs[:, rows.to(Qs.device)]
+            n_rows = len(self.regulator_loc)
+        # the number of heads whose (rows, genes) matrices are computed at once
+        chunk_size = self._heads_per_chunk(n_rows * n_genes, Qs.device)
+        scale = Qs.shape[-1] ** -0.5
+        if self.head_agg == "none" and self.store_path is not None:
+            attns = np.lib.format.open_memmap(
+                self.store_path,
+                mode="w+",
+                dtype=np.float32,
+                shape=(n_rows, n_genes, n_heads),
+            )
+        elif self.head_agg == "none":
+            attns = np.empty((n_rows, n_genes, n_heads), dtype=np.float32)
+        else:
+            attns = torch.full(
+                (n_rows, n_genes),
+                0.0 if self.head_agg == "mean" else -float("inf"),
+                device=Qs.device,
+            )
+        for start in range(0, n_heads, chunk_size):
+            attn = (
+                Qs[start : start + chunk_size]
+                @ Ks[start : start + chunk_size].transpose(-1, -2)
+            ) * scale
             if self.preprocess == "sinkhorn":
-                if attn.numel() > 100_000_000:
-                    raise ValueError("you can't sinkhorn such a large matrix")
-                sink = SinkhornDistance(0.1, max_iter=200)
-                attn = sink(attn)[0]
-                attn = attn * Qs.shape[-1]
+                # (heads, rows, genes) batch of transport plans, in place
+                attn = (
+                    sinkhorn(attn, 0.1, max_iter=200, inplace=True)[0]
+                    * Qs.shape[-1]
+                )
             elif self.preprocess == "softmax":
                 attn = torch.nn.functional.softmax(attn, dim=-1)
-            elif self.preprocess == "none":
-                pass
-            else:
-                raise ValueError(
-                    "preprocess must be one of 'sinkhorn', 'softmax', 'none'"
-                )
-
             if self.symmetrize:
-                attn = (attn + attn.T) / 2
+                attn = (attn + attn.transpose(-1, -2)) / 2
             if self.apc:
                 pass
                 # attn = attn - (
                 #    (attn.sum(-1).unsqueeze(-1) * attn.sum(-2).unsqueeze(-2))
                 #    / attn.sum(-1).sum(-1).unsqueeze(-1).unsqueeze(-1)
                 # )  # .view()
-            if self.head_agg == "mean":
-                attns = attn.detach().cpu().numpy() + (
-                    attns if attns is not None else 0
+            # the heads are reduced on the device, only the result goes to host
+            if self.head_agg == "none":
+                attns[:, :, start : start + chunk_size] = (
+                    attn.permute(1, 2, 0).detach().cpu().numpy()
                 )
-            elif self.head_agg == "max":
-                attns = (
-                    np.maximum(attn.detach().cpu().numpy(), attns)
-                    if attns is not None
-                    else attn.detach().cpu().numpy()
-                )
-            elif self.head_agg == "none":
-                if attns is not None:
-                    if len(attns.shape) > 2:
-                        attns = np.concatenate(
-                            [attns, attn.detach().cpu().numpy()[..., np.newaxis]],
-                            axis=-1,
-                        )
-                    else:
-                        attns = np.stack([attns, attn.detach().cpu().numpy()], axis=-1)
-
-                else:
-                    attns = attn.detach().cpu().numpy()
+                continue
+            if self.head_agg == "mean":
+                attns += attn.sum(0)
             else:
-                raise ValueError("head_agg must be one of 'mean', 'max' or 'None'")
+                torch.maximum(attns, attn.amax(0), out=attns)
         if self.head_agg == "mean":
-            attns = attns / Qs.shape[0]
+            attns /= n_heads
+        if isinstance(attns, np.memmap):
+            attns.flush()
+        if self.head_agg == "none" and n_heads == 1:
+            attns = attns[:, :, 0]
         return attns
 
+    def _heads_per_chunk(self, n_elements, device):
+        """the number of heads of n_elements each that fit aggregate_memory"""
+        memory = self.aggregate_memory
+        if memory is None:
+            memory = (
+                torch.cuda.mem_get_info(device)[0] // 2
+                if device.type == "cuda"
+                else 2**31
+            )
+        # the float32 matrices, and the copies made by softmax / symmetrize
+        return max(1, memory // (3 * 4 * n_elements))
+
     def filter(self, adj, gt=None):
+        """
+        filter sparsifies the (genes, genes) aggregated adjacency matrix. The
+        thresh, top-k, known and mst filtrations go over it one block of rows
+        at a time and return a csr matrix (@see filtration)
+
+        Args:
+            adj (np.ndarray | Tensor): the dense adjacency matrix, without the
+                cell tokens, on the host or on the device
+            gt (pd.DataFrame, optional): the ground truth of the "known"
+                filtration. Defaults to None (self.known_grn).
+
+        Returns:
+            np.ndarray | scipy.sparse.csr_matrix: the filtered adjacency matrix
+        """
+        if gt is None:
+            gt = self.known_grn
+        if torch.is_tensor(adj) and self.filtration in ["none", "tmfg"]:
+            # these need the full matrix on the host
+            adj = adj.detach().cpu().numpy()
         if self.filtration == "thresh":
-            adj[adj < (1 / adj.shape[-1])] = 0
-            # res = (adj != 0).sum()
-            # if res / adj.shape[0] ** 2 < 0.01:
-            #   adj = scipy.sparse.csr_matrix(adj)
+            adj = filtration.threshold(adj)
         elif self.filtration == "none":
             pass
         elif self.filtration == "top-k":
-            args = np.argsort(adj)
-            adj[np.arange(adj.shape[0])[:, None], args[:, : -self.k]] = 0
-            adj = scipy.sparse.csr_matrix(adj)
+            adj = filtration.top_k(adj, self.k)
         elif self.filtration == "known" and gt is not None:
-            gt = gt.reindex(sorted(gt.columns), axis=1)
-            gt = gt.reindex(sorted(gt.columns), axis=0)
-            gt = gt[gt.index.isin(self.curr_genes)].iloc[
-                :, gt.columns.isin(self.curr_genes)
-            ]
-
-            loc = np.isin(self.curr_genes, gt.index)
+            loc = np.isin(self.curr_genes, gt.index) & np.isin(
+                self.curr_genes, gt.columns
+            )
+            adj = filtration.known_edges(
+                adj, filtration.known_mask(gt, list(self.curr_genes))
+            )[loc][:, loc]
             self.curr_genes = np.array(self.curr_genes)[loc]
-            adj = adj[8:, 8:][loc][:, loc]
-            adj[gt.values != 1] = 0
-            adj = scipy.sparse.csr_matrix(adj)
         elif self.filtration == "tmfg":
-            adj = nx.to_scipy_sparse_array(tmfg(adj))
+            adj = tmfg(adj)
         elif self.filtration == "mst":
-            pass
+            adj = filtration.mst(adj, k=self.k, n_trees=self.mst_trees)
         else:
-            raise ValueError("filtration must be one of 'thresh', 'none' or 'top-k'")
-        res = (adj != 0).sum() if self.filtration != "none" else adj.shape[0] ** 2
-        print(f"avg link count: {res}, sparsity: {res / adj.shape[0] ** 2}")
+            raise ValueError(
+                "filtration must be one of 'thresh', 'none', 'top-k', "
+                "'known', 'tmfg' or 'mst'"
+            )
+        size = adj.shape[0] * adj.shape[1]
+        res = adj.nnz if scipy.sparse.issparse(adj) else size
+        print(f"avg link count: {res}, sparsity: {res / size}")
         return adj
 
     def save(self, grn, subadata, loc=""):
+        if self.regulators is not None:
+            # puts the (regulators, genes) rows back in a sparse (genes, genes)
+            n_genes = len(self.curr_genes)
+            grn = scipy.sparse.csr_matrix(
+                (
+                    np.ones(len(self.regulator_loc)),
+                    (self.regulator_loc, np.arange(len(self.regulator_loc))),
+                ),
+                shape=(n_genes, len(self.regulator_loc)),
+            ) @ scipy.sparse.csr_matrix(grn)
         grn = GRNAnnData(
             subadata[:, subadata.var.index.isin(self.curr_genes)].copy(),
             grn=grn,
@@ -364,6 +706,116 @@ class GRNfer:
             return grn
 
 
+def mean_heads(
+    adj: np.ndarray, heads: Optional[np.ndarray] = None, chunk_rows: int = 256
+) -> np.ndarray:
+    """
+    mean_heads averages per-head adjacency matrices over a subset of the heads,
+    one block of rows at a time, so that a memory-mapped array (@see GRNfer's
+    store_path) is never loaded entirely
+
+    Args:
+        adj (np.ndarray): the (genes, genes, heads) adjacency matrices
+        heads (np.ndarray, optional): a boolean mask or the indices of the
+            heads to average. Defaults to None (all).
+        chunk_rows (int, optional): the number of rows read at once. Defaults
+            to 256.
+
+    Returns:
+        np.ndarray: the (genes, genes) mean adjacency matrix
+    """
+    out = np.empty(adj.shape[:2], dtype=np.float32)
+    for start in range(0, adj.shape[0], chunk_rows):
+        block = np.asarray(adj[start : start + chunk_rows])
+        out[start : start + chunk_rows] = (
+            block if heads is None else block[:, :, heads]
+        ).mean(-1)
+    return out
+
+
+def sub_grn(
+    grn: GRNAnnData,
+    genes: List[str],
+    key: str = "all",
+    use_col: str = "symbol",
+    transpose: bool = False,
+    chunk_rows: int = 256,
+) -> GRNAnnData:
+    """
+    sub_grn the per-head adjacency matrices of a subset of the genes, gathered
+    one block of rows at a time like mean_heads, so that only the rows of the
+    genes are read from a memory-mapped varp[key] (e.g. to train a classifier
+    on the genes of a ground truth without loading the full matrices)
+
+    Args:
+        grn (GRNAnnData): the GRN, with the (genes, genes, heads) matrices
+            in varp[key]
+        genes (List[str]): the genes to keep
+        key (str, optional): the varp key of the matrices. Defaults to "all".
+        use_col (str, optional): the column of grn.var with the genes.
+            Defaults to "symbol".
+        transpose (bool, optional): whether to swap the regulators and the
+            targets of the subset. Defaults to False.
+        chunk_rows (int, optional): the number of rows read at once.
+            Defaults to 256.
+
+    Returns:
+        GRNAnnData: the GRN of the genes, with their matrices in varp["GRN"]
+    """
+    adj = grn.varp[key]
+    loc = np.flatnonzero(grn.var[use_col].isin(genes).values)
+    out = np.empty((len(loc), len(loc), adj.shape[-1]), dtype=np.float32)
+    for start in range(0, len(loc), chunk_rows):
+        rows = loc[start : start + chunk_rows]
+        out[start : start + chunk_rows] = np.asarray(adj[rows])[:, loc]
+    if transpose:
+        out = out.transpose(1, 0, 2)
+    return GRNAnnData(var=grn.var.iloc[loc].copy(), grn=out)
+
+
+def _gt_genes(name: str = "omnipath") -> set:
+    gt = get_GT_db(name=name)
+    return set(gt.iloc[:, :2].values.flatten())
+
+
+def differential_grn(
+    grns: Dict[str, GRNAnnData], group: str, reference: Optional[str] = None
+) -> GRNAnnData:
+    """
+    differential_grn the difference between the GRN of a group and the GRN of a
+    reference group, or the mean GRN of all the other groups, on their common
+    genes
+
+    Args:
+        grns (Dict[str, GRNAnnData]): the GRNs of the groups, as returned by
+            GRNfer(groupby=...)
+        group (str): the group
+        reference (str, optional): the reference group. Defaults to None (all
+            the other groups).
+
+    Returns:
+        GRNAnnData: the GRN of the group, whose varp["GRN"] is the difference
+    """
+    others = (
+        [reference]
+        if reference is not None
+        else [i for i in grns if i != group]
+    )
+    genes = grns[group].var.index
+    for other in others:
+        genes = genes[genes.isin(grns[other].var.index)]
+
+    def sub(name):
+        loc = grns[name].var.index.get_indexer(genes)
+        return grns[name].varp["GRN"][loc][:, loc]
+
+    diff = sub(group) - sum(sub(other) for other in others) / len(others)
+    return GRNAnnData(
+        grns[group][:, grns[group].var.index.get_indexer(genes)].copy(),
+        grn=diff,
+    )
+
+
 def get_GTdb(db="omnipath"):
     if db == "omnipath":
         if not os.path.exists(FILEDIR + "/../../data/main/omnipath.parquet"):
@@ -416,8 +868,20 @@ def default_benchmark(
     maxgenes=5000,
     batch_size=32,
     maxcells=1024,
+    store_dir: Optional[str] = None,
 ):
+    """
+    default_benchmark benchmarks the GRNs inferred by the model on the sroy or
+    gwps ground truths, or on the cell types of a given dataset
+
+    Args:
+        store_dir (str, optional): if set, the per-head GRNs are written to
+            memory-mapped files in this directory (@see GRNfer's store_path)
+            and averaged one block of rows at a time. Defaults to None.
+    """
     metrics = {}
+    if store_dir is not None:
+        os.makedirs(store_dir, exist_ok=True)
     layers = list(range(model.nlayers))[max(0, model.nlayers - maxlayers) :]
     clf_omni = None
     if default_dataset == "sroy":
@@ -460,13 +924,18 @@ def default_benchmark(
                 doplot=False,
                 batch_size=batch_size,
                 devices=1,
+                store_path=(
+                    os.path.join(store_dir, da + ".npy")
+                    if store_dir is not None
+                    else None
+                ),
             )
             grn = grn_inferer(layer=layers)
             grn.varp["all"] = grn.varp["GRN"]
             grn.var["ensembl_id"] = grn.var.index
             grn.var["symbol"] = make_index_unique(grn.var["symbol"].astype(str))
             grn.var.index = grn.var["symbol"]
-            grn.varp["GRN"] = grn.varp["all"].mean(-1).T
+            grn.varp["GRN"] = mean_heads(grn.varp["all"]).T
             metrics["mean_" + da + "_" + gt] = BenGRN(
                 grn, do_auc=True, doplot=False
             ).compare_to(other=preadata)
@@ -478,9 +947,8 @@ def default_benchmark(
 
             ## OMNI
             if clf_omni is None:
-                grn.varp["GRN"] = grn.varp["all"]
                 _, m, clf_omni = train_classifier(
-                    grn,
+                    sub_grn(grn, _gt_genes()),
                     C=1,
                     train_size=0.9,
                     class_weight={1: 800, 0: 1},
@@ -489,7 +957,9 @@ def default_benchmark(
                 )
                 joblib.dump(clf_omni, "clf_omni.pkl")
                 metrics["omni_classifier"] = m
-            grn.varp["GRN"] = grn.varp["all"][:, :, clf_omni.coef_[0] > 0].mean(-1)
+            grn.varp["GRN"] = mean_heads(
+                grn.varp["all"], clf_omni.coef_[0] > 0
+            )
             if spe == "human":
                 metrics["omni_" + da + "_" + gt + "_base"] = BenGRN(
                     grn, do_auc=True, doplot=True
@@ -501,9 +971,8 @@ def default_benchmark(
 
             ## SELF
             if clf_self is None:
-                grn.varp["GRN"] = np.transpose(grn.varp["all"], (1, 0, 2))
                 _, m, clf_self = train_classifier(
-                    grn,
+                    sub_grn(grn, preadata.var.index, transpose=True),
                     other=preadata,
                     C=1,
                     train_size=0.5,
@@ -512,7 +981,9 @@ def default_benchmark(
                     return_full=False,
                 )
                 metrics["self_classifier"] = m
-            grn.varp["GRN"] = grn.varp["all"][:, :, clf_self.coef_[0] > 0].mean(-1).T
+            grn.varp["GRN"] = mean_heads(
+                grn.varp["all"], clf_self.coef_[0] > 0
+            ).T
             metrics["self_" + da + "_" + gt] = BenGRN(
                 grn, do_auc=True, doplot=False
             ).compare_to(other=preadata)
@@ -525,37 +996,37 @@ def default_benchmark(
             ## chip / ko
             if (da, spe, "chip") in todo:
                 preadata = get_sroy_gt(get=da, species=spe, gt="chip")
-                grn.varp["GRN"] = grn.varp["all"].mean(-1).T
+                grn.varp["GRN"] = mean_heads(grn.varp["all"]).T
                 metrics["mean_" + da + "_" + "chip"] = BenGRN(
                     grn, do_auc=True, doplot=False
                 ).compare_to(other=preadata)
-                grn.varp["GRN"] = (
-                    grn.varp["all"][:, :, clf_omni.coef_[0] > 0].mean(-1).T
-                )
+                grn.varp["GRN"] = mean_heads(
+                    grn.varp["all"], clf_omni.coef_[0] > 0
+                ).T
                 metrics["omni_" + da + "_" + "chip"] = BenGRN(
                     grn, do_auc=True, doplot=False
                 ).compare_to(other=preadata)
-                grn.varp["GRN"] = (
-                    grn.varp["all"][:, :, clf_self.coef_[0] > 0].mean(-1).T
-                )
+                grn.varp["GRN"] = mean_heads(
+                    grn.varp["all"], clf_self.coef_[0] > 0
+                ).T
                 metrics["self_" + da + "_" + "chip"] = BenGRN(
                     grn, do_auc=True, doplot=False
                 ).compare_to(other=preadata)
             if (da, spe, "ko") in todo:
                 preadata = get_sroy_gt(get=da, species=spe, gt="ko")
-                grn.varp["GRN"] = grn.varp["all"].mean(-1).T
+                grn.varp["GRN"] = mean_heads(grn.varp["all"]).T
                 metrics["mean_" + da + "_" + "ko"] = BenGRN(
                     grn, do_auc=True, doplot=False
                 ).compare_to(other=preadata)
-                grn.varp["GRN"] = (
-                    grn.varp["all"][:, :, clf_omni.coef_[0] > 0].mean(-1).T
-                )
+                grn.varp["GRN"] = mean_heads(
+                    grn.varp["all"], clf_omni.coef_[0] > 0
+                ).T
                 metrics["omni_" + da + "_" + "ko"] = BenGRN(
                     grn, do_auc=True, doplot=False
                 ).compare_to(other=preadata)
-                grn.varp["GRN"] = (
-                    grn.varp["all"][:, :, clf_self.coef_[0] > 0].mean(-1).T
-                )
+                grn.varp["GRN"] = mean_heads(
+                    grn.varp["all"], clf_self.coef_[0] > 0
+                ).T
                 metrics["self_" + da + "_" + "ko"] = BenGRN(
                     grn, do_auc=True, doplot=False
                 ).compare_to(other=preadata)
@@ -591,23 +1062,27 @@ def default_benchmark(
             num_workers=8,
             batch_size=batch_size,
             devices=1,
+            store_path=(
+                os.path.join(store_dir, "gwps.npy")
+                if store_dir is not None
+                else None
+            ),
         )
         grn = grn_inferer(layer=layers)
         grn.varp["all"] = grn.varp["GRN"]
 
-        grn.varp["GRN"] = grn.varp["all"].mean(-1).T
+        grn.varp["GRN"] = mean_heads(grn.varp["all"]).T
         metrics["mean"] = BenGRN(grn, do_auc=True, doplot=False).compare_to(other=adata)
         grn.var["ensembl_id"] = grn.var.index
         grn.var.index = grn.var["symbol"]
-        grn.varp["GRN"] = grn.varp["all"].mean(-1)
+        grn.varp["GRN"] = mean_heads(grn.varp["all"])
         metrics["mean_base"] = BenGRN(
             grn, do_auc=True, doplot=False
         ).scprint_benchmark()
 
-        grn.varp["GRN"] = grn.varp["all"]
         grn.var.index = grn.var["ensembl_id"]
         _, m, clf_omni = train_classifier(
-            grn,
+            sub_grn(grn, _gt_genes(), use_col="gene_name"),
             C=1,
             train_size=0.9,
             class_weight={1: 800, 0: 1},
@@ -616,7 +1091,7 @@ def default_benchmark(
             return_full=False,
             use_col="gene_name",
         )
-        grn.varp["GRN"] = grn.varp["all"][:, :, clf_omni.coef_[0] > 0].mean(-1).T
+        grn.varp["GRN"] = mean_heads(grn.varp["all"], clf_omni.coef_[0] > 0).T
         metrics["omni"] = BenGRN(grn, do_auc=True, doplot=False).compare_to(other=adata)
         metrics["omni_classifier"] = m
         grn.var.index = grn.var["symbol"]
@@ -624,10 +1099,11 @@ def default_benchmark(
         metrics["omni_base"] = BenGRN(
             grn, do_auc=True, doplot=False
         ).scprint_benchmark()
-        grn.varp["GRN"] = np.transpose(grn.varp["all"], (1, 0, 2))
         grn.var.index = grn.var["ensembl_id"]
         _, m, clf_self = train_classifier(
-            grn,
+            sub_grn(
+                grn, adata.var.index, use_col="ensembl_id", transpose=True
+            ),
             other=adata,
             C=1,
             train_size=0.5,
@@ -637,7 +1113,7 @@ def default_benchmark(
             return_full=False,
             use_col="ensembl_id",
         )
-        grn.varp["GRN"] = grn.varp["all"][:, :, clf_self.coef_[0] > 0].mean(-1).T
+        grn.varp["GRN"] = mean_heads(grn.varp["all"], clf_self.coef_[0] > 0).T
         metrics["self"] = BenGRN(grn, do_auc=True, doplot=False).compare_to(other=adata)
         metrics["self_classifier"] = m
         grn.var.index = grn.var["symbol"]
@@ -650,57 +1126,66 @@ def default_benchmark(
         adata = sc.read_h5ad(default_dataset)
         adata.var["isTF"] = False
         adata.var.loc[adata.var.symbol.isin(grnutils.TF), "isTF"] = True
-        for celltype in cell_types:
-            print(celltype)
-            grn_inferer = GRNfer(
-                model,
-                adata[adata.X.sum(1) > 500],
-                how="random expr",
-                preprocess="softmax",
-                head_agg="max",
-                filtration="none",
-                forward_mode="none",
-                num_workers=8,
-                num_genes=2200,
-                max_cells=maxcells,
-                doplot=False,
-                batch_size=batch_size,
-                devices=1,
-            )
-
-            grn = grn_inferer(layer=layers, cell_type=celltype)
+        adata = adata[adata.X.sum(1) > 500]
+        grn_inferer = GRNfer(
+            model,
+            adata,
+            how="random expr",
+            preprocess="softmax",
+            head_agg="max",
+            filtration="none",
+            forward_mode="none",
+            num_workers=8,
+            num_genes=2200,
+            max_cells=maxcells,
+            doplot=False,
+            batch_size=batch_size,
+            devices=1,
+            # all the cell types are encoded in a single pass
+            groupby="cell_type",
+            groups=cell_types,
+        )
+        subadata = grn_inferer.predict(layer=layers)
+        for celltype, grn in grn_inferer.group_grns(subadata):
             grn.var.index = make_index_unique(grn.var["symbol"].astype(str))
             metrics[celltype + "_scprint"] = BenGRN(
                 grn, doplot=False
             ).scprint_benchmark()
             del grn
             gc.collect()
-            grn_inferer = GRNfer(
-                model,
-                adata[adata.X.sum(1) > 500],
-                how="most var across",
-                preprocess="softmax",
-                head_agg="none",
-                filtration="none",
-                forward_mode="none",
-                num_workers=8,
-                num_genes=maxgenes,
-                max_cells=maxcells,
-                doplot=False,
-                batch_size=batch_size,
-                devices=1,
-            )
-            grn = grn_inferer(layer=layers, cell_type=celltype)
+        grn_inferer = GRNfer(
+            model,
+            adata,
+            how="most var across",
+            preprocess="softmax",
+            head_agg="none",
+            filtration="none",
+            forward_mode="none",
+            num_workers=8,
+            num_genes=maxgenes,
+            max_cells=maxcells,
+            doplot=False,
+            batch_size=batch_size,
+            devices=1,
+            store_path=(
+                os.path.join(store_dir, "celltype.npy")
+                if store_dir is not None
+                else None
+            ),
+            groupby="cell_type",
+            groups=cell_types,
+        )
+        subadata = grn_inferer.predict(layer=layers)
+        for celltype, grn in grn_inferer.group_grns(subadata):
             grn.var.index = make_index_unique(grn.var["symbol"].astype(str))
             grn.varp["all"] = grn.varp["GRN"]
-            grn.varp["GRN"] = grn.varp["GRN"].mean(-1)
+            grn.varp["GRN"] = mean_heads(grn.varp["all"])
             metrics[celltype + "_scprint_mean"] = BenGRN(
                 grn, doplot=False
             ).scprint_benchmark()
             if clf_omni is None:
-                grn.varp["GRN"] = grn.varp["all"]
                 _, m, clf_omni = train_classifier(
-                    grn,
+                    sub_grn(grn, _gt_genes()),
                     C=1,
                     train_size=0.6,
                     max_iter=300,
@@ -711,7 +1196,9 @@ def default_benchmark(
                 )
                 joblib.dump(clf_omni, "clf_omni.pkl")
                 metrics["classifier"] = m
-            grn.varp["GRN"] = grn.varp["all"][:, :, clf_omni.coef_[0] > 0].mean(-1)
+            grn.varp["GRN"] = mean_heads(
+                grn.varp["all"], clf_omni.coef_[0] > 0
+            )
             metrics[celltype + "_scprint_class"] = BenGRN(
                 grn, doplot=False
             ).scprint_benchmark()
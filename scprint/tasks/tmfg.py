@@ -1,67 +1,42 @@
-import networkx as nx
-import collections
 import numpy as np
+import scipy.sparse
 
 
-def _calculate_new_faces(faces, new, old_set):
+def _best_gains(weight, faces, remaining):
     """
-    Calculates the new triangular faces for the network when we
-    add in new
+    Finds, for each face, the remaining node with the largest gain,
+    the sum of the weights from the 3 nodes of the face to the node
 
     Parameters
     -----------
-    faces : list
-        a list of the faces present in the graph
-    new : int
-        the node id that is being added to the face
-    old_set : set
-        the old face that the node is being added to
+    weight : array_like
+        p x p matrix - the weights
+    faces : array_like
+        f x 3 array - the nodes of the faces to compute
+    remaining : array_like
+        boolean array of size p, the nodes that are not in the TMFG yet
 
     Returns
     -------
-    None
+    tuple of array_like
+        the best node and its gain for each face
     """
-    faces.remove(frozenset(old_set))
+    gains = weight[faces[:, 0]] + weight[faces[:, 1]] + weight[faces[:, 2]]
+    gains[:, ~remaining] = -np.inf
+    best = gains.argmax(axis=1)
+    return best, gains[np.arange(len(faces)), best]
 
-    faces.add(frozenset([new, old_set[1], old_set[0]]))
-    faces.add(frozenset([new, old_set[0], old_set[2]]))
-    faces.add(frozenset([new, old_set[1], old_set[2]]))
 
-
-def _add_triangular_face(G, new, old_set, C, faces):
-    """
-    Adds a new triangle to the networkx graph G
-
-    Parameters
-    -----------
-    G : networkx graph
-        the networkx graph to add the new face to
-    new : int
-        the node id that is being added to the face
-    C : array_like
-        correlation matrix
-    old_set : set
-        the old face that the node is being added to
-    faces : list
-        a list of the faces present in the graph
-
-    Returns
-    -------
-    None
-    """
-    if isinstance(new, collections.abc.Sized):
-        raise ValueError("New should be a scaler")
-
-    if len(old_set) > 3:
-        raise ValueError("Old set is not the right size!")
-    for j in old_set:
-        G.add_edge(new, j, weight=C[new, j])
-
-
-def tmfg(corr, absolute=False, threshold_mean=True):
+def tmfg(corr, absolute=False, threshold_mean=True, chunk_rows=1024):
     """
     Constructs a TMFG from the supplied correlation matrix
 
+    The TMFG is grown from the tetrahedron of the 4 most central vertices by
+    inserting, at each step, the remaining node with the largest gain into the
+    face it is the most correlated with. The best node and gain of each face
+    are kept in a table, and only the faces that are created or whose best node
+    was just inserted are recomputed, in O(p) each.
+
     Parameters
     -----------
     corr : array_like
@@ -71,70 +46,75 @@ def tmfg(corr, absolute=False, threshold_mean=True):
     threshold_mean : bool
         this will discard all correlations below the mean value when selecting the first 4
         vertices, as in the original implementation
+    chunk_rows : int
+        the number of rows of corr read at once to find the 4 first vertices
 
     Returns
     -------
-    networkx graph
-        The Triangular Maximally Filtered Graph
+    scipy.sparse.csr_matrix
+        The symmetric adjacency matrix of the Triangular Maximally Filtered
+        Graph, where the edge between an inserted node and a node of its face
+        has the weight corr[inserted, node]
     """
     p = corr.shape[0]
-
-    if absolute:
-        weight_corr = np.abs(corr)
-    else:
-        weight_corr = corr
+    weight_corr = np.abs(corr) if absolute else np.asarray(corr)
 
     # Find the 4 most central vertices
-    new_weight = weight_corr.copy()
-    if threshold_mean:
-        new_weight[new_weight < new_weight.mean()] = 0
-    degree_centrality = new_weight.sum(axis=0)
+    mean = weight_corr.mean() if threshold_mean else -np.inf
+    degree_centrality = np.zeros(p)
+    for start in range(0, p, chunk_rows):
+        block = weight_corr[start : start + chunk_rows]
+        degree_centrality += np.where(block < mean, 0, block).sum(axis=0)
     ind = np.argsort(degree_centrality)[::-1]
-    starters = ind[0:4]
-    starters_set = set(starters)
-    not_in = set(range(p))
-    not_in = not_in.difference(starters_set)
-    G = nx.Graph()
-    G.add_nodes_from(range(p))
 
     # Add the tetrahedron in
-    faces = set()
-    _add_triangular_face(G, ind[0], set([ind[1], ind[3]]), corr, faces)
-    _add_triangular_face(G, ind[1], set([ind[2], ind[3]]), corr, faces)
-    _add_triangular_face(G, ind[0], set([ind[2], ind[3]]), corr, faces)
-    _add_triangular_face(G, ind[2], set([ind[1], ind[3]]), corr, faces)
-
-    faces.add(frozenset([ind[0], ind[1], ind[3]]))
-    faces.add(frozenset([ind[1], ind[2], ind[3]]))
-    faces.add(frozenset([ind[0], ind[2], ind[3]]))
-    faces.add(frozenset([ind[0], ind[1], ind[2]]))
-
-    while len(not_in) > 0:
-        print(str(len(not_in)), end="\r")
-
-        # to_check = permutations(starters_set, 3)
-
-        max_corr = -np.inf
-        max_i = -1
-        nodes_correlated_with = None
-        not_in_arr = np.array(list(not_in))
-
-        # Find the node most correlated with the faces in the TMFG currently
-        for ind in faces:
-            ind = list(ind)
-            ind_arr = np.array(ind)
-            most_related = weight_corr[ind_arr, :][:, not_in_arr].sum(axis=0)
-            ind_2 = np.argsort(most_related)[::-1]
-            curr_corr = most_related[ind_2[0]]
-
-            if curr_corr > max_corr:
-                max_corr = curr_corr
-                max_i = not_in_arr[[ind_2[0]]]
-                nodes_correlated_with = ind
-
-        starters_set = starters_set.union(set(max_i))
-        not_in = not_in.difference(starters_set)
-        _add_triangular_face(G, max_i[0], nodes_correlated_with, corr, faces)
-        _calculate_new_faces(faces, max_i[0], nodes_correlated_with)
-
-    return G
+    rows = [ind[0], ind[0], ind[1], ind[0], ind[2], ind[2]]
+    cols = [ind[1], ind[3], ind[3], ind[2], ind[1], ind[3]]
+    faces = np.empty((max(2 * p - 4, 4), 3), dtype=np.int64)
+    faces[:4] = [
+        [ind[0], ind[1], ind[3]],
+        [ind[1], ind[2], ind[3]],
+        [ind[0], ind[2], ind[3]],
+        [ind[0], ind[1], ind[2]],
+    ]
+    n_faces = 4
+    remaining = np.ones(p, dtype=bool)
+    remaining[ind[:4]] = False
+    best_node = np.zeros(faces.shape[0], dtype=np.int64)
+    best_gain = np.full(faces.shape[0], -np.inf)
+    if p > 4:
+        best_node[:4], best_gain[:4] = _best_gains(
+            weight_corr, faces[:4], remaining
+        )
+
+    for _ in range(p - 4):
+        face = best_gain[:n_faces].argmax()
+        new = best_node[face]
+        a, b, c = faces[face]
+        remaining[new] = False
+        rows += [new, new, new]
+        cols += [a, b, c]
+        # the face is split in 3, the first one replacing it
+        faces[face] = [new, a, b]
+        faces[n_faces] = [new, a, c]
+        faces[n_faces + 1] = [new, b, c]
+        n_faces += 2
+        if not remaining.any():
+            break
+        # the new faces and the ones whose best node was just inserted
+        todo = np.flatnonzero(best_node[:n_faces] == new)
+        todo = np.union1d(todo, [face, n_faces - 2, n_faces - 1])
+        best_node[todo], best_gain[todo] = _best_gains(
+            weight_corr, faces[todo], remaining
+        )
+
+    rows, cols = np.array(rows), np.array(cols)
+    values = np.asarray(corr[rows, cols], dtype=np.float64)
+    adj = scipy.sparse.csr_matrix(
+        (
+            np.concatenate([values, values]),
+            (np.r_[rows, cols], np.r_[cols, rows]),
+        ),
+        shape=(p, p),
+    )
+    return adj
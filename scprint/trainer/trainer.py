@@ -29,6 +29,7 @@ class TrainingMode(Callback):
         do_cls: bool = True,
         do_adv_batch: bool = False,
         run_full_forward: bool = False,
+        fused_views: bool = False,
         lr: float = 0.001,
         optim: str = "adamW",
         weight_decay: float = 0.01,
@@ -72,6 +73,7 @@ class TrainingMode(Callback):
         self.do_cls = do_cls
         self.do_adv_batch = do_adv_batch
         self.run_full_forward = run_full_forward
+        self.fused_views = fused_views
         self.name = name
 
     def __repr__(self):
@@ -103,7 +105,8 @@ class TrainingMode(Callback):
             f"mvc_scale={self.mvc_scale}, "
             f"do_cls={self.do_cls}, "
             f"do_adv_batch={self.do_adv_batch}, "
-            f"run_full_forward={self.run_full_forward}), "
+            f"run_full_forward={self.run_full_forward}, "
+            f"fused_views={self.fused_views}), "
             f"name={self.name})"
         )
 
@@ -134,6 +137,7 @@ class TrainingMode(Callback):
         model.do_cls = self.do_cls
         model.do_adv_batch = self.do_adv_batch
         model.run_full_forward = self.run_full_forward
+        model.fused_views = self.fused_views
         model.lr = self.lr
         model.optim = self.optim
         model.weight_decay = self.weight_decay
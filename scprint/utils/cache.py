@@ -0,0 +1,155 @@
+import hashlib
+import json
+import os
+import tempfile
+from typing import Any, Optional
+
+import numpy as np
+import pandas as pd
+import scipy.sparse
+import torch
+from anndata import AnnData
+
+# the number of values of the expression matrix hashed at once
+_BLOCK_SIZE = 2**24
+
+
+def _update(h, array):
+    h.update(np.ascontiguousarray(array).view(np.uint8).data)
+
+
+def _update_blocks(h, adata):
+    """hashes the matrix of an AnnData (or its .raw) by blocks of cells"""
+    step = max(1, _BLOCK_SIZE // max(1, adata.n_vars))
+    for start in range(0, adata.n_obs, step):
+        X = adata[start : start + step].X
+        h.update(str(X.dtype).encode())
+        if scipy.sparse.issparse(X):
+            X = scipy.sparse.csr_matrix(X)
+            for array in [X.data, X.indices, X.indptr]:
+                _update(h, array)
+        else:
+            _update(h, np.asarray(X))
+
+
+def adata_fingerprint(adata: AnnData) -> str:
+    """
+    adata_fingerprint a hash of the content of an AnnData: its expression
+    matrix (and the one of .raw) and the names of its cells and genes.
+
+    The content is hashed at each call, so that a dataset modified in place
+    gets a new hash. A view has the same hash as its copy, its matrix is
+    hashed by blocks of cells so that it is never copied whole.
+
+    Args:
+        adata (AnnData): the dataset, or a view of it
+
+    Returns:
+        str: the hex digest
+    """
+    h = hashlib.sha256(str(adata.shape).encode())
+    _update_blocks(h, adata)
+    h.update("\n".join(adata.obs_names).encode())
+    h.update("\n".join(adata.var_names).encode())
+    if adata.raw is not None:
+        h.update(b"raw")
+        _update_blocks(h, adata.raw)
+        h.update("\n".join(adata.raw.var_names).encode())
+    return h.hexdigest()
+
+
+def labels_fingerprint(labels: pd.Series) -> str:
+    """
+    labels_fingerprint a hash of the labels of the cells (e.g. their groups),
+    from their categories and codes instead of each label
+
+    Args:
+        labels (pd.Series): the labels
+
+    Returns:
+        str: the hex digest
+    """
+    labels = pd.Categorical(labels)
+    h = hashlib.sha256(
+        json.dumps(labels.categories.astype(str).tolist()).encode()
+    )
+    _update(h, labels.codes)
+    return h.hexdigest()
+
+
+def model_fingerprint(model: torch.nn.Module) -> str:
+    """
+    model_fingerprint a hash of the weights of a model
+
+    Args:
+        model (torch.nn.Module): the model
+
+    Returns:
+        str: the hex digest
+    """
+    h = hashlib.sha256()
+    for name, tensor in model.state_dict().items():
+        h.update(name.encode())
+        _update(
+            h,
+            tensor.detach()
+            .cpu()
+            .contiguous()
+            .reshape(-1)
+            .view(torch.uint8)
+            .numpy(),
+        )
+    return h.hexdigest()
+
+
+def cache_key(**parts) -> str:
+    """
+    cache_key the hash of the given (json serializable) parts, e.g.
+    fingerprints and parameters
+
+    Returns:
+        str: the hex digest
+    """
+    return hashlib.sha256(
+        json.dumps(parts, sort_keys=True, default=str).encode()
+    ).hexdigest()
+
+
+def load(cache_dir: str, key: str) -> Optional[Any]:
+    """
+    load the object stored under key in cache_dir, @see save. Only tensors
+    and plain python objects are unpickled (torch.load(weights_only=True))
+
+    Args:
+        cache_dir (str): the cache directory
+        key (str): the key
+
+    Returns:
+        Any: the object, or None if it is not cached
+    """
+    path = os.path.join(cache_dir, key + ".pt")
+    if not os.path.exists(path):
+        return None
+    return torch.load(path, weights_only=True)
+
+
+def save(cache_dir: str, key: str, obj: Any):
+    """
+    save an object (tensors and dicts, lists, strings or numbers of them)
+    under key in cache_dir, atomically so that an interrupted run never
+    leaves a partial entry
+
+    Args:
+        cache_dir (str): the cache directory
+        key (str): the key
+        obj (Any): the object
+    """
+    os.makedirs(cache_dir, exist_ok=True)
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+    os.close(fd)
+    try:
+        torch.save(obj, tmp)
+        os.replace(tmp, os.path.join(cache_dir, key + ".pt"))
+    finally:
+        if os.path.exists(tmp):
+            os.remove(tmp)
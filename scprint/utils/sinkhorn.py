@@ -1,83 +1,126 @@
+import math
+from typing import Optional, Tuple
+
 import torch
 
 # Adapted from https://github.com/gpeyre/SinkhornAutoDiff
 # and from https://github.com/dfdazac/wassdistance/blob/master/layers.py
 
 
-class SinkhornDistance(torch.nn.Module):
-    def __init__(self, eps=1e-2, max_iter=100, reduction="none"):
-        super(SinkhornDistance, self).__init__()
-        self.eps = eps
-        self.max_iter = max_iter
-        self.reduction = reduction
+def _row_tiles(n_rows: int, chunk_rows: int):
+    for start in range(0, n_rows, chunk_rows):
+        yield slice(start, start + chunk_rows)
 
-    def forward(self, c):
-        C = -c
-        x_points = C.shape[-2]
-        batch_size = C.shape[0]
-
-        # both marginals are fixed with equal weights
-        mu = (
-            torch.empty(
-                batch_size,
-                x_points,
-                dtype=C.dtype,
-                requires_grad=False,
-                device=C.device,
-            )
-            .fill_(1.0 / x_points)
-            .squeeze()
-        )
-        nu = (
-            torch.empty(
-                batch_size,
-                x_points,
-                dtype=C.dtype,
-                requires_grad=False,
-                device=C.device,
-            )
-            .fill_(1.0 / x_points)
-            .squeeze()
-        )
-        u = torch.zeros_like(mu)
-        v = torch.zeros_like(nu)
-
-        # Stopping criterion
-        thresh = 1e-12
-
-        # Sinkhorn iterations
-        for i in range(self.max_iter):
-            if i % 2 == 0:
-                u1 = u  # useful to check the update
-                u = (
-                    self.eps
-                    * (torch.log(mu) - torch.logsumexp(self.M(C, u, v), dim=-1))
-                    + u
-                )
-                err = (u - u1).abs().sum(-1).mean()
-            else:
-                v = (
-                    self.eps
-                    * (
-                        torch.log(nu)
-                        - torch.logsumexp(self.M(C, u, v).transpose(-2, -1), dim=-1)
-                    )
-                    + v
-                )
-                v = v.detach().requires_grad_(False)
-                v[v > 9 * 1e8] = 0.0
-                v = v.detach().requires_grad_(True)
 
+@torch.no_grad()
+def sinkhorn(
+    c: torch.Tensor,
+    eps: float = 1e-2,
+    max_iter: int = 100,
+    thresh: float = 1e-12,
+    check_every: int = 10,
+    chunk_rows: Optional[int] = None,
+    inplace: bool = False,
+) -> Tuple[torch.Tensor, torch.Tensor, torch.Tensor]:
+    """
+    sinkhorn computes the entropic optimal transport plans of a batch of
+    similarity matrices, with uniform marginals, by log-domain Sinkhorn
+    iterations.
+
+    The only (B, N, M) buffer is the log kernel c / eps, which becomes the
+    transport plans at the end (in c itself if inplace), the log-sum-exps are
+    computed by tiles of chunk_rows rows. Convergence is checked (with a host
+    synchronization) every check_every iterations only.
+
+    Args:
+        c (torch.Tensor): (B, N, M) similarities (the negative costs)
+        eps (float, optional): the entropic regularization. Defaults to 1e-2.
+        max_iter (int, optional): the maximum number of half iterations
+            (updates of the row or column potentials). Defaults to 100.
+        thresh (float, optional): stops when, for every matrix of the batch,
+            the sum of the absolute changes of the row potentials is below
+            thresh. Defaults to 1e-12.
+        check_every (int, optional): the number of full iterations between two
+            convergence checks. Defaults to 10.
+        chunk_rows (int, optional): the number of rows of the tiles. Defaults
+            to None (tiles of about 2**24 elements).
+        inplace (bool, optional): whether to overwrite c with the transport
+            plans. Defaults to False.
+
+    Returns:
+        Tuple[torch.Tensor, torch.Tensor, torch.Tensor]: the (B, N, M)
+            transport plans and the (B, N) and (B, M) potentials u and v
+    """
+    batch_size, n_rows, n_cols = c.shape
+    if chunk_rows is None:
+        chunk_rows = max(1, 2**24 // (batch_size * n_cols))
+    if c.dtype in [torch.float16, torch.bfloat16]:
+        # the log domain iterations need a single precision at least
+        c, inplace = c.float(), True
+    logk = c.div_(eps) if inplace else c / eps
+    # both marginals are fixed with equal weights
+    log_mu, log_nu = -math.log(n_rows), -math.log(n_cols)
+    # the potentials, divided by eps
+    f = torch.zeros(batch_size, n_rows, dtype=logk.dtype, device=logk.device)
+    g = torch.zeros(batch_size, n_cols, dtype=logk.dtype, device=logk.device)
+
+    for i in range(0, max_iter, 2):
+        f_prev = f.clone() if (i // 2) % check_every == 0 else None
+        for tile in _row_tiles(n_rows, chunk_rows):
+            f[:, tile] = log_mu - torch.logsumexp(
+                logk[:, tile] + g[:, None, :], -1
+            )
+        if f_prev is not None:
+            err = (f - f_prev).abs().sum(-1).amax() * eps
             if err.item() < thresh:
                 break
+        if i + 1 == max_iter:
+            break
+        lse = None
+        for tile in _row_tiles(n_rows, chunk_rows):
+            tile_lse = torch.logsumexp(logk[:, tile] + f[:, tile, None], 1)
+            lse = tile_lse if lse is None else torch.logaddexp(lse, tile_lse)
+        g = log_nu - lse
+        g.masked_fill_(g * eps > 9 * 1e8, 0.0)
 
-        U, V = u, v
-        # Transport plan pi = diag(a)*K*diag(b)
-        pi = torch.exp(self.M(C, U, V))
+    # Transport plan pi = diag(a)*K*diag(b)
+    for tile in _row_tiles(n_rows, chunk_rows):
+        logk[:, tile] += f[:, tile, None] + g[:, None, :]
+    return logk.exp_(), f * eps, g * eps
 
-        # Sinkhorn distance
 
-        return pi, C, U, V
+class SinkhornDistance(torch.nn.Module):
+    def __init__(
+        self,
+        eps=1e-2,
+        max_iter=100,
+        reduction="none",
+        thresh=1e-12,
+        check_every=10,
+    ):
+        super(SinkhornDistance, self).__init__()
+        self.eps = eps
+        self.max_iter = max_iter
+        self.reduction = reduction
+        self.thresh = thresh
+        self.check_every = check_every
+
+    def forward(self, c, inplace=False):
+        """
+        @see sinkhorn
+
+        Returns:
+            the transport plans, the costs -c and the potentials u and v
+        """
+        pi, u, v = sinkhorn(
+            c,
+            self.eps,
+            self.max_iter,
+            self.thresh,
+            self.check_every,
+            inplace=inplace,
+        )
+        return pi, None if inplace else -c, u, v
 
     def M(self, C, u, v):
         "Modified cost for logarithmic updates"
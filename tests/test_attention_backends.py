@@ -0,0 +1,187 @@
+import pytest
+import torch
+
+from scprint.model.flash_attn.backends import (
+    attention,
+    flash_attn_qkvpacked_func,
+    select_backend,
+)
+from scprint.model.flash_attn.flashformer import FlashTransformerEncoder
+from scprint.model.flash_attn.mha import pack_index, varlen_attention
+
+B, S, H, D = 2, 37, 4, 16
+
+
+def _inputs(dtype=torch.float32, device="cpu"):
+    torch.manual_seed(0)
+    qkv = torch.randn(B, S, 3, H, D, dtype=dtype, device=device)
+    bias = {
+        "none": None,
+        "shared": torch.randn(1, 1, S, S, dtype=dtype, device=device),
+        "per_cell": torch.randn(B, 1, S, S, dtype=dtype, device=device),
+    }
+    return qkv, bias
+
+
+@pytest.mark.parametrize("bias", ["none", "shared", "per_cell"])
+@pytest.mark.parametrize("causal", [False, True])
+@pytest.mark.parametrize("softmax_scale", [None, 0.1])
+def test_sdpa_matches_einsum(bias, causal, softmax_scale):
+    qkv, biases = _inputs()
+    kwargs = dict(
+        bias=biases[bias], causal=causal, softmax_scale=softmax_scale
+    )
+    ref = attention(qkv, backend="einsum", **kwargs)
+    out = attention(qkv, backend="sdpa", **kwargs)
+    assert out.shape == (B, S, H, D)
+    torch.testing.assert_close(out, ref, atol=1e-5, rtol=1e-5)
+
+
+def test_sdpa_matches_einsum_key_padding():
+    qkv, _ = _inputs()
+    key_padding_mask = torch.ones(B, S, dtype=torch.bool)
+    key_padding_mask[1, -10:] = False
+    ref = attention(qkv, key_padding_mask=key_padding_mask, backend="einsum")
+    out = attention(qkv, key_padding_mask=key_padding_mask, backend="sdpa")
+    torch.testing.assert_close(out, ref, atol=1e-5, rtol=1e-5)
+
+
+@pytest.mark.parametrize("bias", ["none", "shared", "per_cell"])
+@pytest.mark.parametrize("causal", [False, True])
+@pytest.mark.parametrize("chunk_size", [8, 16])
+def test_chunked_matches_einsum(bias, causal, chunk_size):
+    qkv, biases = _inputs()
+    key_padding_mask = torch.ones(B, S, dtype=torch.bool)
+    key_padding_mask[1, -10:] = False
+    kwargs = dict(
+        bias=biases[bias],
+        causal=causal,
+        softmax_scale=0.1,
+        key_padding_mask=key_padding_mask,
+    )
+    ref = attention(qkv, backend="einsum", **kwargs)
+    out = attention(qkv, chunk_size=chunk_size, **kwargs)
+    torch.testing.assert_close(out, ref, atol=1e-5, rtol=1e-5)
+
+
+def test_select_backend_cpu():
+    qkv, biases = _inputs()
+    assert select_backend(qkv) == "sdpa"
+    assert select_backend(qkv, biases["per_cell"]) == "sdpa"
+    with pytest.raises(ValueError):
+        attention(qkv, backend="unknown")
+
+
+@pytest.mark.skipif(
+    not torch.cuda.is_available() or flash_attn_qkvpacked_func is None,
+    reason="needs CUDA and triton",
+)
+@pytest.mark.parametrize("bias", ["none", "shared", "per_cell"])
+def test_triton_matches_einsum(bias):
+    qkv, biases = _inputs(torch.float16, "cuda")
+    assert select_backend(qkv, biases[bias]) == "triton"
+    ref = attention(qkv.float(), bias=biases[bias], backend="einsum")
+    out = attention(qkv, bias=biases[bias], backend="triton")
+    torch.testing.assert_close(out.float(), ref, atol=2e-3, rtol=2e-3)
+
+
+def test_encoder_backends_match():
+    torch.manual_seed(0)
+    encoders = {
+        backend: FlashTransformerEncoder(
+            d_model=H * D,
+            nhead=H,
+            nlayers=2,
+            dropout=0.0,
+            use_flash_attn=False,
+            attn_backend=backend,
+        ).eval()
+        for backend in ["einsum", "sdpa", "chunked"]
+    }
+    encoders["sdpa"].load_state_dict(encoders["einsum"].state_dict())
+    encoders["chunked"].load_state_dict(encoders["einsum"].state_dict())
+    encoders["chunked"].set_attn_chunk_size(10)
+    x = torch.randn(B, S, H * D)
+    bias = torch.randn(B, 1, S, S)
+    with torch.no_grad():
+        ref = encoders["einsum"](x, bias=bias, bias_layer=[0, 1])
+        for backend in ["sdpa", "chunked"]:
+            out = encoders[backend](x, bias=bias, bias_layer=[0, 1])
+            torch.testing.assert_close(out, ref, atol=1e-5, rtol=1e-5)
+
+
+@pytest.mark.parametrize("backend", ["einsum", "sdpa"])
+def test_packed_matches_unpadded(backend):
+    torch.manual_seed(0)
+    encoder = FlashTransformerEncoder(
+        d_model=H * D,
+        nhead=H,
+        nlayers=2,
+        dropout=0.0,
+        use_flash_attn=False,
+        attn_backend=backend,
+    ).eval()
+    lengths = [S, 5, 20]
+    x = torch.randn(len(lengths), S, H * D)
+    bias = torch.randn(len(lengths), 1, S, S)
+    keep = torch.arange(S)[None, :] < torch.tensor(lengths)[:, None]
+    cu_seqlens = torch.tensor([0] + lengths).cumsum(0).to(torch.int32)
+    with torch.no_grad():
+        out = encoder(
+            x[keep],
+            bias=bias,
+            bias_layer=[0, 1],
+            cu_seqlens=cu_seqlens,
+            max_seqlen=max(lengths),
+        )
+        for i, length in enumerate(lengths):
+            ref = encoder(
+                x[i : i + 1, :length],
+                bias=bias[i : i + 1, :, :length, :length],
+                bias_layer=[0, 1],
+            )[0]
+            torch.testing.assert_close(
+                out[cu_seqlens[i] : cu_seqlens[i + 1]],
+                ref,
+                atol=1e-5,
+                rtol=1e-5,
+            )
+
+
+@pytest.mark.parametrize("min_fill", [1.0, 0.9])
+def test_packed_buckets(min_fill):
+    torch.manual_seed(0)
+    lengths = [17, 2, 9, 10, 0, 9, 5, 10]
+    cu_seqlens = torch.tensor([0] + lengths).cumsum(0).to(torch.int32)
+    qkv = torch.randn(sum(lengths), 3, H, D)
+    calls = []
+
+    def attn_fn(qkv, bias=None, key_padding_mask=None):
+        calls.append((qkv.shape[:2], key_padding_mask))
+        return attention(
+            qkv, bias=bias, key_padding_mask=key_padding_mask, backend="einsum"
+        )
+
+    index = pack_index(cu_seqlens, min_fill=min_fill)
+    out = varlen_attention(attn_fn, qkv, cu_seqlens, index=index)
+    # each bucket is padded to its own longest sequence
+    real = sum(length**2 for length in lengths)
+    work = sum(n * seqlen**2 for (n, seqlen), _ in calls)
+    if min_fill == 1.0:
+        # the sequences of a bucket have the same length, no work on padding
+        assert work == real
+        assert all(mask is None for _, mask in calls)
+        assert sorted(seqlen for (_, seqlen), _ in calls) == [2, 5, 9, 10, 17]
+    else:
+        for (n, seqlen), mask in calls:
+            if mask is not None:
+                fill = (mask.sum(1) ** 2).sum() / (n * seqlen**2)
+                assert fill >= min_fill
+        assert len(calls) < 5
+        assert work < len(lengths) * max(lengths) ** 2
+    for i, length in enumerate(lengths):
+        tokens = slice(cu_seqlens[i], cu_seqlens[i + 1])
+        if length == 0:
+            continue
+        ref = attention(qkv[None, tokens], backend="einsum")[0]
+        torch.testing.assert_close(out[tokens], ref, atol=1e-5, rtol=1e-5)
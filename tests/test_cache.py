@@ -0,0 +1,89 @@
+import os
+
+import numpy as np
+import pandas as pd
+import torch
+from anndata import AnnData
+
+from scprint.utils import cache
+
+
+def test_cache_roundtrip():
+    obj = {
+        "gene_dim": 12,
+        "groups": [
+            {"ids": torch.arange(5), "qk": torch.randn(2, 5, 2, 3, 4)},
+            {"ids": torch.arange(3), "qk": torch.randn(2, 3, 2, 3, 4)},
+        ],
+        "genes": ["G1", "G2"],
+        "rankings": {"a": ["G2", "G1"], "b": []},
+    }
+    key = cache.cache_key(selection="test", n=2)
+    assert cache.load("cache", key) is None
+    cache.save("cache", key, obj)
+    assert os.listdir("cache") == [key + ".pt"]
+    out = cache.load("cache", key)
+    assert out["gene_dim"] == 12
+    assert out["genes"] == obj["genes"]
+    assert out["rankings"] == obj["rankings"]
+    for a, b in zip(out["groups"], obj["groups"]):
+        assert torch.equal(a["ids"], b["ids"])
+        assert torch.equal(a["qk"], b["qk"])
+
+
+def test_cache_key():
+    assert cache.cache_key(a=1, b="x") == cache.cache_key(b="x", a=1)
+    assert cache.cache_key(a=1) != cache.cache_key(a=2)
+
+
+def test_adata_fingerprint():
+    rng = np.random.default_rng(0)
+    adata = AnnData(
+        X=rng.poisson(1.0, (20, 6)).astype(np.float32),
+        obs=pd.DataFrame(index=[f"c{i}" for i in range(20)]),
+        var=pd.DataFrame(index=[f"G{i}" for i in range(6)]),
+    )
+    key = cache.adata_fingerprint(adata)
+    assert cache.adata_fingerprint(adata) == key
+    assert cache.adata_fingerprint(adata.copy()) == key
+    # views are hashed from their positions in the parent
+    view = adata[adata.obs_names[:10], :]
+    assert view.is_view
+    assert cache.adata_fingerprint(view) == cache.adata_fingerprint(adata[:10])
+    assert cache.adata_fingerprint(view) != cache.adata_fingerprint(adata[10:])
+    assert cache.adata_fingerprint(view) != key
+    assert cache.adata_fingerprint(view[:, :3]) == cache.adata_fingerprint(
+        adata[:10, :3]
+    )
+    assert view.is_view
+    assert cache.adata_fingerprint(view) == cache.adata_fingerprint(
+        view.copy()
+    )
+
+
+def test_adata_fingerprint_inplace():
+    rng = np.random.default_rng(0)
+    adata = AnnData(
+        X=rng.poisson(1.0, (20, 6)).astype(np.float32),
+        obs=pd.DataFrame(index=[f"c{i}" for i in range(20)]),
+        var=pd.DataFrame(index=[f"G{i}" for i in range(6)]),
+    )
+    key = cache.adata_fingerprint(adata)
+    # the dataset is modified in place: its hash changes
+    adata.X[0, 0] += 1
+    edited = cache.adata_fingerprint(adata)
+    assert edited != key
+    adata.X = adata.X * 2
+    assert cache.adata_fingerprint(adata) not in [key, edited]
+    adata.raw = adata
+    assert cache.adata_fingerprint(adata) != cache.adata_fingerprint(
+        adata.raw.to_adata()
+    )
+
+
+def test_labels_fingerprint():
+    labels = pd.Series(["a", "b", "a", "c"])
+    key = cache.labels_fingerprint(labels)
+    assert cache.labels_fingerprint(labels.astype("category")) == key
+    assert cache.labels_fingerprint(labels[::-1]) != key
+    assert cache.labels_fingerprint(labels.replace("c", "d")) != key
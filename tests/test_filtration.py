@@ -0,0 +1,72 @@
+import numpy as np
+import pytest
+import torch
+
+from scprint.tasks import filtration
+
+
+def _adj(rows=37, genes=37):
+    rng = np.random.default_rng(0)
+    adj = rng.random((rows, genes), dtype=np.float32)
+    return adj / adj.sum(1, keepdims=True)
+
+
+@pytest.mark.parametrize("tensor", [False, True])
+@pytest.mark.parametrize("thresh", [None, 0.03])
+def test_threshold(tensor, thresh):
+    adj = _adj(rows=20)
+    out = filtration.threshold(
+        torch.from_numpy(adj) if tensor else adj, thresh, chunk_rows=8
+    )
+    ref = np.where(adj >= (thresh or 1 / adj.shape[1]), adj, 0)
+    assert out.shape == adj.shape
+    np.testing.assert_array_equal(out.toarray(), ref)
+
+
+@pytest.mark.parametrize("tensor", [False, True])
+@pytest.mark.parametrize("k", [1, 5, 100])
+def test_top_k(tensor, k):
+    adj = _adj(rows=20)
+    out = filtration.top_k(
+        torch.from_numpy(adj) if tensor else adj, k, chunk_rows=8
+    )
+    k = min(k, adj.shape[1])
+    ref = np.zeros_like(adj)
+    cols = np.argsort(-adj, axis=1)[:, :k]
+    np.put_along_axis(ref, cols, np.take_along_axis(adj, cols, 1), 1)
+    np.testing.assert_array_equal(out.toarray(), ref)
+    assert (out.getnnz(1) == k).all()
+
+
+def _edges(adj):
+    adj = adj.tocoo()
+    return {tuple(sorted(e)) for e in zip(adj.row, adj.col)}
+
+
+@pytest.mark.parametrize("k", [5, 36])
+@pytest.mark.parametrize("n_trees", [1, 2])
+def test_mst(k, n_trees):
+    nx = pytest.importorskip("networkx")
+    adj = _adj()
+    out = filtration.mst(torch.from_numpy(adj), k=k, n_trees=n_trees)
+    # the candidates: the k strongest edges of each row, undirected
+    candidates = filtration.top_k(adj, k).toarray()
+    np.fill_diagonal(candidates, 0)
+    weights = np.maximum(candidates, candidates.T)
+    graph = nx.Graph()
+    graph.add_nodes_from(range(len(adj)))
+    graph.add_weighted_edges_from(
+        (i, j, weights[i, j]) for i, j in zip(*np.nonzero(np.triu(weights)))
+    )
+    ref = set()
+    for _ in range(n_trees):
+        tree = {
+            tuple(sorted(e)) for e in nx.maximum_spanning_tree(graph).edges
+        }
+        graph.remove_edges_from(tree)
+        ref |= tree
+    assert _edges(out) == ref
+    # the kept edges have their weights, in the directions of the candidates
+    out = out.toarray()
+    np.testing.assert_array_equal(out[out != 0], candidates[out != 0])
+    assert ((out != 0) == ((candidates != 0) & (out + out.T != 0))).all()
@@ -0,0 +1,65 @@
+import numpy as np
+import pandas as pd
+import scanpy as sc
+from anndata import AnnData
+
+from scprint.tasks import gene_selection
+
+
+def test_rank_genes_groups():
+    rng = np.random.default_rng(0)
+    X = rng.poisson(2.0, (60, 8)).astype(np.float32)
+    X[:20, 0] += 10
+    X[20:40, 1] += 10
+    adata = AnnData(
+        X=X,
+        obs=pd.DataFrame(
+            {"cell_type": np.repeat(["a", "b", "c"], 20)},
+            index=[f"c{i}" for i in range(60)],
+        ),
+        var=pd.DataFrame(index=[f"G{i}" for i in range(8)]),
+    )
+    view = adata[adata.obs_names[5:], :]
+    ranks = gene_selection.rank_genes_groups(view, groupby="cell_type")
+    assert view.is_view
+    assert "rank_genes_groups" not in adata.uns
+    assert ranks["a"][0] == "G0"
+    assert ranks["b"][0] == "G1"
+
+    expected = view.copy()
+    sc.tl.rank_genes_groups(expected, groupby="cell_type")
+    names = expected.uns["rank_genes_groups"]["names"]
+    for group in ["a", "b", "c"]:
+        assert ranks[group] == np.asarray(names[group]).tolist()
+
+    # the genes to rank
+    ranks = gene_selection.rank_genes_groups(
+        view, groupby="cell_type", genes=["G1", "G2", "G3"]
+    )
+    assert sorted(ranks["b"]) == ["G1", "G2", "G3"]
+    assert ranks["b"][0] == "G1"
+
+
+def test_rank_genes_groups_raw():
+    rng = np.random.default_rng(0)
+    X = rng.poisson(2.0, (60, 8)).astype(np.float32)
+    X[:20, 0] += 10
+    adata = AnnData(
+        X=X,
+        obs=pd.DataFrame(
+            {"cell_type": np.repeat(["a", "b", "c"], 20)},
+            index=[f"c{i}" for i in range(60)],
+        ),
+        var=pd.DataFrame(index=[f"G{i}" for i in range(8)]),
+    )
+    adata.raw = adata
+    # the matrix differs from .raw, which scanpy ranks by default
+    adata.X = adata.X[:, ::-1].copy()
+    ranks = gene_selection.rank_genes_groups(adata, groupby="cell_type")
+    assert ranks["a"][0] == "G0"
+
+    expected = adata.copy()
+    sc.tl.rank_genes_groups(expected, groupby="cell_type")
+    names = expected.uns["rank_genes_groups"]["names"]
+    for group in ["a", "b", "c"]:
+        assert ranks[group] == np.asarray(names[group]).tolist()
@@ -0,0 +1,240 @@
+from types import SimpleNamespace
+
+import numpy as np
+import pandas as pd
+import pytest
+import torch
+from anndata import AnnData
+from grnndata import GRNAnnData
+
+from scprint.model.utils import Attention
+from scprint.tasks.grn import GRNfer, mean_heads, sub_grn
+
+
+def _grn(n=30, heads=4, memmap=False):
+    rng = np.random.default_rng(0)
+    adj = rng.random((n, n, heads), dtype=np.float32)
+    if memmap:
+        path = "all.npy"
+        np.save(path, adj)
+        adj = np.load(path, mmap_mode="r")
+    var = pd.DataFrame(
+        {"symbol": [f"G{i}" for i in range(n)]},
+        index=[f"E{i}" for i in range(n)],
+    )
+    grn = GRNAnnData(var=var, grn=mean_heads(adj))
+    grn.varp["all"] = adj
+    return grn
+
+
+@pytest.mark.parametrize("memmap", [False, True])
+@pytest.mark.parametrize("transpose", [False, True])
+def test_sub_grn(memmap, transpose):
+    grn = _grn(memmap=memmap)
+    genes = ["G3", "G17", "G0", "G29", "G8", "missing"]
+    sub = sub_grn(grn, genes, transpose=transpose, chunk_rows=2)
+    full = np.asarray(grn.varp["all"])
+    if transpose:
+        full = np.transpose(full, (1, 0, 2))
+    loc = grn.var["symbol"].isin(genes).values
+    assert sub.var.index.tolist() == ["E0", "E3", "E8", "E17", "E29"]
+    np.testing.assert_array_equal(sub.varp["GRN"], full[loc][:, loc])
+
+
+@pytest.mark.parametrize("dtype", [torch.float32, torch.bfloat16])
+@pytest.mark.parametrize("masked", [False, True])
+def test_grouped_attention(dtype, masked):
+    torch.manual_seed(0)
+    ncell_tokens, n_genes, seq_len = 3, 10, 5
+    gene_dim = ncell_tokens + n_genes
+    groups = torch.tensor([0, 1, 0, 2, 1, 0])
+    pos = torch.stack([torch.randperm(n_genes)[:seq_len] for _ in groups])
+    x = [torch.randn(len(groups), ncell_tokens + seq_len, 2, 2, 4)]
+    x.append(2 * x[0])
+    mask = torch.rand(3, gene_dim) > 0.3
+    mask[:, :ncell_tokens] = True
+    attn = Attention(gene_dim, dtype=dtype)
+    attn.n_groups, attn.groups = 3, groups
+    attn.group_mask = mask if masked else None
+    attn.agg(x, pos)
+    for group in range(3):
+        ref = Attention(gene_dim, dtype=dtype)
+        ref.agg([i[groups == group] for i in x], pos[groups == group])
+        ids, qk = attn.get(group=group)
+        ref_ids, ref_qk = ref.get()
+        if masked:
+            keep = mask[group, ref_ids]
+            ref_ids, ref_qk = ref_ids[keep], ref_qk[:, keep]
+        assert torch.equal(ids, ref_ids)
+        torch.testing.assert_close(qk, ref_qk)
+    with pytest.raises(ValueError):
+        attn.get()
+
+
+@pytest.fixture
+def tiny_model(monkeypatch):
+    scdataloader_collator = pytest.importorskip("scdataloader.collator")
+    from scprint.model.model import scPrint
+
+    torch.manual_seed(0)
+    genes = [f"G{i}" for i in range(40)]
+    model = scPrint(
+        genes=genes,
+        d_model=16,
+        nhead=2,
+        d_hid=16,
+        nlayers=2,
+        dropout=0.0,
+        transformer="normal",
+        classes={"cell_type_ontology_term_id": 3},
+    ).eval()
+    # the collator's gene table, instead of the one of the lamindb instance
+    genedf = pd.DataFrame({"organism": model.organisms[0]}, index=genes)
+    monkeypatch.setattr(
+        scdataloader_collator, "load_genes", lambda organisms: genedf
+    )
+    return model
+
+
+def _adata(model, n_cells=30):
+    rng = np.random.default_rng(0)
+    cell_types = np.tile(["a", "b", "c"], n_cells // 3)
+    X = rng.poisson(rng.gamma(2.0, 2.0, (n_cells, len(model.genes))))
+    # the groups have different expressions
+    X[cell_types == "b"] *= 100
+    X[cell_types == "c", ::3] = 0
+    organisms = np.array([model.organisms[0]] * n_cells, dtype=object)
+    # cells of another organism, dropped by the collator
+    organisms[[4, 13]] = "NCBITaxon:10090"
+    return AnnData(
+        X=X.astype(np.float32),
+        obs=pd.DataFrame(
+            {"organism_ontology_term_id": organisms, "cell_type": cell_types},
+            index=[f"cell{i}" for i in range(n_cells)],
+        ),
+        var=pd.DataFrame({"symbol": model.genes}, index=model.genes),
+    )
+
+
+@pytest.mark.parametrize("cache_dir", [None, "cache"])
+@pytest.mark.parametrize(
+    "selection",
+    [
+        dict(how="given", genes=[f"G{i}" for i in range(0, 40, 2)]),
+        # the genes are selected on all the cells of a group, then max_cells
+        # of them are encoded
+        dict(
+            how="most var across",
+            num_genes=12,
+            max_cells=4,
+            drop_unexpressed=True,
+        ),
+    ],
+)
+def test_grnfer_groupby(tiny_model, cache_dir, selection):
+    adata = _adata(tiny_model)
+    kwargs = dict(
+        batch_size=4,
+        num_workers=0,
+        doplot=False,
+        filtration="none",
+        dtype=torch.bfloat16,
+        cache_dir=cache_dir,
+        **selection,
+    )
+    grnfer = GRNfer(tiny_model, adata, groupby="cell_type", **kwargs)
+    grns = grnfer(layer=[0, 1])
+    assert list(grns) == ["a", "b", "c"]
+    # the model's accumulator is left ungrouped
+    assert tiny_model.attn.groups is None
+    assert tiny_model.attn.n_groups == 1
+    assert tiny_model.attn.group_mask is None
+    for group, grn in grns.items():
+        ref = GRNfer(tiny_model, adata, **kwargs)
+        ref = ref(layer=[0, 1], cell_type=group)
+        if selection["how"] == "given":
+            assert grn.var.index.tolist() == selection["genes"]
+        assert grn.var.index.tolist() == ref.var.index.tolist()
+        np.testing.assert_allclose(grn.varp["GRN"], ref.varp["GRN"], rtol=1e-6)
+    # only some of the groups, the others stay in the gene selection
+    some = GRNfer(
+        tiny_model, adata, groupby="cell_type", groups=["a", "c"], **kwargs
+    )(layer=[0, 1])
+    assert list(some) == ["a", "c"]
+    for group, grn in some.items():
+        assert grn.var.index.tolist() == grns[group].var.index.tolist()
+        np.testing.assert_allclose(
+            grn.varp["GRN"], grns[group].varp["GRN"], rtol=1e-6
+        )
+    if cache_dir is not None:
+        # the Q and K are read from the cache, the model is not run
+        grnfer = GRNfer(tiny_model, adata, groupby="cell_type", **kwargs)
+        tiny_model._predict = None
+        for group, grn in grnfer(layer=[0, 1]).items():
+            assert grnfer.attn_cache is not None
+            np.testing.assert_array_equal(
+                grn.varp["GRN"], grns[group].varp["GRN"]
+            )
+
+def test_grnfer_cache_precision(tiny_model):
+    adata = _adata(tiny_model)
+    kwargs = dict(
+        how="given",
+        genes=tiny_model.genes[::2],
+        batch_size=4,
+        num_workers=0,
+        doplot=False,
+        filtration="none",
+        cache_dir="cache",
+    )
+    calls = []
+    predict = tiny_model._predict
+
+    def counted(*args, **kwargs):
+        calls.append(1)
+        return predict(*args, **kwargs)
+
+    tiny_model._predict = counted
+    GRNfer(tiny_model, adata, dtype=torch.bfloat16, **kwargs)(layer=[0, 1])
+    n = len(calls)
+    assert n > 0
+    GRNfer(tiny_model, adata, dtype=torch.bfloat16, **kwargs)(layer=[0, 1])
+    assert len(calls) == n
+    # only the precision changes: the cache is missed
+    GRNfer(tiny_model, adata, dtype=torch.float32, **kwargs)(layer=[0, 1])
+    assert len(calls) == 2 * n
+
+
+@pytest.mark.parametrize("head_agg", ["mean", "max", "none"])
+def test_aggregate_chunks(head_agg):
+    torch.manual_seed(0)
+    n_genes, ncell_tokens = 30, 2
+    attn = torch.randn(2, n_genes + ncell_tokens, 2, 4, 8)
+    ids = torch.arange(n_genes + ncell_tokens)
+    model = SimpleNamespace(
+        device=torch.device("cpu"),
+        genes=[f"G{i}" for i in range(n_genes)],
+        attn=SimpleNamespace(gene_dim=n_genes + ncell_tokens),
+    )
+    size = (n_genes + ncell_tokens) ** 2
+    adjs = []
+    # one head at a time, then the 8 heads at once
+    for memory in [1, 12 * 8 * size]:
+        grnfer = GRNfer(
+            model,
+            None,
+            head_agg=head_agg,
+            doplot=False,
+            aggregate_memory=memory,
+        )
+        assert grnfer._heads_per_chunk(size, model.device) in [1, 8]
+        adjs.append(grnfer.aggregate((ids, attn)))
+    torch.testing.assert_close(
+        torch.as_tensor(adjs[0]),
+        torch.as_tensor(adjs[1]),
+        atol=1e-6,
+        rtol=1e-5,
+    )
+    # several 5000 x 5000 heads fit in 8 GiB
+    grnfer.aggregate_memory = 2**33
+    assert grnfer._heads_per_chunk(5000 * 5000, model.device) == 28
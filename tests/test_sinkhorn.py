@@ -0,0 +1,53 @@
+import pytest
+import torch
+
+from scprint.utils.sinkhorn import SinkhornDistance, sinkhorn
+
+
+def _scores(batch_size=3, n_rows=20, n_cols=30):
+    torch.manual_seed(0)
+    return torch.randn(batch_size, n_rows, n_cols, dtype=torch.float64)
+
+
+@pytest.mark.parametrize("chunk_rows", [None, 3])
+def test_sinkhorn_marginals(chunk_rows):
+    c = _scores()
+    pi, u, v = sinkhorn(c, 0.1, max_iter=500, chunk_rows=chunk_rows)
+    n_rows, n_cols = c.shape[1:]
+    torch.testing.assert_close(
+        pi.sum(-1), torch.full_like(u, 1 / n_rows), rtol=0, atol=1e-8
+    )
+    torch.testing.assert_close(
+        pi.sum(-2), torch.full_like(v, 1 / n_cols), rtol=0, atol=1e-8
+    )
+
+
+def test_sinkhorn_tiles_match():
+    c = _scores()
+    ref = sinkhorn(c, 0.1, max_iter=50)
+    for out in [
+        sinkhorn(c, 0.1, max_iter=50, chunk_rows=7),
+        sinkhorn(c.clone(), 0.1, max_iter=50, chunk_rows=1, inplace=True),
+    ]:
+        for a, b in zip(out, ref):
+            torch.testing.assert_close(a, b)
+
+
+def test_sinkhorn_converges_on_every_matrix():
+    # the zero matrices converge at once, not the last one
+    c = torch.zeros(100, 20, 30, dtype=torch.float64)
+    c[-1] = 2 * _scores(1)[0]
+    pi = sinkhorn(c, 0.1, max_iter=20000, thresh=1e-4, check_every=1)[0]
+    # it stops after an update of the rows, the columns are off until then
+    torch.testing.assert_close(
+        pi.sum(-2), torch.full((100, 30), 1 / 30).double(), rtol=0, atol=5e-5
+    )
+
+
+def test_sinkhorn_distance_inplace():
+    c = _scores()
+    pi, cost, u, v = SinkhornDistance(0.1, max_iter=50)(c)
+    torch.testing.assert_close(cost, -c)
+    inplace = SinkhornDistance(0.1, max_iter=50)(c.clone(), inplace=True)
+    assert inplace[1] is None
+    torch.testing.assert_close(inplace[0], pi)
@@ -0,0 +1,63 @@
+import numpy as np
+import pytest
+
+from scprint.tasks.tmfg import tmfg
+
+
+def _reference_tmfg(corr, absolute=False, threshold_mean=True):
+    """the previous networkx implementation, testing every face at each step"""
+    nx = pytest.importorskip("networkx")
+    p = corr.shape[0]
+    weight_corr = np.abs(corr) if absolute else corr
+    new_weight = weight_corr.copy()
+    if threshold_mean:
+        new_weight[new_weight < new_weight.mean()] = 0
+    ind = np.argsort(new_weight.sum(axis=0))[::-1]
+    not_in = set(range(p)) - set(ind[:4])
+    G = nx.Graph()
+    G.add_nodes_from(range(p))
+    for new, old in [(0, [1, 3]), (1, [2, 3]), (0, [2, 3]), (2, [1, 3])]:
+        for j in old:
+            G.add_edge(ind[new], ind[j], weight=corr[ind[new], ind[j]])
+    faces = {
+        frozenset(ind[[0, 1, 3]]),
+        frozenset(ind[[1, 2, 3]]),
+        frozenset(ind[[0, 2, 3]]),
+        frozenset(ind[[0, 1, 2]]),
+    }
+    while not_in:
+        max_corr, max_i, best = -np.inf, -1, None
+        not_in_arr = np.array(list(not_in))
+        for face in faces:
+            face = list(face)
+            related = weight_corr[face][:, not_in_arr].sum(axis=0)
+            if related.max() > max_corr:
+                max_corr = related.max()
+                max_i = not_in_arr[related.argmax()]
+                best = face
+        not_in.remove(max_i)
+        for j in best:
+            G.add_edge(max_i, j, weight=corr[max_i, j])
+        faces.remove(frozenset(best))
+        faces |= {
+            frozenset([max_i, best[0], best[1]]),
+            frozenset([max_i, best[0], best[2]]),
+            frozenset([max_i, best[1], best[2]]),
+        }
+    return nx.to_numpy_array(G, nodelist=range(p))
+
+
+@pytest.mark.parametrize("p", [4, 5, 60])
+@pytest.mark.parametrize("absolute", [False, True])
+@pytest.mark.parametrize("threshold_mean", [False, True])
+def test_tmfg_matches_reference(p, absolute, threshold_mean):
+    rng = np.random.default_rng(p)
+    corr = np.corrcoef(rng.standard_normal((p, 3 * p)))
+    adj = tmfg(
+        corr, absolute=absolute, threshold_mean=threshold_mean, chunk_rows=7
+    )
+    ref = _reference_tmfg(
+        corr, absolute=absolute, threshold_mean=threshold_mean
+    )
+    assert adj.nnz == 2 * (3 * p - 6)
+    np.testing.assert_allclose(adj.toarray(), ref)